@@ -11,7 +11,9 @@ import torch.nn.functional as F
 import shutil
 from tqdm import tqdm
 from src.metrics import chamfer_distance_and_f_score
-from scipy.sparse import csr_matrix
+from src.checkpoint import latest_checkpoint
+from src.geometry import xray_to_pcd
+from src.xray_io import load_xray
 import argparse
 from diffusers import AutoencoderKLTemporalDecoder
 from src.dataset import UpsamplerDataset
@@ -19,61 +21,6 @@ import time
 from torch.utils.tensorboard import SummaryWriter
 
 
-def get_rays(directions, c2w):
-    # Rotate ray directions from camera coordinate to the world coordinate
-    rays_d = directions @ c2w[:3, :3].T # (H, W, 3)
-    rays_d = rays_d / (np.linalg.norm(rays_d, axis=-1, keepdims=True) + 1e-8)
-    
-    # The origin of all rays is the camera origin in world coordinate
-    rays_o = np.broadcast_to(c2w[:3, 3], rays_d.shape) # (H, W, 3)
-
-    return rays_o, rays_d
-
-def xray_to_pcd(GenDepths, GenNormals, GenColors):
-    camera_angle_x = 0.8575560450553894
-    image_width = GenDepths.shape[-1]
-    image_height = GenDepths.shape[-2]
-    fx = 0.5 * image_width / np.tan(0.5 * camera_angle_x)
-
-    rays_screen_coords = np.mgrid[0:image_height, 0:image_width].reshape(
-            2, image_height * image_width).T  # [h, w, 2]
-
-    grid = rays_screen_coords.reshape(image_height, image_width, 2)
-
-    cx = image_width / 2.0
-    cy = image_height / 2.0
-
-    i, j = grid[..., 1], grid[..., 0]
-
-    directions = np.stack([(i-cx)/fx, -(j-cy)/fx, -np.ones_like(i)], -1) # (H, W, 3)
-
-    c2w = np.eye(4).astype(np.float32)
-
-    rays_origins, ray_directions = get_rays(directions, c2w)
-    rays_origins = rays_origins[None].repeat(GenDepths.shape[0], 0)
-    ray_directions = ray_directions[None].repeat(GenDepths.shape[0], 0)
-
-    GenDepths = GenDepths.transpose(0, 2, 3, 1)
-    GenNormals = GenNormals.transpose(0, 2, 3, 1)
-    GenColors = GenColors.transpose(0, 2, 3, 1)
-    
-    valid_index = GenDepths[..., 0] > 0
-    rays_origins = rays_origins[valid_index]
-    ray_directions = ray_directions[valid_index]
-    GenDepths = GenDepths[valid_index]
-    normals = GenNormals[valid_index]
-    colors = GenColors[valid_index]
-    xyz = rays_origins + ray_directions * GenDepths
-    return xyz, normals, colors
-
-
-def load_xray(xray_path):
-    loaded_data = np.load(xray_path)
-    loaded_sparse_matrix = csr_matrix((loaded_data['data'], loaded_data['indices'], loaded_data['indptr']), shape=loaded_data['shape'])
-    original_shape = (16, 1+3+3, 256, 256)
-    restored_array = loaded_sparse_matrix.toarray().reshape(original_shape)
-    return restored_array
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("X-Ray full Inference")
     parser.add_argument("--exp_vae", type=str, help="experiment name")
@@ -97,11 +44,8 @@ if __name__ == "__main__":
         os.makedirs(f"Output/{exp_vae}/evaluate", exist_ok=True)
         progress_bar =  tqdm(range(500))
         
-        # Get the most recent checkpoint
-        dirs = os.listdir(os.path.join("Output", exp_vae))
-        dirs = [d for d in dirs if d.startswith("checkpoint")]
-        dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
-        ckpt_name = dirs[-1]
+        # Get the most recent checkpoint that was completely written
+        ckpt_name = latest_checkpoint(os.path.join("Output", exp_vae))
         print("restore from", f"Output/{exp_vae}/{ckpt_name}/vae")
         vae = AutoencoderKLTemporalDecoder.from_pretrained(f"Output/{exp_vae}/{ckpt_name}", subfolder="vae").cuda()
 
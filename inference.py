@@ -0,0 +1,100 @@
+"""Single-process image-to-X-Ray inference: the diffusion model and the upsampler in one pass.
+
+Does what `inference_lr.py` followed by `inference_hr.py` does, without the stage boundary on disk:
+the low-res X-Rays of a batch stay on the GPU and go straight into the upsampler, and every
+condition image is decoded and resized once, for both stages (64 * 8 = 256 * 2 = 512 pixels).
+Only the final point clouds `<uid>_prd.ply` and the condition images `<uid>.png` are written, on a
+background thread; `--save_lr` also writes the low-res stage as `<uid>_lr.pt` / `<uid>_lr_prd.ply`.
+
+Example:
+    python inference.py --exp_diffusion Objaverse_XRay --exp_upsampler Objaverse_XRay_upsampler \
+        --data_root Data/Test/images --batch_size 8
+"""
+import argparse
+import glob
+import os
+
+import torch
+import torchvision
+from diffusers import AutoencoderKL, UNetSpatioTemporalConditionModel
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from src.background import BackgroundWriter, to_host
+from src.checkpoint import latest_checkpoint
+from src.inference import ConditionImageDataset, collate_images, save_hr_outputs, save_lr_outputs
+from src.xray_decoder import AutoencoderKLTemporalDecoder
+from src.xray_pipeline import XRayDiffusionPipeline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("X-Ray fused inference")
+    parser.add_argument("--exp_diffusion", type=str, default="Objaverse_XRay_pretrained", help="experiment name")
+    parser.add_argument("--exp_upsampler", type=str, default="Objaverse_XRay_upsampler", help="experiment name")
+    parser.add_argument("--data_root", type=str, default="Data/Test/images", help="data root")
+    parser.add_argument("--model_id", type=str, default="stabilityai/stable-video-diffusion-img2vid")
+    parser.add_argument("--output_dir", type=str, default=None, help="defaults to Output/<exp_upsampler>/inference")
+    parser.add_argument("--batch_size", type=int, default=8, help="images generated together")
+    parser.add_argument("--num_workers", type=int, default=4, help="dataloader workers decoding the images")
+    parser.add_argument("--max_images", type=int, default=None, help="only the first images of --data_root are generated")
+    parser.add_argument("--save_lr", action="store_true", help="also write the low-res X-Rays and their point clouds")
+    args = parser.parse_args()
+
+    near = 0.6
+    far = 1.8
+    num_frames = 8
+    height_lr, width_lr = 64, 64
+    height, width = 256, 256
+
+    output_dir = args.output_dir or f"Output/{args.exp_upsampler}/inference"
+    os.makedirs(output_dir, exist_ok=True)
+
+    pipe = XRayDiffusionPipeline.from_pretrained(args.model_id, torch_dtype=torch.float16, variant="fp16").to("cuda")
+    ckpt_name = latest_checkpoint(os.path.join("Output", args.exp_diffusion))
+    print("restore from", f"Output/{args.exp_diffusion}/{ckpt_name}/unet")
+    pipe.unet = UNetSpatioTemporalConditionModel.from_pretrained(
+        f"Output/{args.exp_diffusion}/{ckpt_name}", subfolder="unet", torch_dtype=torch.float16).to("cuda")
+
+    vae_image = AutoencoderKL.from_pretrained("madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16).cuda()
+    ckpt_name = latest_checkpoint(os.path.join("Output", args.exp_upsampler))
+    print("restore from", f"Output/{args.exp_upsampler}/{ckpt_name}/vae")
+    vae = AutoencoderKLTemporalDecoder.from_pretrained(f"Output/{args.exp_upsampler}/{ckpt_name}", subfolder="vae").cuda()
+
+    image_paths = sorted(glob.glob(os.path.join(args.data_root, "*.png")))[:args.max_images]
+    # both stages take the condition image at 512 x 512
+    assert width_lr * 8 == width * 2 and height_lr * 8 == height * 2
+    dataset = ConditionImageDataset(image_paths, width_lr * 8)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate_images)
+    writer = BackgroundWriter("inference-writer")
+
+    for batch in tqdm(dataloader):
+        if len(batch["image"]) == 0:
+            continue
+        images = [image.convert("RGB") for image in batch["image"]]
+        with torch.no_grad():
+            xray_lr = pipe(images,
+                           height=height_lr,
+                           width=width_lr,
+                           num_frames=num_frames,
+                           decode_chunk_size=8,
+                           motion_bucket_id=127,
+                           fps=7,
+                           noise_aug_strength=0.0,
+                           output_type="latent").frames
+            xray_lr = xray_lr.clamp(-1, 1)  # [B, 8, 8, 64, 64]
+
+            conditional_pixel_values = torch.stack([torchvision.transforms.functional.to_tensor(image) for image in images])
+            conditional_pixel_values = (conditional_pixel_values * 2 - 1).half().cuda(non_blocking=True)
+            conditional_latents = vae_image.encode(conditional_pixel_values).latent_dist.mode().float()
+            conditional_latents = conditional_latents.unsqueeze(1).repeat(1, num_frames, 1, 1, 1)
+
+            xray_input = torch.cat([xray_lr.float(), conditional_latents], dim=2).flatten(0, 1)
+            model_pred = vae(xray_input, num_frames=num_frames).sample
+            outputs = model_pred.reshape(-1, num_frames, *model_pred.shape[1:]).clamp(-1, 1)  # [B, 8, 8, 256, 256]
+
+        for uid, image, lr, output in zip(batch["uid"], batch["image"], xray_lr, outputs):
+            prefix = os.path.join(output_dir, uid)
+            if args.save_lr:
+                writer.submit(save_lr_outputs, to_host(lr), None, f"{prefix}_lr", near, far)
+            writer.submit(save_hr_outputs, to_host(output), image, prefix, near, far)
+    writer.close()
@@ -11,6 +11,10 @@ import time
 import json
 import imageio
 from scipy.sparse import csr_matrix
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from src.xray_io import save_xray
 import torchvision
 import torch
 import torch.nn.functional as F
@@ -213,13 +217,7 @@ def process_model(model_path):
 
             # save GenDepths as a npy file
             os.makedirs(os.path.join(xray_dir, uid), exist_ok=True)
-            sparse_matrix = csr_matrix(GenDepths.reshape(16, -1))
-            
-            np.savez_compressed(os.path.join(xray_dir, uid, frame["file_path"][:-4]), 
-                                data=sparse_matrix.data, 
-                                indices=sparse_matrix.indices, 
-                                indptr=sparse_matrix.indptr, 
-                                shape=sparse_matrix.shape)
+            save_xray(os.path.join(xray_dir, uid, frame["file_path"][:-4]), GenDepths, codec=codec)
             # # export mesh
             # pcd = o3d.geometry.PointCloud()
             # pcd.points = o3d.utility.Vector3dVector(points)
@@ -310,6 +308,8 @@ if __name__ == "__main__":
     xray_dir = "/hdd/taohu/Data/Objaverse/Data/Render/Objaverse_XRay/xrays"
     image_height = 256
     image_width = 256
+    # "zlib" keeps the original format, "zstd" / "lz4" decode faster (see scripts/benchmark_codecs.py)
+    codec = "zlib"
 
     model_paths = glob.glob(os.path.join(root_dir, "**/*.glb"), recursive=True)
     random.shuffle(model_paths)
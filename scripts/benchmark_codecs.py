@@ -0,0 +1,131 @@
+"""Compare the X-Ray codecs of `src.xray_io` on a dataset.
+
+For every codec the script re-encodes the X-Rays found under `--data_root` and reports the
+compression ratio against the original zlib files and the encode / decode time per sample.
+Lossless codecs are checked to round trip exactly. For the lossy "quant" codec the script
+reports the maximum depth, normal (in degrees) and colour error over all hits, and the Chamfer
+distance / F-score (`src.metrics`) between the point clouds of the original and decoded X-Rays.
+
+Example:
+    python scripts/benchmark_codecs.py --data_root example/dataset --threads 1 4
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.geometry import xray_to_pcd
+from src.metrics import chamfer_distance_and_f_score
+from src.xray_io import CODECS, LOSSY_CODECS, encode_xray, load_xray
+
+
+def quantization_errors(xray, decoded, threshold):
+    hit = xray[:, 0] > 0
+    cos = np.clip((xray[:, 1:4] * decoded[:, 1:4]).sum(1)[hit], -1, 1)
+    points, _, _ = xray_to_pcd(xray[:, 0:1])
+    decoded_points, _, _ = xray_to_pcd(decoded[:, 0:1])
+    chamfer, f_score = chamfer_distance_and_f_score(points, decoded_points, threshold=threshold)
+    return {
+        "max_depth_error": float(np.abs(xray[:, 0] - decoded[:, 0]).max()),
+        "max_normal_error_deg": float(np.degrees(np.arccos(cos)).max()) if hit.any() else 0.0,
+        "max_color_error": float(np.abs(xray[:, 4:7] - decoded[:, 4:7]).max()),
+        "hits_changed": int(((decoded[:, 0] > 0) != hit).sum()),
+        "chamfer": float(chamfer),
+        "f_score": float(f_score),
+    }
+
+
+def benchmark_codec(xray_paths, xrays, codec, threads, repeats, threshold, **kwargs):
+    original_bytes, encoded_bytes, encode_times = 0, 0, []
+    encoded = []
+    for xray_path, xray in zip(xray_paths, xrays):
+        original_bytes += os.path.getsize(xray_path)
+        start = time.perf_counter()
+        buffer = encode_xray(xray, codec=codec, **kwargs)
+        encode_times.append(time.perf_counter() - start)
+        encoded_bytes += len(buffer)
+        encoded.append(buffer)
+
+    result = {
+        "codec": codec,
+        **kwargs,
+        "ratio": original_bytes / encoded_bytes,
+        "bytes_per_sample": encoded_bytes / len(xrays),
+        "encode_ms": 1000 * float(np.mean(encode_times)),
+        "decode_ms": {},
+    }
+    for num_threads in threads:
+        decode_times = []
+        for _ in range(repeats):
+            for xray, buffer in zip(xrays, encoded):
+                start = time.perf_counter()
+                decoded = load_xray(io.BytesIO(buffer), num_threads=num_threads)
+                decode_times.append(time.perf_counter() - start)
+                if codec not in LOSSY_CODECS and not np.array_equal(decoded, xray):
+                    raise RuntimeError(f"{codec} round trip is not lossless")
+        result["decode_ms"][num_threads] = 1000 * float(np.mean(decode_times))
+
+    if codec in LOSSY_CODECS:
+        errors = [quantization_errors(xray, load_xray(io.BytesIO(buffer)), threshold) for xray, buffer in zip(xrays, encoded)]
+        for key in errors[0]:
+            values = [e[key] for e in errors]
+            result[key] = min(values) if key == "f_score" else (sum(values) if key == "hits_changed" else max(values))
+        result["mean_chamfer"] = float(np.mean([e["chamfer"] for e in errors]))
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark X-Ray codecs")
+    parser.add_argument("--data_root", type=str, default="example/dataset")
+    parser.add_argument("--codecs", type=str, nargs="+", default=CODECS, choices=CODECS)
+    parser.add_argument("--level", type=int, default=None, help="compression level passed to zstd / lz4")
+    parser.add_argument("--normal_bits", type=int, nargs="+", default=[8, 16], choices=[8, 16], help="normal precisions of the quant codec")
+    parser.add_argument("--near", type=float, default=0.6, help="depth range of the quant codec")
+    parser.add_argument("--far", type=float, default=1.8, help="depth range of the quant codec")
+    parser.add_argument("--threshold", type=float, default=0.01, help="F-score threshold for the quant codec")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4], help="decode thread counts to time")
+    parser.add_argument("--max_samples", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", type=str, default=None, help="optional json file for the results")
+    args = parser.parse_args()
+
+    xray_paths = sorted(glob.glob(os.path.join(args.data_root, "xrays/**/*.npz"), recursive=True))[:args.max_samples]
+    if len(xray_paths) == 0:
+        raise ValueError(f"no X-Rays found under {args.data_root}")
+    xrays = [load_xray(xray_path) for xray_path in xray_paths]
+    print(f"{len(xrays)} samples from {args.data_root}")
+
+    runs = []
+    for codec in args.codecs:
+        if codec == "quant":
+            runs += [(codec, {"depth_range": (args.near, args.far), "normal_bits": bits}) for bits in args.normal_bits]
+        elif codec == "zlib":
+            runs.append((codec, {}))
+        else:
+            runs.append((codec, {"level": args.level}))
+
+    results = []
+    print(f"{'codec':>8} {'ratio':>7} {'MB/sample':>10} {'encode ms':>10} " + " ".join(f"{f'decode ms x{t}':>13}" for t in args.threads))
+    for codec, kwargs in runs:
+        result = benchmark_codec(xray_paths, xrays, codec, args.threads, args.repeats, args.threshold, **kwargs)
+        results.append(result)
+        name = f"{codec}{kwargs['normal_bits']}" if codec == "quant" else codec
+        print(f"{name:>8} {result['ratio']:>7.2f} {result['bytes_per_sample'] / 1e6:>10.3f} {result['encode_ms']:>10.1f} "
+              + " ".join(f"{result['decode_ms'][t]:>13.1f}" for t in args.threads))
+
+    for result in results:
+        if result["codec"] in LOSSY_CODECS:
+            print(f"quant{result['normal_bits']}: max depth error {result['max_depth_error']:.2e}, "
+                  f"max normal error {result['max_normal_error_deg']:.4f} deg, max colour error {result['max_color_error']:.2e}, "
+                  f"hits changed {result['hits_changed']}, Chamfer vs original max {result['chamfer']:.2e} / mean {result['mean_chamfer']:.2e}, "
+                  f"min F-score@{args.threshold} {result['f_score']:.4f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,256 @@
+"""Benchmark the training dataloaders, to size dataloader hosts before launching training.
+
+`DiffusionDataset` / `UpsamplerDataset` (or `ShardDataset` over the same samples) are built over
+`--data_root`, or over a synthetic dataset written with `--synthetic N`, and iterated by a CPU-only
+`DataLoader` for every combination of storage format, `num_workers`, `batch_size`, `pin_memory`
+and `prefetch_factor`. Every configuration reports samples/s, p50 / p99 batch latency, the
+resident memory of the main process and its workers, and the bytes the processes read (Linux,
+from /proc). Results go to `--output` as JSON for regression tracking.
+
+Storage formats: "native" reads `--data_root` as it is, a codec of `src.xray_io` ("zlib",
+"zstd", ...) re-encodes the X-Rays into `--work_dir` first, and "shards" packs them into tar
+shards for `ShardDataset`. The first configuration reading a format warms the page cache, so
+use `--warmup_batches` or repeat the sweep to compare cold against warm reads.
+
+Example:
+    python scripts/benchmark_dataloader.py --data_root example/dataset --dataset upsampler \
+        --formats native zstd shards --num_workers 0 2 4 --batch_size 4 --output dataloader.json
+    python scripts/benchmark_dataloader.py --synthetic 64 --dataset diffusion --height 64
+"""
+import argparse
+import glob
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.dataset import DiffusionDataset, ShardDataset, UpsamplerDataset
+from src.xray_io import CODECS, load_xray, save_xray
+
+DATASETS = {
+    "diffusion": lambda root, args: DiffusionDataset(root, args.height, args.num_frames, near=args.near, far=args.far,
+                                                     phase="all", decode_threads=args.decode_threads),
+    "upsampler": lambda root, args: UpsamplerDataset(root, args.height, args.num_frames, near=args.near, far=args.far,
+                                                     phase="all", decode_threads=args.decode_threads),
+}
+
+
+def write_synthetic(root, num_samples, near, far, seed=0):
+    """Nested discs as X-Ray layers with a matching RGBA condition image, enough to pass the dataset filters."""
+    rng = np.random.default_rng(seed)
+    j, i = np.mgrid[0:256, 0:256]
+    radius = np.hypot(i - 127.5, j - 127.5)
+    for idx in range(num_samples):
+        uid = f"synthetic{idx:06d}"
+        xray = np.zeros((16, 7, 256, 256), dtype=np.float32)
+        outer = rng.uniform(60, 120)
+        for layer in range(rng.integers(2, 7)):
+            hit = radius < outer * (1 - 0.15 * layer)
+            depth = near + (far - near) * (0.3 + 0.1 * layer) + 0.05 * np.cos(radius / 20)
+            normals = np.stack([(i - 127.5) / 256, (j - 127.5) / 256, np.ones_like(radius)])
+            normals /= np.linalg.norm(normals, axis=0, keepdims=True)
+            xray[layer, 0] = np.where(hit, depth, 0)
+            xray[layer, 1:4] = np.where(hit, normals, 0)
+            xray[layer, 4:7] = np.where(hit, rng.uniform(0, 1, (3, 1, 1)), 0)
+        os.makedirs(os.path.join(root, "xrays", uid), exist_ok=True)
+        os.makedirs(os.path.join(root, "images", uid), exist_ok=True)
+        save_xray(os.path.join(root, "xrays", uid, "000.npz"), xray)
+        image = np.zeros((256, 256, 4), dtype=np.uint8)
+        image[..., :3] = rng.integers(0, 256, 3)
+        image[..., 3] = np.where(radius < outer, 255, 0)
+        Image.fromarray(image).resize((512, 512), Image.NEAREST).save(os.path.join(root, "images", uid, "000.png"))
+
+
+def convert(data_root, root, codec):
+    """Copy of `data_root` with the X-Rays re-encoded with `codec`, the images are linked."""
+    xray_paths = glob.glob(os.path.join(data_root, "xrays/**/*.npz"), recursive=True)
+    for xray_path in xray_paths:
+        output_path = os.path.join(root, "xrays", os.path.relpath(xray_path, os.path.join(data_root, "xrays")))
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        save_xray(output_path, load_xray(xray_path), codec=codec)
+    os.symlink(os.path.abspath(os.path.join(data_root, "images")), os.path.join(root, "images"))
+
+
+def pack(data_root, root, samples_per_shard=100):
+    """Tar shards with an index.json in the layout of `scripts/pack_shards.py`."""
+    xray_root = os.path.join(data_root, "xrays")
+    xray_paths = sorted(glob.glob(os.path.join(xray_root, "**/*.npz"), recursive=True))
+    os.makedirs(root, exist_ok=True)
+    shards = []
+    for start in range(0, len(xray_paths), samples_per_shard):
+        name = f"shard-{len(shards):06d}.tar"
+        num_bytes = 0
+        with tarfile.open(os.path.join(root, name), "w") as tar:
+            for xray_path in xray_paths[start:start + samples_per_shard]:
+                key = os.path.splitext(os.path.relpath(xray_path, xray_root))[0]
+                for ext, path in [(".npz", xray_path), (".png", xray_path.replace("xrays", "images").replace(".npz", ".png"))]:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    info = tarfile.TarInfo(key + ext)
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+                    num_bytes += len(data)
+        shards.append({"url": name, "num_samples": len(xray_paths[start:start + samples_per_shard]), "num_bytes": num_bytes})
+    with open(os.path.join(root, "index.json"), "w") as f:
+        json.dump({"phase": "all", "shards": shards}, f, indent=2)
+
+
+def process_stats(pid):
+    """(resident bytes, bytes read through read(), bytes fetched from storage) of a process, None if unavailable."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+        with open(f"/proc/{pid}/io") as f:
+            io_stats = dict(line.split(": ") for line in f.read().splitlines())
+        return rss, int(io_stats["rchar"]), int(io_stats["read_bytes"])
+    except (OSError, StopIteration, KeyError):
+        return None
+
+
+def loader_stats(iterator):
+    """Per-process stats of the main process and the workers of a dataloader iterator."""
+    pids = [os.getpid()] + [worker.pid for worker in getattr(iterator, "_workers", [])]
+    return {pid: process_stats(pid) for pid in pids}
+
+
+def run(dataset, num_workers, batch_size, pin_memory, prefetch_factor, num_batches, warmup_batches):
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=not isinstance(dataset, torch.utils.data.IterableDataset),
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=num_workers > 0,
+        drop_last=True,
+    )
+    iterator = iter(loader)
+
+    def next_batch():
+        nonlocal iterator
+        try:
+            return next(iterator)
+        except StopIteration:
+            # small datasets: keep going over further epochs, the persistent workers stay up
+            iterator = iter(loader)
+            return next(iterator)
+
+    for _ in range(warmup_batches):
+        next_batch()
+    before = loader_stats(iterator)
+    latencies, num_samples = [], 0
+    start = last = time.perf_counter()
+    for _ in range(num_batches):
+        batch = next_batch()
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+        num_samples += len(batch["image_path"])
+    elapsed = time.perf_counter() - start
+    after = loader_stats(iterator)
+    del iterator, loader
+
+    def total(index):
+        if any(after[pid] is None or before.get(pid) is None for pid in after):
+            return None
+        return sum(after[pid][index] - before[pid][index] for pid in after)
+
+    latencies = 1000 * np.array(latencies)
+    return {
+        "samples_per_s": num_samples / elapsed,
+        "batch_ms_p50": float(np.percentile(latencies, 50)),
+        "batch_ms_p99": float(np.percentile(latencies, 99)),
+        "rss_main_mb": after[os.getpid()][0] / 2 ** 20 if after[os.getpid()] is not None else None,
+        "rss_workers_mb": sum(after[pid][0] for pid in after if pid != os.getpid()) / 2 ** 20
+        if all(stats is not None for stats in after.values()) else None,
+        "bytes_read_per_sample": total(1) / num_samples if total(1) is not None else None,
+        "storage_bytes_read_per_sample": total(2) / num_samples if total(2) is not None else None,
+        "num_samples": num_samples,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark the training dataloaders")
+    parser.add_argument("--data_root", type=str, default="example/dataset")
+    parser.add_argument("--synthetic", type=int, default=None, help="benchmark N synthetic samples instead of --data_root")
+    parser.add_argument("--dataset", type=str, default="diffusion", choices=list(DATASETS))
+    parser.add_argument("--formats", type=str, nargs="+", default=["native"], choices=["native", "shards"] + CODECS)
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--pin_memory", type=int, nargs="+", default=[0, 1], choices=[0, 1])
+    parser.add_argument("--prefetch_factor", type=int, nargs="+", default=[2], help="ignored for num_workers 0")
+    parser.add_argument("--num_batches", type=int, default=50)
+    parser.add_argument("--warmup_batches", type=int, default=5)
+    parser.add_argument("--height", type=int, default=64)
+    parser.add_argument("--num_frames", type=int, default=8)
+    parser.add_argument("--near", type=float, default=0.6)
+    parser.add_argument("--far", type=float, default=1.8)
+    parser.add_argument("--decode_threads", type=int, default=1)
+    parser.add_argument("--work_dir", type=str, default=None, help="where converted / synthetic data is written, a temporary directory by default")
+    parser.add_argument("--output", type=str, default=None, help="json file for the results")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="benchmark_dataloader_")
+    data_root = args.data_root
+    if args.synthetic is not None:
+        data_root = os.path.join(work_dir, "synthetic")
+        if not os.path.exists(data_root):
+            write_synthetic(data_root, args.synthetic, args.near, args.far)
+
+    datasets = {}
+    for storage_format in args.formats:
+        root = os.path.join(work_dir, storage_format)
+        if storage_format == "native":
+            datasets[storage_format] = DATASETS[args.dataset](data_root, args)
+            continue
+        if not os.path.exists(root) and storage_format == "shards":
+            pack(data_root, root)
+        elif not os.path.exists(root):
+            convert(data_root, root, storage_format)
+        if storage_format == "shards":
+            datasets[storage_format] = ShardDataset(root, args.height, args.num_frames, near=args.near, far=args.far,
+                                                    type=args.dataset, shuffle_buffer=16, decode_threads=args.decode_threads)
+        else:
+            datasets[storage_format] = DATASETS[args.dataset](root, args)
+
+    configs = []
+    for storage_format, num_workers, batch_size, pin_memory, prefetch_factor in itertools.product(
+            args.formats, args.num_workers, args.batch_size, args.pin_memory, args.prefetch_factor):
+        config = {"format": storage_format, "num_workers": num_workers, "batch_size": batch_size,
+                  "pin_memory": bool(pin_memory), "prefetch_factor": prefetch_factor if num_workers > 0 else None}
+        if config not in configs:
+            configs.append(config)
+
+    print(f"{args.dataset} dataset, {len(datasets[args.formats[0]])} samples at {args.height}x{args.height}, "
+          f"{args.num_batches} batches per configuration, CUDA {'available' if torch.cuda.is_available() else 'not available (pin_memory is a no-op)'}")
+    print(f"{'format':>8} {'workers':>7} {'batch':>5} {'pin':>3} {'prefetch':>8} {'samples/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'RSS MB':>8} {'KB/sample':>9}")
+    results = []
+    for config in configs:
+        result = run(datasets[config["format"]], config["num_workers"], config["batch_size"], config["pin_memory"],
+                     config["prefetch_factor"], args.num_batches, args.warmup_batches)
+        results.append({**config, **result})
+        rss = result["rss_main_mb"] + result["rss_workers_mb"] if result["rss_workers_mb"] is not None else float("nan")
+        kb = result["bytes_read_per_sample"] / 1024 if result["bytes_read_per_sample"] is not None else float("nan")
+        print(f"{config['format']:>8} {config['num_workers']:>7} {config['batch_size']:>5} {int(config['pin_memory']):>3} "
+              f"{str(config['prefetch_factor']):>8} {result['samples_per_s']:>10.1f} {result['batch_ms_p50']:>8.1f} "
+              f"{result['batch_ms_p99']:>8.1f} {rss:>8.0f} {kb:>9.1f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({
+                "args": vars(args),
+                "host": {"platform": platform.platform(), "cpu_count": os.cpu_count(), "torch": torch.__version__,
+                         "cuda": torch.cuda.is_available()},
+                "results": results,
+            }, f, indent=2)
@@ -0,0 +1,110 @@
+"""Benchmark and agreement check of the kNN and image-grid normal consistency losses.
+
+Real X-Rays from `--data_root` are stacked into a batch the way the trainers see them
+(batch * frames, 1, H, W). The script times forward + backward of both losses, compares the
+normals estimated on the pixel grid with the ground-truth normals stored in the X-Rays (and with
+the kNN normals when pytorch3d is installed), and checks that both losses rank increasingly noisy
+depth maps the same way. With `--check` it exits with an error if the grid loss disagrees.
+
+Example:
+    python scripts/benchmark_normal_loss.py --data_root example/dataset --batch_size 2 --check
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.geometry import get_ray_directions, xray_to_pcd
+from src.losses import grid_normal_similarity_loss, grid_pca_normals, knn_points, normal_similarity_loss
+from src.xray_io import load_xray
+
+
+def timeit(fn, depths, steps):
+    for _ in range(2):
+        fn(depths.clone().requires_grad_()).backward()
+    if depths.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn(depths.clone().requires_grad_()).backward()
+    if depths.device.type == "cuda":
+        torch.cuda.synchronize()
+    return 1000 * (time.perf_counter() - start) / steps
+
+
+def rank(values):
+    return torch.tensor(values).argsort().argsort()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark normal consistency losses")
+    parser.add_argument("--data_root", type=str, default="example/dataset")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_frames", type=int, default=8)
+    parser.add_argument("--noise", type=float, nargs="+", default=[0.0, 0.002, 0.005, 0.01, 0.02], help="depth noise levels")
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--check", action="store_true", help="fail if the grid loss does not agree")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    xray_paths = sorted(glob.glob(os.path.join(args.data_root, "xrays/**/*.npz"), recursive=True))[:args.batch_size]
+    xrays = torch.stack([torch.from_numpy(load_xray(xray_path, num_layers=args.num_frames)[:args.num_frames]) for xray_path in xray_paths])
+    xrays = xrays.float().flatten(0, 1).to(device)  # (batch * frames, 7, H, W)
+    depths, gt_normals = xrays[:, 0:1], F.normalize(xrays[:, 1:4], dim=1)
+    hits = (depths > 0).float()
+    height, width = depths.shape[-2:]
+    directions = get_ray_directions(height, width, device=device)
+    num_points = int(hits.sum())
+    print(f"{len(xray_paths)} samples x {args.num_frames} frames, {num_points} hits")
+
+    def grid_loss(d):
+        return grid_normal_similarity_loss(d, hits, directions)
+
+    def knn_loss(d):
+        points, _, _ = xray_to_pcd(d, hits=hits, directions=directions)
+        return normal_similarity_loss(points[None], k=20, k_similarity=10)
+
+    results = {"grid": {"ms": timeit(grid_loss, depths, args.steps)}}
+    if knn_points is not None:
+        results["knn"] = {"ms": timeit(knn_loss, depths, args.steps)}
+    else:
+        print("pytorch3d is not installed, skipping the knn loss")
+    for name, result in results.items():
+        print(f"{name:>5}: {result['ms']:.1f} ms forward + backward")
+
+    # normals: grid PCA vs ground truth (and vs kNN PCA)
+    normals, defined, (frame, y, x) = grid_pca_normals(depths, hits, directions)
+    agreement = (normals * gt_normals.permute(0, 2, 3, 1)[frame, y, x]).sum(-1).abs()[defined]
+    print(f"grid normals vs ground truth: median |cos| {agreement.median():.4f}, |cos| > 0.9 for {(agreement > 0.9).float().mean():.1%}, "
+          f"defined for {defined.float().mean():.1%} of the hits")
+    if knn_points is not None:
+        points, _, _ = xray_to_pcd(depths, hits=hits, directions=directions)
+        neighbours = knn_points(points[None], points[None], K=20, return_nn=True).knn[0]
+        centered = neighbours - neighbours.mean(dim=1, keepdim=True)
+        knn_normals = torch.linalg.eigh(centered.transpose(2, 1) @ centered)[1][:, :, 0]
+        knn_agreement = (normals * knn_normals).sum(-1).abs()[defined]
+        print(f"grid normals vs knn normals: median |cos| {knn_agreement.median():.4f}, |cos| > 0.9 for {(knn_agreement > 0.9).float().mean():.1%}")
+
+    # losses under increasing depth noise
+    generator = torch.Generator(device=device).manual_seed(0)
+    noise = torch.randn(depths.shape, generator=generator, device=device)
+    for name, fn in [("grid", grid_loss), ("knn", knn_loss)]:
+        if name in results:
+            with torch.no_grad():
+                results[name]["noise"] = [fn(depths + sigma * noise * hits).item() for sigma in args.noise]
+            print(f"{name:>5} loss at depth noise {args.noise}: " + ", ".join(f"{v:.4f}" for v in results[name]["noise"]))
+
+    if args.check:
+        grid_noise = results["grid"]["noise"]
+        assert all(a < b for a, b in zip(grid_noise, grid_noise[1:])), "grid loss does not increase with the depth noise"
+        assert agreement.median() > 0.95, "grid normals disagree with the ground-truth normals"
+        if "knn" in results:
+            assert torch.equal(rank(grid_noise), rank(results["knn"]["noise"])), "grid and knn losses rank the noise levels differently"
+            assert knn_agreement.median() > 0.9, "grid normals disagree with the knn normals"
+        print("agreement check passed")
@@ -0,0 +1,56 @@
+"""Benchmark on-the-fly X-Ray rendering, to size the dataloader workers of `--train_meshes`.
+
+For every mesh of `--mesh_dir` (written by `scripts/prepare_meshes.py`) the BVH is built once and
+`--views` random views are cast, reporting the build time, the X-Ray and condition image times
+per view and the samples/s of one worker. A training step consumes `batch_size` samples per GPU,
+so `num_workers * samples/s` has to stay above `batch_size * steps/s`.
+
+Example:
+    python scripts/benchmark_raycast.py --mesh_dir Data/Objaverse_meshes --num_meshes 16 --views 8
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.raycast import RayMeshIntersector, MeshCaster, sample_camera
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark on-the-fly X-Ray rendering")
+    parser.add_argument("--mesh_dir", type=str, required=True)
+    parser.add_argument("--num_meshes", type=int, default=16)
+    parser.add_argument("--views", type=int, default=8)
+    parser.add_argument("--num_frames", type=int, default=8)
+    parser.add_argument("--image_size", type=int, default=512)
+    args = parser.parse_args()
+
+    print(f"intersector: {RayMeshIntersector.__module__}")
+    mesh_paths = sorted(glob.glob(os.path.join(args.mesh_dir, "**/*.npz"), recursive=True))[:args.num_meshes]
+    rng = random.Random(0)
+    build, xray, image, faces, hits = [], [], [], [], []
+    for mesh_path in mesh_paths:
+        start = time.perf_counter()
+        caster = MeshCaster.load(mesh_path)
+        build.append(time.perf_counter() - start)
+        faces.append(len(caster.mesh.faces))
+        for _ in range(args.views):
+            c2w = sample_camera(rng)
+            start = time.perf_counter()
+            xrays = caster.xray(c2w, num_layers=args.num_frames)
+            xray.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            caster.image(c2w, args.image_size)
+            image.append(time.perf_counter() - start)
+            hits.append((xrays[:, 0] > 0).sum())
+
+    per_view = np.mean(xray) + np.mean(image) + np.mean(build) / args.views
+    print(f"{len(mesh_paths)} meshes, {np.mean(faces):.0f} faces and {np.mean(hits):.0f} hits per view on average")
+    print(f"bvh build {np.mean(build) * 1000:.1f} ms, x-ray {np.mean(xray) * 1000:.1f} ms "
+          f"(p99 {np.percentile(xray, 99) * 1000:.1f} ms), image {np.mean(image) * 1000:.1f} ms per view")
+    print(f"{1 / per_view:.1f} samples/s per worker with {args.views} views per mesh")
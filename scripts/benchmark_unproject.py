@@ -0,0 +1,87 @@
+"""Micro-benchmark of the unprojection used by the normal loss of the VAE / upsampler trainers.
+
+Compares the per-step cost of the former `xray_to_pcd_torch` (ray table rebuilt on the host and
+copied to the device on every call) with `src.geometry.xray_to_pcd` using a persistent
+device-resident ray table and a flat masked gather.
+
+Example:
+    python scripts/benchmark_unproject.py --batch_size 1 --num_frames 8 --height 256
+"""
+import argparse
+import math
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.geometry import get_ray_directions, xray_to_pcd
+
+
+def xray_to_pcd_torch_reference(GenDepths, GenHits):
+    # the per-step implementation the trainers used before src.geometry
+    camera_angle_x = 0.8575560450553894
+    image_width = GenDepths.shape[-1]
+    image_height = GenDepths.shape[-2]
+    fx = 0.5 * image_width / math.tan(0.5 * camera_angle_x)
+
+    rays_screen_coords = torch.stack(torch.meshgrid(
+        torch.arange(image_height, dtype=torch.float32),
+        torch.arange(image_width, dtype=torch.float32),
+        indexing="ij",
+    ), -1).reshape(-1, 2)
+    grid = rays_screen_coords.reshape(image_height, image_width, 2)
+    i, j = grid[..., 1], grid[..., 0]
+    directions = torch.stack([(i - image_width / 2.0) / fx, -(j - image_height / 2.0) / fx, -torch.ones_like(i)], -1)
+
+    c2w = torch.eye(4, dtype=torch.float32)
+    rays_d = torch.matmul(directions, c2w[:3, :3].T)
+    rays_d = rays_d / (torch.norm(rays_d, dim=-1, keepdim=True) + 1e-8)
+    rays_o = c2w[:3, 3].expand_as(rays_d)
+    rays_origins = rays_o.unsqueeze(0).expand(GenDepths.shape[0], -1, -1, -1).to(GenDepths.device)
+    ray_directions = rays_d.unsqueeze(0).expand(GenDepths.shape[0], -1, -1, -1).to(GenDepths.device)
+
+    GenDepths = GenDepths.permute(0, 2, 3, 1)
+    valid_index = GenHits.permute(0, 2, 3, 1)[..., 0] > 0
+    return rays_origins[valid_index] + ray_directions[valid_index] * GenDepths[valid_index]
+
+
+def timeit(fn, steps, device):
+    for _ in range(5):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return 1000 * (time.perf_counter() - start) / steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark X-Ray unprojection")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_frames", type=int, default=8)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--hit_ratio", type=float, default=0.2, help="fraction of pixels that are hits")
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shape = (args.batch_size * args.num_frames, 1, args.height, args.height)
+    GenHits = (torch.rand(shape, device=device) < args.hit_ratio).float()
+    GenDepths = (torch.rand(shape, device=device) * 1.2 + 0.6) * GenHits
+
+    ray_directions = get_ray_directions(args.height, args.height, device=device)
+    reference = xray_to_pcd_torch_reference(GenDepths, GenHits)
+    points, _, _ = xray_to_pcd(GenDepths, hits=GenHits, directions=ray_directions)
+    print(f"{len(points)} points, max difference to the reference {(reference - points).abs().max().item():.2e}")
+
+    reference_ms = timeit(lambda: xray_to_pcd_torch_reference(GenDepths, GenHits), args.steps, device)
+    buffered_ms = timeit(lambda: xray_to_pcd(GenDepths, hits=GenHits, directions=ray_directions), args.steps, device)
+    print(f"{args.batch_size}x{args.num_frames}x{args.height}x{args.height} on {device}: "
+          f"reference {reference_ms:.2f} ms/step, device ray table {buffered_ms:.2f} ms/step "
+          f"({reference_ms / buffered_ms:.1f}x, {reference_ms - buffered_ms:.2f} ms saved per step)")
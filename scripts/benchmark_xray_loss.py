@@ -0,0 +1,114 @@
+"""Benchmark of the fused `src.losses.XRayLoss` against the loss block the VAE / upsampler trainers used before.
+
+A random (batch, frames, 8, H, W) prediction and target are pushed through both implementations
+(eager, and compiled with `--compile`); the script checks that the hit, surface and normal terms
+agree and reports forward + backward time and, on CUDA, the peak memory of one loss step.
+
+Example:
+    python scripts/benchmark_xray_loss.py --batch_size 1 --num_frames 8 --height 256 --normal_loss grid --compile
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.geometry import get_ray_directions, xray_to_pcd
+from src.losses import XRayLoss, grid_normal_similarity_loss, knn_points, normal_similarity_loss
+
+
+def reference_loss(model_pred, xray, args, ray_directions):
+    # the loss block of train_vae.py before XRayLoss
+    H = (xray[:, :, -1:] > 0.0).detach().expand(-1, -1, 7, -1, -1)
+    hit_loss = F.binary_cross_entropy_with_logits(model_pred[:, :, -1:], xray[:, :, -1:] * 0.5 + 0.5)
+    surface_loss = F.mse_loss(model_pred[:, :, :-1][H], xray[:, :, :-1][H])
+
+    GenDepths = (model_pred[:, :, 0:1] * 0.5 + 0.5) * (args.far - args.near) + args.near
+    GenHits = (model_pred[:, :, -1:] > 0).float().detach()
+    GenDepths[GenHits == 0] = 0
+    GenDepths[GenDepths <= args.near] = 0
+    GenDepths[GenDepths >= args.far] = 0
+    GenDepths = GenDepths.reshape(-1, 1, args.height, args.height)
+    GenHits = GenHits.reshape(-1, 1, args.height, args.height)
+    if args.normal_loss == "grid":
+        normal_loss = 0.001 * grid_normal_similarity_loss(GenDepths, GenHits, ray_directions)
+    else:
+        Genpts, _, _ = xray_to_pcd(GenDepths, hits=GenHits, directions=ray_directions)
+        normal_loss = 0.001 * normal_similarity_loss(Genpts[None], k=20, k_similarity=10)
+    return hit_loss, surface_loss, normal_loss
+
+
+def step(fn, model_pred, xray):
+    model_pred = model_pred.clone().requires_grad_()
+    losses = fn(model_pred, xray)
+    sum(losses).backward()
+    return losses
+
+
+def measure(fn, model_pred, xray, steps, device):
+    for _ in range(3):
+        step(fn, model_pred, xray)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step(fn, model_pred, xray)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    ms = 1000 * (time.perf_counter() - start) / steps
+    peak_mb = (torch.cuda.max_memory_allocated() - baseline) / 2 ** 20 if device.type == "cuda" else float("nan")
+    return ms, peak_mb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("benchmark the fused X-Ray loss")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_frames", type=int, default=8)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--near", type=float, default=0.6)
+    parser.add_argument("--far", type=float, default=1.8)
+    parser.add_argument("--hit_ratio", type=float, default=0.2, help="fraction of pixels that are hits")
+    parser.add_argument("--normal_loss", type=str, default="knn" if knn_points is not None else "grid", choices=["knn", "grid"])
+    parser.add_argument("--compile", action="store_true", help="also time the compiled loss")
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shape = (args.batch_size, args.num_frames, 8, args.height, args.height)
+    generator = torch.Generator(device=device).manual_seed(0)
+    xray = torch.rand(shape, generator=generator, device=device) * 2 - 1
+    xray[:, :, -1:] = torch.where(torch.rand(xray[:, :, -1:].shape, generator=generator, device=device) < args.hit_ratio, 1.0, -1.0)
+    # a prediction close to the target so that the predicted hits form surfaces
+    model_pred = xray + 0.05 * torch.randn(shape, generator=generator, device=device)
+    model_pred[:, :, -1:] = xray[:, :, -1:] * 4
+
+    ray_directions = get_ray_directions(args.height, args.height, device=device)
+    xray_loss = XRayLoss(args.height, args.height, args.near, args.far, normal_loss=args.normal_loss,
+                         normal_weight=0.001, knn_kwargs={"k": 20, "k_similarity": 10}).to(device)
+    implementations = {
+        "reference": lambda p, x: reference_loss(p, x, args, ray_directions),
+        "fused": xray_loss,
+    }
+    if args.compile:
+        implementations["compiled"] = XRayLoss(args.height, args.height, args.near, args.far, normal_loss=args.normal_loss,
+                                               normal_weight=0.001, knn_kwargs={"k": 20, "k_similarity": 10},
+                                               compile=True).to(device)
+
+    with torch.no_grad():
+        reference = reference_loss(model_pred.clone(), xray, args, ray_directions)
+        for name, fn in implementations.items():
+            if name != "reference":
+                losses = fn(model_pred, xray)
+                difference = max((a - b).abs().item() for a, b in zip(reference, losses))
+                print(f"{name}: max difference of the loss terms to the reference {difference:.2e}")
+
+    print(f"{args.batch_size}x{args.num_frames}x8x{args.height}x{args.height} on {device}, {args.normal_loss} normal loss")
+    for name, fn in implementations.items():
+        ms, peak_mb = measure(fn, model_pred, xray, args.steps, device)
+        print(f"{name:>9}: {ms:.1f} ms forward + backward, peak memory {peak_mb:.1f} MB")
@@ -0,0 +1,49 @@
+"""Record the number of non-empty layers of every X-Ray of a dataset in `<data_root>/manifest.json`.
+
+The counts are read from the occupancy planes only (see `scripts/layer_stats.py`), a view's count
+is the index of its deepest non-empty layer + 1. The training scripts read the manifest with
+`--layer_buckets`, which batches views of similar depth together and trains them with fewer frames.
+
+Example:
+    python scripts/build_manifest.py --data_root Data/Objaverse_XRay --num_workers 16
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+
+import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.dataset import MANIFEST_NAME, count_layers
+
+
+def count(xray_path):
+    try:
+        return count_layers(xray_path)
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("build the layer count manifest of an X-Ray dataset")
+    parser.add_argument("--data_root", type=str, default="example/dataset")
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    xray_paths = sorted(glob.glob(os.path.join(args.data_root, "xrays/**/*.npz"), recursive=True))
+    with multiprocessing.Pool(args.num_workers) as pool:
+        counts = list(tqdm.tqdm(pool.imap(count, xray_paths, chunksize=64), total=len(xray_paths)))
+
+    num_layers = {os.path.relpath(xray_path, args.data_root): n
+                  for xray_path, n in zip(xray_paths, counts) if n is not None}
+    with open(os.path.join(args.data_root, MANIFEST_NAME), "w") as f:
+        json.dump({"num_layers": num_layers}, f)
+
+    hist = {}
+    for n in num_layers.values():
+        hist[n] = hist.get(n, 0) + 1
+    print(f"{len(num_layers)} views ({len(xray_paths) - len(num_layers)} unreadable), non-empty layers: "
+          + ", ".join(f"{k}: {v}" for k, v in sorted(hist.items())))
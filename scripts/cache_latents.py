@@ -0,0 +1,121 @@
+"""Encode a dataset with a trained X-Ray VAE (`train_vae.py`) for latent-space diffusion.
+
+For every X-Ray under `<data_root>/xrays` the posterior mean and standard deviation of the VAE
+latents are written as float16 to `<output_dir>/<same relative path>.npz`. Samples that the
+training datasets reject (image mask and first layer disagree) are skipped. `latent_stats.json`
+records the VAE, the resolutions and the scaling factor (1 / std of the latents) that
+`train_diffusion.py --latent_dir` trains with.
+
+Example:
+    python scripts/cache_latents.py --data_root Data/Objaverse_XRay --xray_vae Output/Objaverse_XRay_vae/checkpoint-100000 \
+        --output_dir Data/Objaverse_XRay/latents --height 256
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKLTemporalDecoder
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.dataset import read_sample
+
+
+class XRayFiles(torch.utils.data.Dataset):
+    def __init__(self, xray_paths, args):
+        self.xray_paths = xray_paths
+        self.args = args
+
+    def __len__(self):
+        return len(self.xray_paths)
+
+    def __getitem__(self, idx):
+        xray_path = self.xray_paths[idx]
+        image_path = xray_path.replace("xrays", "images").replace(".npz", ".png")
+        try:
+            sample = read_sample(xray_path, image_path, self.args.height, self.args.num_frames, self.args.near, self.args.far,
+                                 image_scale=1, upsample_lr=False)
+        except Exception:
+            return None
+        return xray_path, sample["xray"]
+
+
+def collate(samples):
+    samples = [sample for sample in samples if sample is not None]
+    if len(samples) == 0:
+        return [], None
+    return [path for path, _ in samples], torch.stack([xray for _, xray in samples])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("cache X-Ray VAE latents")
+    parser.add_argument("--data_root", type=str, required=True)
+    parser.add_argument("--xray_vae", type=str, required=True, help="checkpoint directory with a `vae` subfolder")
+    parser.add_argument("--output_dir", type=str, default=None, help="defaults to <data_root>/latents")
+    parser.add_argument("--height", type=int, default=256, help="resolution of the encoded X-Rays")
+    parser.add_argument("--num_frames", type=int, default=8)
+    parser.add_argument("--near", type=float, default=0.6)
+    parser.add_argument("--far", type=float, default=1.8)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--overwrite", action="store_true", help="encode samples that are already cached again")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(args.data_root, "latents")
+    xray_root = os.path.join(args.data_root, "xrays")
+    xray_paths = sorted(glob.glob(os.path.join(xray_root, "**/*.npz"), recursive=True))
+    latent_path = lambda xray_path: os.path.join(output_dir, os.path.relpath(xray_path, xray_root))
+    todo = [p for p in xray_paths if args.overwrite or not os.path.exists(latent_path(p))]
+    print(f"{len(xray_paths)} X-Rays, {len(todo)} to encode into {output_dir}")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    vae = AutoencoderKLTemporalDecoder.from_pretrained(args.xray_vae, subfolder="vae").to(device).eval()
+    dataloader = torch.utils.data.DataLoader(XRayFiles(todo, args), batch_size=args.batch_size,
+                                             num_workers=args.num_workers, collate_fn=collate)
+
+    latent_shape = None
+    with torch.no_grad():
+        for paths, xrays in tqdm(dataloader):
+            if len(paths) == 0:
+                continue
+            posterior = vae.encode(xrays.to(device).flatten(0, 1)).latent_dist
+            mean = posterior.mean.reshape(len(paths), args.num_frames, *posterior.mean.shape[1:]).cpu()
+            std = posterior.std.reshape(len(paths), args.num_frames, *posterior.std.shape[1:]).cpu()
+            latent_shape = list(mean.shape[1:])
+            for path, m, s in zip(paths, mean, std):
+                os.makedirs(os.path.dirname(latent_path(path)), exist_ok=True)
+                # write to a temporary file first, so an interrupted run never leaves a truncated cache entry
+                tmp_path = latent_path(path)[:-len(".npz")] + ".tmp.npz"
+                np.savez(tmp_path, mean=m.half().numpy(), std=s.half().numpy())
+                os.replace(tmp_path, latent_path(path))
+
+    # the scaling factor brings the latents to unit variance, like the 0.18215 of the image VAEs
+    cached = glob.glob(os.path.join(output_dir, "**/*.npz"), recursive=True)
+    if len(cached) == 0:
+        raise RuntimeError(f"no latents were written to {output_dir}")
+    total, total_sq, count = 0.0, 0.0, 0
+    for path in cached[:2000]:
+        with np.load(path) as data:
+            mean = data["mean"].astype(np.float64)
+        latent_shape = list(mean.shape)
+        total, total_sq, count = total + mean.sum(), total_sq + (mean ** 2).sum(), count + mean.size
+    std = float(np.sqrt(total_sq / count - (total / count) ** 2))
+
+    stats = {
+        "xray_vae": os.path.abspath(args.xray_vae),
+        "height": args.height,
+        "num_frames": args.num_frames,
+        "near": args.near,
+        "far": args.far,
+        "latent_channels": latent_shape[1],
+        "latent_size": latent_shape[2],
+        "scaling_factor": 1.0 / std,
+        "num_samples": len(cached),
+    }
+    with open(os.path.join(output_dir, "latent_stats.json"), "w") as f:
+        json.dump(stats, f, indent=2)
+    print(json.dumps(stats, indent=2))
@@ -0,0 +1,62 @@
+"""Check `LayerBucketBatchSampler` with a simulated multi-process split.
+
+One sampler per process index is iterated over a few epochs, as the trainers do on every rank, and
+for every step the batches of all processes are checked to be full and to come from one bucket.
+Without `--drop_last`, every sample is checked to be seen each epoch.
+
+Example:
+    python scripts/check_layer_buckets.py
+    python scripts/check_layer_buckets.py --num_processes 3 --batch_size 2 --drop_last
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.dataset import LayerBucketBatchSampler
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_split(sample_num_frames, batch_size, num_processes, drop_last, epochs):
+    samplers = [LayerBucketBatchSampler(sample_num_frames, batch_size, drop_last=drop_last, seed=0,
+                                        num_processes=num_processes, process_index=rank)
+                for rank in range(num_processes)]
+    lengths = {len(sampler) for sampler in samplers}
+    check(len(lengths) == 1, f"the processes have different lengths {lengths}")
+    for epoch in range(epochs):
+        batches = [list(sampler) for sampler in samplers]
+        check(all(len(rank_batches) == len(samplers[0]) for rank_batches in batches),
+              f"epoch {epoch}: the number of batches differs from len() on some process")
+        seen = set()
+        for step, step_batches in enumerate(zip(*batches)):
+            frames = {sample_num_frames[idx] for batch in step_batches for idx in batch}
+            check(len(frames) == 1, f"epoch {epoch}, step {step}: the batches {step_batches} mix frame counts {frames}")
+            check(all(len(batch) == batch_size for batch in step_batches),
+                  f"epoch {epoch}, step {step}: short batch in {step_batches}")
+            seen.update(idx for batch in step_batches for idx in batch)
+        if not drop_last:
+            check(len(seen) == len(sample_num_frames),
+                  f"epoch {epoch}: {len(seen)} of {len(sample_num_frames)} samples were seen")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("check the layer bucket batch sampler across processes")
+    parser.add_argument("--num_processes", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--drop_last", action="store_true")
+    parser.add_argument("--epochs", type=int, default=3)
+    args = parser.parse_args()
+
+    cases = {
+        "2x5 + 4x7 + 8x9": [2] * 5 + [4] * 7 + [8] * 9,
+        "one bucket": [8] * 13,
+        "bucket smaller than a batch": [2] * 1 + [8] * 30,
+        "interleaved": [(2, 4, 8)[i % 3] for i in range(50)],
+    }
+    for name, sample_num_frames in cases.items():
+        check_split(sample_num_frames, args.batch_size, args.num_processes, args.drop_last, args.epochs)
+        print(f"{name}: ok")
@@ -4,11 +4,15 @@ import imageio
 import numpy as np
 from PIL import Image
 import random
-from scipy.sparse import csr_matrix
 import torch
 import torch.nn.functional as F
 import open3d as o3d
 import torchvision
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.geometry import xray_to_pcd
+from src.xray_io import load_xray
 import shutil
 import trimesh
 
@@ -51,65 +55,6 @@ def create_arrow(start, end, shaft_diameter=0.0005, head_diameter=0.01, head_len
     return arrow_mesh
 
 
-def get_rays(directions, c2w):
-    # Rotate ray directions from camera coordinate to the world coordinate
-    rays_d = directions @ c2w[:3, :3].T # (H, W, 3)
-    rays_d = rays_d / (np.linalg.norm(rays_d, axis=-1, keepdims=True) + 1e-8)
-    
-    # The origin of all rays is the camera origin in world coordinate
-    rays_o = np.broadcast_to(c2w[:3, 3], rays_d.shape) # (H, W, 3)
-
-    return rays_o, rays_d
- 
-
-def xray_to_pcd(GenDepths, GenNormals, GenColors):
-    camera_angle_x = 0.8575560450553894
-    image_width = GenDepths.shape[-1]
-    image_height = GenDepths.shape[-2]
-    fx = 0.5 * image_width / np.tan(0.5 * camera_angle_x)
-
-    rays_screen_coords = np.mgrid[0:image_height, 0:image_width].reshape(
-            2, image_height * image_width).T  # [h, w, 2]
-
-    grid = rays_screen_coords.reshape(image_height, image_width, 2)
-
-    cx = image_width / 2.0
-    cy = image_height / 2.0
-
-    i, j = grid[..., 1], grid[..., 0]
-
-    directions = np.stack([(i-cx)/fx, -(j-cy)/fx, -np.ones_like(i)], -1) # (H, W, 3)
-
-    c2w = np.eye(4).astype(np.float32)
-
-    rays_origins, ray_directions = get_rays(directions, c2w)
-    rays_origins = rays_origins[None].repeat(GenDepths.shape[0], 0)
-    ray_directions = ray_directions[None].repeat(GenDepths.shape[0], 0)
-
-    GenDepths = GenDepths.transpose(0, 2, 3, 1)
-    GenNormals = GenNormals.transpose(0, 2, 3, 1)
-    GenColors = GenColors.transpose(0, 2, 3, 1)
-    
-    valid_index = GenDepths[..., 0] > 0
-    rays_origins = rays_origins[valid_index]
-    ray_directions = ray_directions[valid_index]
-    GenDepths = GenDepths[valid_index]
-    normals = GenNormals[valid_index]
-    colors = GenColors[valid_index]
-    xyz = rays_origins + ray_directions * GenDepths
-
-    return xyz, normals, colors
-
-
-def load_xray( xray_path):
-	loaded_data = np.load(xray_path)
-
-	loaded_sparse_matrix = csr_matrix((loaded_data['data'], loaded_data['indices'], loaded_data['indptr']), shape=loaded_data['shape'])
-
-	original_shape = (16, 7, 256, 256)
-	restored_array = loaded_sparse_matrix.toarray().reshape(original_shape)
-	return restored_array
-
 instance_data_root = "/hdd/taohu/Data/Objaverse/Data/Render/Objaverse_XRay"
 obj_paths = glob.glob(os.path.join("/hdd/taohu/Data/Objaverse/Data/hf-objaverse-v1/glbs", "**/*.glb"), recursive=True)
 
@@ -177,8 +122,10 @@ for xray_path in xray_paths[::10]:
     shutil.rmtree("logs/parts")
     os.makedirs("logs/parts", exist_ok=True)
     
+    # unproject all layers at once and split the points by layer
+    all_pts, all_normals, all_colors, layer_index = xray_to_pcd(GenDepths, GenNormals, GenColors, return_batch_index=True)
     for i in range(16):
-        gen_pts, gen_normals, gen_colors = xray_to_pcd(GenDepths[i:i+1], GenNormals[i:i+1], GenColors[i:i+1])
+        gen_pts, gen_normals, gen_colors = all_pts[layer_index == i], all_normals[layer_index == i], all_colors[layer_index == i]
         if len(gen_pts) == 0:
             continue
         pcd = o3d.geometry.PointCloud()
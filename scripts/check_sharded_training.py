@@ -0,0 +1,182 @@
+"""Offline end-to-end check of `train_diffusion.py` on the CPU, plain and under DeepSpeed ZeRO-2 / ZeRO-3.
+
+A tiny stand-in for `stabilityai/stable-video-diffusion-img2vid` (CLIP image encoder, image VAE,
+scheduler and feature extractor built from configs, nothing is downloaded) is written to
+`<work_dir>/pretrained`, and the small unet of `src/xray_unet_small.json` is trained on the example
+dataset with it. Every mode trains a few steps with a checkpoint, resumes from that checkpoint for
+a few more, and checks what the run left behind:
+
+- the checkpoints are complete and hold a loadable `unet` (the consolidated one of
+  `save_consolidated` under DeepSpeed) and the EMA weights,
+- the resumed run continued from the checkpoint step,
+- the final pipeline was saved,
+- under DeepSpeed, `scripts/export_unet.py` rebuilds the unet from the sharded states, and under
+  ZeRO-2 its fp32 weights equal the consolidated ones.
+
+DeepSpeed runs single-process on the CPU accelerator (gloo), the modes are skipped when DeepSpeed
+is not installed. Every run is `accelerate launch`ed, its output goes to `<work_dir>/<mode>.log`.
+
+Example:
+    python scripts/check_sharded_training.py
+    python scripts/check_sharded_training.py --modes zero3 --work_dir /tmp/xray_check --keep
+"""
+import argparse
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import torch
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from diffusers import AutoencoderKLTemporalDecoder, EulerDiscreteScheduler, UNetSpatioTemporalConditionModel
+from transformers import CLIPImageProcessor, CLIPVisionConfig, CLIPVisionModelWithProjection
+
+from src.checkpoint import is_complete, list_checkpoints
+from src.xray_pipeline import XRayDiffusionPipeline
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UNET_CONFIG = os.path.join(ROOT, "src", "xray_unet_small.json")
+ACCELERATE_CONFIGS = {
+    "plain": "cpu.yaml",
+    "zero2": "zero2.yaml",
+    "zero3": "zero3.yaml",
+}
+
+
+def build_pretrained(path):
+    """Write a tiny pipeline with the layout and variant of the SVD checkpoint the trainer loads."""
+    torch.manual_seed(0)
+    unet_config = UNetSpatioTemporalConditionModel.load_config(UNET_CONFIG)
+    image_encoder = CLIPVisionModelWithProjection(CLIPVisionConfig(
+        hidden_size=32, intermediate_size=64, num_hidden_layers=1, num_attention_heads=2, image_size=224, patch_size=32,
+        projection_dim=unet_config["cross_attention_dim"]))
+    # four blocks, the 8x downsampling of the SVD VAE, and 4 latent channels
+    vae = AutoencoderKLTemporalDecoder(block_out_channels=(32, 32, 32, 32), layers_per_block=1, latent_channels=4)
+    scheduler = EulerDiscreteScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+                                       prediction_type="v_prediction", timestep_spacing="leading",
+                                       use_karras_sigmas=True, interpolation_type="linear", steps_offset=1)
+    feature_extractor = CLIPImageProcessor(crop_size=224, size={"shortest_edge": 224})
+    unet = UNetSpatioTemporalConditionModel.from_config(unet_config)
+    pipeline = XRayDiffusionPipeline(vae=vae, image_encoder=image_encoder, unet=unet, scheduler=scheduler,
+                                     feature_extractor=feature_extractor)
+    pipeline.save_pretrained(path, variant="fp16")
+
+
+def accelerate_config(mode, work_dir):
+    """The repo's accelerate config of `mode`, reduced to one CPU process in full precision."""
+    with open(os.path.join(ROOT, "configs", "accelerate", ACCELERATE_CONFIGS[mode]), "r") as f:
+        config = yaml.safe_load(f)
+    config.update(num_processes=1, use_cpu=True, mixed_precision="no")
+    path = os.path.join(work_dir, f"{mode}.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def run(command, log, env):
+    log.write("$ " + " ".join(command) + "\n")
+    log.flush()
+    result = subprocess.run(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        raise RuntimeError(f"`{' '.join(command[:4])} ...` failed with exit code {result.returncode}, see {log.name}")
+
+
+def train(mode, pretrained, output_dir, max_train_steps, log, env, resume=False):
+    command = [
+        sys.executable, "-m", "accelerate.commands.launch", "--config_file", accelerate_config(mode, os.path.dirname(output_dir)),
+        "train_diffusion.py",
+        f"--pretrained_model_name_or_path={pretrained}",
+        f"--unet_config={UNET_CONFIG}",
+        "--data_root=example/dataset",
+        f"--output_dir={output_dir}",
+        "--per_gpu_batch_size=1", "--gradient_accumulation_steps=1",
+        f"--max_train_steps={max_train_steps}",
+        "--width=64", "--height=64", "--num_frames=8",
+        "--checkpointing_steps=2",
+        "--learning_rate=1e-4", "--lr_warmup_steps=0",
+        "--seed=1243",
+        "--num_workers=0",
+        "--validation_steps=1000000",
+        "--num_validation_images=1",
+        "--use_ema", "--ema_update_every=2",
+        "--near=0.6", "--far=1.8",
+    ]
+    if resume:
+        command.append("--resume_from_checkpoint=latest")
+    run(command, log, env)
+
+
+def check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_mode(mode, pretrained, work_dir, env):
+    output_dir = os.path.join(work_dir, mode)
+    with open(os.path.join(work_dir, f"{mode}.log"), "w") as log:
+        train(mode, pretrained, output_dir, 2, log, env)
+        train(mode, pretrained, output_dir, 4, log, env, resume=True)
+
+        checkpoints = list_checkpoints(output_dir)
+        check(checkpoints == ["checkpoint-2", "checkpoint-4"], f"expected checkpoints 2 and 4, found {checkpoints}")
+        for name in checkpoints:
+            checkpoint = os.path.join(output_dir, name)
+            check(is_complete(checkpoint), f"{checkpoint} is not marked complete")
+            unet = UNetSpatioTemporalConditionModel.from_pretrained(checkpoint, subfolder="unet")
+            check(all(torch.isfinite(p).all() for p in unet.parameters()), f"{checkpoint}/unet has non-finite weights")
+            check(os.path.isdir(os.path.join(checkpoint, "unet_ema")), f"{checkpoint} has no unet_ema")
+        with open(log.name, "r") as f:
+            check("Resuming from checkpoint checkpoint-2" in f.read(), "the second run did not resume from checkpoint-2")
+        check(os.path.exists(os.path.join(output_dir, "model_index.json")), "the final pipeline was not saved")
+        check(not os.path.exists(os.path.join(output_dir, "unet_consolidated")), "unet_consolidated was not removed")
+
+        if mode != "plain":
+            checkpoint = os.path.join(output_dir, "checkpoint-4")
+            export_dir = os.path.join(work_dir, f"{mode}_export")
+            run([sys.executable, "scripts/export_unet.py", "--checkpoint", checkpoint, "--output_dir", export_dir], log, env)
+            exported = UNetSpatioTemporalConditionModel.from_pretrained(export_dir, subfolder="unet")
+            consolidated = UNetSpatioTemporalConditionModel.from_pretrained(checkpoint, subfolder="unet")
+            if mode == "zero2":
+                # both are the fp32 weights, ZeRO-3 consolidates in 16-bit only with a 16-bit model
+                for (name, a), b in zip(exported.state_dict().items(), consolidated.state_dict().values()):
+                    check(torch.equal(a, b), f"exported and consolidated `{name}` differ")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("check train_diffusion.py end to end on the CPU")
+    parser.add_argument("--modes", nargs="+", default=list(ACCELERATE_CONFIGS), choices=list(ACCELERATE_CONFIGS))
+    parser.add_argument("--work_dir", type=str, default=None, help="defaults to a temporary directory")
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="xray_check_")
+    os.makedirs(work_dir, exist_ok=True)
+    # LOCAL_SIZE is the device count of the DeepSpeed CPU accelerator (set by the deepspeed launcher, numactl
+    # is asked otherwise). The checkpoints are the check's own; DeepSpeed pickles its loss scaler into them,
+    # which torch>=2.6 refuses to load by default.
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES="", DS_ACCELERATOR="cpu", LOCAL_SIZE="1", HF_HUB_OFFLINE="1",
+               TRANSFORMERS_OFFLINE="1", WANDB_MODE="disabled", TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD="1")
+    pretrained = os.path.join(work_dir, "pretrained")
+    build_pretrained(pretrained)
+
+    failed = []
+    for mode in args.modes:
+        if mode != "plain" and importlib.util.find_spec("deepspeed") is None:
+            print(f"{mode}: skipped, DeepSpeed is not installed")
+            continue
+        try:
+            check_mode(mode, pretrained, work_dir, env)
+            print(f"{mode}: ok")
+        except Exception as e:
+            failed.append(mode)
+            print(f"{mode}: FAILED, {e}")
+
+    if args.keep or failed:
+        print(f"work directory: {work_dir}")
+    else:
+        shutil.rmtree(work_dir)
+    sys.exit(1 if failed else 0)
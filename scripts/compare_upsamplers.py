@@ -0,0 +1,92 @@
+"""Compare upsampler checkpoints, e.g. patch-trained (`train_upsampler.py --patch_size`) against full-frame.
+
+Every checkpoint upsamples the same ground-truth low-resolution X-Rays of the validation split at
+full resolution, so the comparison isolates the upsampler from the diffusion stage. The script
+reports the mean Chamfer distance and F-score (`src.metrics`) between the point clouds of the
+upsampled and the ground-truth high-resolution X-Rays, with the same post-processing as
+`evaluate_upsampler.py`.
+
+Example:
+    python scripts/compare_upsamplers.py --data_root Data/Objaverse_XRay \
+        --checkpoints Output/upsampler_full/checkpoint-50000 Output/upsampler_patch128/checkpoint-50000
+"""
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+import torchvision
+from diffusers import AutoencoderKL
+from PIL import Image
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.dataset import UpsamplerDataset
+from src.geometry import xray_to_pcd
+from src.metrics import chamfer_distance_and_f_score
+from src.xray_decoder import AutoencoderKLTemporalDecoder
+
+
+def xray_to_points(xray, near, far):
+    """Point cloud of a (frames, 8, H, W) X-Ray in the normalized training layout, centred at the origin."""
+    xray = xray.clamp(-1, 1)
+    depths = (xray[:, 0:1] * 0.5 + 0.5) * (far - near) + near
+    hits = xray[:, 7:8] > 0
+    depths = torch.where(hits & (depths > near) & (depths < far), depths, torch.zeros_like(depths)).cpu().numpy()
+    # a layer can not be in front of the previous one
+    depths[1:] = np.where(depths[1:] < depths[:-1], 0, depths[1:])
+    points, _, _ = xray_to_pcd(depths)
+    return points - points.mean(axis=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("compare upsampler checkpoints")
+    parser.add_argument("--data_root", type=str, required=True)
+    parser.add_argument("--checkpoints", type=str, nargs="+", required=True, help="checkpoint directories with a `vae` subfolder")
+    parser.add_argument("--num_samples", type=int, default=100)
+    parser.add_argument("--num_frames", type=int, default=8)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--near", type=float, default=0.6)
+    parser.add_argument("--far", type=float, default=1.8)
+    parser.add_argument("--threshold", type=float, default=0.01, help="F-score threshold")
+    parser.add_argument("--output", type=str, default=None, help="optional json file for the results")
+    args = parser.parse_args()
+
+    dataset = UpsamplerDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="val")
+    num_samples = min(args.num_samples, len(dataset))
+    vae_image = AutoencoderKL.from_pretrained("madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16).cuda()
+
+    results = {}
+    for checkpoint in args.checkpoints:
+        vae = AutoencoderKLTemporalDecoder.from_pretrained(checkpoint, subfolder="vae").cuda().eval()
+        chamfer, f_score = [], []
+        for idx in tqdm(range(num_samples), desc=checkpoint):
+            sample = dataset[idx]
+            with torch.no_grad():
+                xray_lr = sample["xray_lr"].cuda()[None]
+                image = Image.open(sample["image_path"]).convert("RGB").resize((args.height * 2, args.height * 2), Image.BILINEAR)
+                conditional_pixel_values = (torchvision.transforms.ToTensor()(image).unsqueeze(0) * 2 - 1).half().cuda()
+                conditional_latents = vae_image.encode(conditional_pixel_values).latent_dist.mode().float()
+                conditional_latents = conditional_latents.unsqueeze(1).repeat(1, xray_lr.shape[1], 1, 1, 1)
+                xray_input = torch.cat([xray_lr, conditional_latents], dim=2).flatten(0, 1)
+                outputs = vae(xray_input, num_frames=args.num_frames).sample
+
+            gen_pts = xray_to_points(outputs, args.near, args.far)
+            gt_pts = xray_to_points(sample["xray"], args.near, args.far)
+            cd, fs = chamfer_distance_and_f_score(gt_pts, gen_pts, threshold=args.threshold)
+            chamfer.append(cd)
+            f_score.append(fs)
+        results[checkpoint] = {"chamfer": float(np.mean(chamfer)), "f_score": float(np.mean(f_score)), "num_samples": num_samples}
+        del vae
+        torch.cuda.empty_cache()
+
+    width = max(len(checkpoint) for checkpoint in results)
+    print(f"{'checkpoint':<{width}} {'CD':>10} {f'FS@{args.threshold}':>10}")
+    for checkpoint, result in results.items():
+        print(f"{checkpoint:<{width}} {result['chamfer']:>10.5f} {result['f_score']:>10.4f}")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
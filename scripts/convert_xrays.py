@@ -0,0 +1,48 @@
+"""Re-encode the X-Rays of a dataset with another codec of `src.xray_io`.
+
+The "quant" codec is lossy, run `scripts/benchmark_codecs.py` first to check its error.
+
+Images are not touched, point `--output_root` at a copy of the dataset (or at the dataset
+itself to convert in place).
+
+Example:
+    python scripts/convert_xrays.py --data_root Data/Objaverse_XRay --output_root Data/Objaverse_XRay --codec zstd
+"""
+import argparse
+import glob
+import os
+import sys
+from multiprocessing import Pool
+
+import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.xray_io import CODECS, load_xray, save_xray
+
+
+def convert(xray_path):
+    output_path = os.path.join(args.output_root, os.path.relpath(xray_path, args.data_root))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    xray = load_xray(xray_path)
+    # write next to the target and rename, so converting in place never leaves a truncated file
+    with open(output_path + ".tmp", "wb") as f:
+        save_xray(f, xray, codec=args.codec, level=args.level, depth_range=(args.near, args.far), normal_bits=args.normal_bits)
+    os.replace(output_path + ".tmp", output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("convert X-Ray codec")
+    parser.add_argument("--data_root", type=str, required=True, help="dataset root with xrays/")
+    parser.add_argument("--output_root", type=str, required=True)
+    parser.add_argument("--codec", type=str, default="zstd", choices=CODECS)
+    parser.add_argument("--level", type=int, default=None, help="compression level passed to zstd / lz4")
+    parser.add_argument("--normal_bits", type=int, default=16, choices=[8, 16], help="normal precision of the lossy quant codec")
+    parser.add_argument("--near", type=float, default=0.6, help="depth range of the lossy quant codec")
+    parser.add_argument("--far", type=float, default=1.8, help="depth range of the lossy quant codec")
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    xray_paths = glob.glob(os.path.join(args.data_root, "xrays/**/*.npz"), recursive=True)
+    with Pool(args.num_workers) as p:
+        for _ in tqdm.tqdm(p.imap_unordered(convert, xray_paths), total=len(xray_paths)):
+            pass
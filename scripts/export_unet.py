@@ -0,0 +1,34 @@
+"""Consolidate the sharded DeepSpeed ZeRO states of a `train_diffusion.py` checkpoint into a diffusers unet.
+
+Checkpoints of sharded runs (configs/accelerate/zero2.yaml, zero3.yaml) already carry a
+consolidated `unet` subfolder, in 16-bit under ZeRO-3. This script gathers the fp32 master
+weights from the per-process optimizer shards in `<checkpoint>/pytorch_model` instead, on the CPU
+and without the processes that wrote them, and writes them as `<output_dir>/unet`, loadable with
+`UNetSpatioTemporalConditionModel.from_pretrained(output_dir, subfolder="unet")`.
+
+Example:
+    python scripts/export_unet.py --checkpoint Output/Objaverse_XRay/checkpoint-100000 --output_dir Output/Objaverse_XRay_export
+"""
+import argparse
+import os
+
+from accelerate.utils import MODEL_NAME
+from deepspeed.utils.zero_to_fp32 import get_fp32_state_dict_from_zero_checkpoint
+from diffusers import UNetSpatioTemporalConditionModel
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("export the unet of a sharded training checkpoint")
+    parser.add_argument("--checkpoint", type=str, required=True, help="checkpoint-<step> directory of a DeepSpeed run")
+    parser.add_argument("--output_dir", type=str, required=True)
+    args = parser.parse_args()
+
+    if not os.path.isdir(os.path.join(args.checkpoint, MODEL_NAME)):
+        raise ValueError(f"{args.checkpoint} has no `{MODEL_NAME}` folder, it was not written by a DeepSpeed run")
+
+    state_dict = get_fp32_state_dict_from_zero_checkpoint(args.checkpoint, tag=MODEL_NAME)
+    unet = UNetSpatioTemporalConditionModel.from_config(
+        UNetSpatioTemporalConditionModel.load_config(args.checkpoint, subfolder="unet"))
+    unet.load_state_dict(state_dict)
+    unet.save_pretrained(os.path.join(args.output_dir, "unet"))
+    print(f"wrote {sum(p.numel() for p in unet.parameters()) / 1e6:.1f}M parameters to {os.path.join(args.output_dir, 'unet')}")
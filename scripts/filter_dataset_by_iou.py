@@ -6,15 +6,11 @@ import PIL
 from PIL import Image
 import time
 import random
-from scipy.sparse import csr_matrix
 import shutil
+import sys
 
-def load_xrays( xrays_path):
-	loaded_data = np.load(xrays_path)
-	loaded_sparse_matrix = csr_matrix((loaded_data['data'], loaded_data['indices'], loaded_data['indptr']), shape=loaded_data['shape'])
-	original_shape = (16, 7, 256, 256)
-	restored_array = loaded_sparse_matrix.toarray().reshape(original_shape)
-	return restored_array
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.xray_io import load_occupancy
 
 src_root = "/hdd/taohu/Data/Objaverse/Data/Render/Objaverse_XRay_Raw"
 dst_root = "/hdd/taohu/Data/Objaverse/Data/Render/Objaverse_XRay"
@@ -33,11 +29,12 @@ for xray_path in progress_bar:
             continue
 
         count += 1
-        xrays = load_xrays(xray_path)
+        # only the first layer's hit mask is needed, no need to decode the whole X-Ray
+        occupancy = load_occupancy(xray_path, num_layers=1)
         image_values_pil = Image.open(xray_path.replace("xrays", "images").replace(".npz", ".png"))
         _, _, _, mask = image_values_pil.split()
 
-        xray = (xrays[0, 0] > 0).astype(np.float32)
+        xray = occupancy[0].astype(np.float32)
         mask = (np.array(mask.resize(xray.shape)) / 255 > 0.5).astype(np.float32)
 
         delta = np.abs(xray - mask)
@@ -0,0 +1,60 @@
+"""Per-layer hit statistics of an X-Ray dataset, read from the occupancy planes only.
+
+Reports how many views have k non-empty layers and the mean hit fraction of every layer. With
+`--compare_decode` it also times the same scan through a full `load_xray` decode.
+
+Example:
+    python scripts/layer_stats.py --data_root example/dataset --compare_decode
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.xray_io import load_occupancy, load_xray
+
+
+def scan(xray_paths, read_hits):
+    num_layers_hist = {}
+    hit_fraction = None
+    start = time.perf_counter()
+    for xray_path in tqdm.tqdm(xray_paths, leave=False):
+        hits = read_hits(xray_path)
+        fraction = hits.reshape(hits.shape[0], -1).mean(axis=1)
+        hit_fraction = fraction if hit_fraction is None else hit_fraction + fraction
+        num_layers = int((fraction > 0).sum())
+        num_layers_hist[num_layers] = num_layers_hist.get(num_layers, 0) + 1
+    elapsed = time.perf_counter() - start
+    return dict(sorted(num_layers_hist.items())), (hit_fraction / len(xray_paths)).tolist(), elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("X-Ray layer statistics")
+    parser.add_argument("--data_root", type=str, default="example/dataset")
+    parser.add_argument("--compare_decode", action="store_true", help="also time a full decode of every X-Ray")
+    parser.add_argument("--output", type=str, default=None, help="optional json file for the statistics")
+    args = parser.parse_args()
+
+    xray_paths = sorted(glob.glob(os.path.join(args.data_root, "xrays/**/*.npz"), recursive=True))
+    num_layers_hist, hit_fraction, elapsed = scan(xray_paths, load_occupancy)
+
+    print(f"{len(xray_paths)} views, occupancy scan {1000 * elapsed / len(xray_paths):.2f} ms/view")
+    print("non-empty layers: " + ", ".join(f"{k}: {v}" for k, v in num_layers_hist.items()))
+    print("hit fraction per layer: " + " ".join(f"{f:.4f}" for f in hit_fraction))
+
+    stats = {"num_views": len(xray_paths), "num_layers_hist": num_layers_hist, "hit_fraction": hit_fraction,
+             "occupancy_ms": 1000 * elapsed / len(xray_paths)}
+    if args.compare_decode:
+        _, _, decode_elapsed = scan(xray_paths, lambda xray_path: load_xray(xray_path)[:, 0] > 0)
+        stats["decode_ms"] = 1000 * decode_elapsed / len(xray_paths)
+        print(f"full decode scan {stats['decode_ms']:.2f} ms/view ({decode_elapsed / elapsed:.1f}x slower)")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(stats, f, indent=2)
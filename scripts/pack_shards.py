@@ -0,0 +1,87 @@
+"""Pack an X-Ray dataset (`xrays/` + `images/`) into tar shards for `src.dataset.ShardDataset`.
+
+Every sample is stored as two consecutive tar members sharing a key, `<uid>/<view>.npz` and
+`<uid>/<view>.png`, so the shards can be streamed sequentially. An `index.json` next to the
+shards records the sample count of every shard.
+
+Example:
+    python scripts/pack_shards.py --data_root Data/Objaverse_XRay --output_dir Data/Objaverse_XRay_shards/train --phase train
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+import time
+
+import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.dataset import split_xray_paths
+
+
+def add_file(tar, name, path):
+    with open(path, "rb") as f:
+        data = f.read()
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(data))
+    return len(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("pack X-Ray shards")
+    parser.add_argument("--data_root", type=str, required=True, help="dataset root with xrays/ and images/")
+    parser.add_argument("--output_dir", type=str, required=True, help="where the shards and index.json are written")
+    parser.add_argument("--phase", type=str, default="all", choices=["train", "val", "all"])
+    parser.add_argument("--split_stride", type=int, default=10,
+                        help="every n-th sample (in sorted order) is held out for validation, as by the datasets of the "
+                             "trainers; their validation views (every 20th / 30th) are held out with a divisor of those")
+    parser.add_argument("--samples_per_shard", type=int, default=1000)
+    parser.add_argument("--max_shard_size", type=float, default=2.0, help="maximum shard size in GB")
+    parser.add_argument("--seed", type=int, default=0, help="samples are shuffled before packing")
+    args = parser.parse_args()
+
+    xray_paths = glob.glob(os.path.join(args.data_root, "xrays/**/*.npz"), recursive=True)
+    xray_paths = split_xray_paths(xray_paths, args.phase, args.split_stride)
+    # the shuffle buffer at training time is bounded, so shuffle globally once here
+    random.Random(args.seed).shuffle(xray_paths)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    xray_root = os.path.join(args.data_root, "xrays")
+    max_shard_bytes = int(args.max_shard_size * 1024 ** 3)
+
+    shards = []
+    tar, shard_name, shard_samples, shard_bytes = None, None, 0, 0
+
+    def close_shard():
+        if tar is not None:
+            tar.close()
+            os.replace(os.path.join(args.output_dir, shard_name + ".tmp"), os.path.join(args.output_dir, shard_name))
+            shards.append({"url": shard_name, "num_samples": shard_samples, "num_bytes": shard_bytes})
+
+    for xray_path in tqdm.tqdm(xray_paths):
+        image_path = xray_path.replace("xrays", "images").replace(".npz", ".png")
+        if not os.path.exists(image_path):
+            continue
+
+        if tar is None or shard_samples >= args.samples_per_shard or shard_bytes >= max_shard_bytes:
+            close_shard()
+            shard_name = f"shard-{len(shards):06d}.tar"
+            tar = tarfile.open(os.path.join(args.output_dir, shard_name + ".tmp"), "w")
+            shard_samples, shard_bytes = 0, 0
+
+        key = os.path.splitext(os.path.relpath(xray_path, xray_root))[0]
+        shard_bytes += add_file(tar, key + ".npz", xray_path)
+        shard_bytes += add_file(tar, key + ".png", image_path)
+        shard_samples += 1
+    close_shard()
+
+    with open(os.path.join(args.output_dir, "index.json"), "w") as f:
+        json.dump({"phase": args.phase, "shards": shards}, f, indent=2)
+
+    print(f"packed {sum(s['num_samples'] for s in shards)} samples into {len(shards)} shards")
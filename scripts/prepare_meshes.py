@@ -0,0 +1,54 @@
+"""Normalize `.glb` models into the mesh pool that `--train_meshes` ray casts training samples from.
+
+Every model is loaded, normalized like `preprocess/get_xray/gen_objaverse.py` does before casting
+(z-up, unit extent, centred, textures baked into face colours) and written as
+`<output_dir>/<uid>.npz` with `vertices`, `faces` and `face_colors`. Models without a texture are
+skipped, as they are by the dataset generation.
+
+Example:
+    python scripts/prepare_meshes.py --glb_dir Data/Objaverse/glbs --output_dir Data/Objaverse_meshes --num_workers 16
+"""
+import argparse
+import functools
+import glob
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import tqdm
+import trimesh
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.raycast import normalize_mesh
+
+
+def prepare(glb_path, output_dir):
+    uid = os.path.splitext(os.path.basename(glb_path))[0]
+    output_path = os.path.join(output_dir, uid + ".npz")
+    if os.path.exists(output_path):
+        return True
+    try:
+        mesh = trimesh.load(glb_path, force="mesh", process=False)
+        if mesh.visual.kind != "texture":
+            return False
+        vertices, faces, face_colors = normalize_mesh(mesh)
+    except Exception:
+        return False
+    np.savez(output_path, vertices=vertices, faces=faces, face_colors=face_colors)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("normalize meshes for on-the-fly X-Ray rendering")
+    parser.add_argument("--glb_dir", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--num_workers", type=int, default=8)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    glb_paths = sorted(glob.glob(os.path.join(args.glb_dir, "**/*.glb"), recursive=True))
+    with multiprocessing.Pool(args.num_workers) as pool:
+        written = list(tqdm.tqdm(pool.imap(functools.partial(prepare, output_dir=args.output_dir), glb_paths, chunksize=4),
+                                 total=len(glb_paths)))
+    print(f"{sum(written)} of {len(glb_paths)} meshes in {args.output_dir}")
@@ -0,0 +1,27 @@
+#/bin/bash
+
+# A few steps of a small unet on the CPU with the example dataset, to check the training loop end to end.
+# scripts/check_sharded_training.py does the same offline, with resuming and under DeepSpeed ZeRO-2 / ZeRO-3.
+export MODEL_NAME="stabilityai/stable-video-diffusion-img2vid"
+export OUTPUT_DIR="Output/smoke_test"
+export INSTANCE_DIR="example/dataset"
+
+accelerate launch --config_file configs/accelerate/cpu.yaml train_diffusion.py \
+    --pretrained_model_name_or_path=${MODEL_NAME} \
+    --unet_config=src/xray_unet_small.json \
+    --data_root=${INSTANCE_DIR} \
+    --output_dir=${OUTPUT_DIR} \
+    --per_gpu_batch_size=1 --gradient_accumulation_steps=1 \
+    --max_train_steps=4 \
+    --width=64 \
+    --height=64 \
+    --num_frames=8 \
+    --checkpointing_steps=2 --checkpoints_total_limit=1 \
+    --learning_rate=1e-4 --lr_warmup_steps=0 \
+    --seed=1243 \
+    --num_workers=0 \
+    --validation_steps=1000000 \
+    --num_validation_images=1 \
+    --use_ema --ema_update_every=2 \
+    --near 0.6 \
+    --far 1.8
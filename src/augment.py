@@ -0,0 +1,114 @@
+import torch
+
+
+class XRayAugmentation:
+    """
+    Random augmentations of training batches, applied on the device after the prefetcher.
+
+    Works on the normalized samples of `xray_to_sample`, `xray` and `xray_lr` of shape
+    (B, frames, 8, H, W) with channels depth, normal xyz, colour rgb and hit, and `image_values`
+    of shape (B, 3, H, W). Every sample of the batch draws its own parameters, the same ones for
+    all of its tensors, so the X-Rays and the condition image stay aligned. All ops are batched
+    elementwise kernels, there is no per-sample loop and no host synchronization.
+
+    - `hflip`: probability of mirroring a sample. The view is mirrored at the camera's yz plane, so
+      the x component of the normals changes sign along with the pixel order, and the x offset of
+      the crop of a patch sample (`random_crop`) moves to the mirrored window.
+    - `depth_scale`: the depths of the hits are scaled by a factor in [1 - depth_scale,
+      1 + depth_scale], i.e. the object is scaled about the camera centre, which leaves its
+      silhouette, normals and condition image unchanged. The factor is clamped per sample so every
+      hit stays within [near, far].
+    - `color`: brightness and saturation jitter of that relative strength, on the colours of the
+      hits and on the condition image. Both are multiplicative, the black background of the
+      condition image stays black; the depth, normal and hit channels are not touched.
+
+    Args:
+        near (float), far (float): the depth range the samples were normalized with.
+    """
+
+    def __init__(self, near, far, hflip=0.0, depth_scale=0.0, color=0.0):
+        self.near = near
+        self.far = far
+        self.hflip = hflip
+        self.depth_scale = depth_scale
+        self.color = color
+
+    @property
+    def enabled(self):
+        return self.hflip > 0 or self.depth_scale > 0 or self.color > 0
+
+    @staticmethod
+    def _expand(values, like):
+        return values.view(-1, *[1] * (like.dim() - 1)).to(like.dtype)
+
+    def _flip(self, values, flip):
+        flipped = values.flip(-1)
+        if values.dim() == 5:
+            flipped[:, :, 1] = -flipped[:, :, 1]
+        return torch.where(flip.view(-1, *[1] * (values.dim() - 1)), flipped, values)
+
+    def _depth_bounds(self, xray):
+        # metric depth range of the hits of every sample, (B,) each
+        hit = xray[:, :, 7] > 0
+        depth = (xray[:, :, 0].float() + 1) / 2 * (self.far - self.near) + self.near
+        nearest = torch.where(hit, depth, torch.full_like(depth, self.far)).flatten(1).amin(1)
+        farthest = torch.where(hit, depth, torch.full_like(depth, self.near)).flatten(1).amax(1)
+        return nearest, farthest
+
+    def _scale_depth(self, xray, scale):
+        depth = (xray[:, :, 0].float() + 1) / 2 * (self.far - self.near) + self.near
+        depth = (depth * scale.view(-1, 1, 1, 1) - self.near) / (self.far - self.near) * 2 - 1
+        xray = xray.clone()
+        xray[:, :, 0] = torch.where(xray[:, :, 7] > 0, depth.to(xray.dtype), xray[:, :, 0])
+        return xray
+
+    @staticmethod
+    def _jitter_colors(colors, brightness, saturation):
+        # colors in [0, 1], channels at dim -3
+        gray = (colors * colors.new_tensor([0.299, 0.587, 0.114]).view(3, 1, 1)).sum(-3, keepdim=True)
+        colors = gray + (colors - gray) * saturation
+        return (colors * brightness).clamp(0, 1)
+
+    def _color(self, values, brightness, saturation):
+        if values.dim() == 4:
+            colors = (values + 1) / 2
+            return self._jitter_colors(colors, self._expand(brightness, colors), self._expand(saturation, colors)) * 2 - 1
+        colors = (values[:, :, 4:7] + 1) / 2
+        colors = self._jitter_colors(colors, self._expand(brightness, colors), self._expand(saturation, colors)) * 2 - 1
+        values = values.clone()
+        values[:, :, 4:7] = torch.where(values[:, :, 7:8] > 0, colors, values[:, :, 4:7])
+        return values
+
+    def __call__(self, batch):
+        """Return an augmented copy of `batch`, the tensors of the input are not modified."""
+        if not self.enabled:
+            return batch
+        batch = dict(batch)
+        xray = batch["xray"]
+        batch_size, device = len(xray), xray.device
+        keys = [key for key in ("xray", "xray_lr", "image_values") if key in batch]
+
+        if self.depth_scale > 0:
+            scale = 1 + (torch.rand(batch_size, device=device) * 2 - 1) * self.depth_scale
+            nearest, farthest = self._depth_bounds(xray)
+            scale = torch.minimum(torch.maximum(scale, self.near / nearest), self.far / farthest)
+            for key in ("xray", "xray_lr"):
+                if key in batch:
+                    batch[key] = self._scale_depth(batch[key], scale)
+
+        if self.color > 0:
+            brightness = 1 + (torch.rand(batch_size, device=device) * 2 - 1) * self.color
+            saturation = 1 + (torch.rand(batch_size, device=device) * 2 - 1) * self.color
+            for key in keys:
+                batch[key] = self._color(batch[key], brightness, saturation)
+
+        if self.hflip > 0:
+            flip = torch.rand(batch_size, device=device) < self.hflip
+            for key in keys:
+                batch[key] = self._flip(batch[key], flip)
+            if batch.get("crop") is not None:
+                frame_size = int(batch["frame_size"][0])
+                crop = batch["crop"].clone()
+                crop[:, 1] = torch.where(flip.to(crop.device), frame_size - crop[:, 1] - xray.shape[-1], crop[:, 1])
+                batch["crop"] = crop
+        return batch
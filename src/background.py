@@ -0,0 +1,90 @@
+import logging
+import queue
+import threading
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def to_host(tensor):
+    """
+    Detached CPU copy of `tensor` for a `BackgroundWriter` job.
+
+    CUDA tensors are copied asynchronously into pinned memory, so taking the snapshot does not wait
+    for the GPU; the writer waits for the copy before running the job it is submitted with.
+    """
+    tensor = tensor.detach()
+    if tensor.device.type != "cuda":
+        return tensor.clone()
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True)
+    return host.copy_(tensor, non_blocking=True)
+
+
+class BackgroundWriter:
+    """
+    Runs file writes (PNGs, point clouds, ...) on a daemon thread so that the training loop does not
+    wait for image encoding and disk I/O. Jobs run in submission order; `flush` blocks until all
+    submitted jobs are done and `close` additionally stops the thread. An exception in a job is
+    logged and does not stop the writer.
+
+    With `max_pending`, `try_submit` drops jobs while that many are queued or running, so artifacts
+    that are only worth having when they are cheap (training sample dumps) never pile up behind a
+    slow disk. `submit` always queues.
+
+    When CUDA is in use, every job waits for the work queued on the current stream at submission,
+    i.e. for the `to_host` copies of its arguments.
+    """
+
+    def __init__(self, name="background-writer", max_pending=None):
+        self.queue = queue.Queue()
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                event, fn, args, kwargs = job
+                if event is not None:
+                    event.synchronize()
+                fn(*args, **kwargs)
+            except Exception:
+                logger.exception("background write failed")
+            finally:
+                self.queue.task_done()
+
+    def _put(self, fn, args, kwargs):
+        if not self.thread.is_alive():
+            raise RuntimeError("the background writer is closed")
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((event, fn, args, kwargs))
+
+    def submit(self, fn, *args, **kwargs):
+        """Run `fn(*args, **kwargs)` on the writer thread. Arguments must not be modified afterwards."""
+        self._put(fn, args, kwargs)
+
+    def try_submit(self, fn, *args, **kwargs):
+        """Like `submit`, but drop the job when `max_pending` jobs are pending. Returns whether it was queued."""
+        if self.max_pending is not None and self.queue.unfinished_tasks >= self.max_pending:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logger.warning(f"background writer is behind, dropped {self.dropped} jobs so far")
+            return False
+        self._put(fn, args, kwargs)
+        return True
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,262 @@
+import contextlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import threading
+
+import numpy as np
+import torch
+from accelerate.utils import DistributedType, OPTIMIZER_NAME, RNG_STATE_NAME, SCALER_NAME, SCHEDULER_NAME
+from diffusers.utils import CONFIG_NAME, SAFETENSORS_WEIGHTS_NAME
+from safetensors.torch import save_file
+
+logger = logging.getLogger(__name__)
+
+# written last into every checkpoint directory, a checkpoint without it was interrupted while being written
+COMPLETE_MARKER = "COMPLETE"
+PARTIAL_SUFFIX = ".partial"
+_CHECKPOINT_PATTERN = re.compile(r"^checkpoint-(\d+)$")
+
+
+def _checkpoint_dirs(output_dir):
+    if not os.path.isdir(output_dir):
+        return []
+    dirs = [d for d in os.listdir(output_dir) if _CHECKPOINT_PATTERN.match(d)]
+    return sorted(dirs, key=lambda d: int(d.split("-")[1]))
+
+
+def is_complete(checkpoint_dir):
+    return os.path.exists(os.path.join(checkpoint_dir, COMPLETE_MARKER))
+
+
+def mark_complete(checkpoint_dir):
+    with open(os.path.join(checkpoint_dir, COMPLETE_MARKER), "w") as f:
+        f.write("")
+
+
+def _partial_dirs(output_dir):
+    if not os.path.isdir(output_dir):
+        return []
+    return [d for d in os.listdir(output_dir) if d.endswith(PARTIAL_SUFFIX) and d.startswith("checkpoint-")]
+
+
+def list_checkpoints(output_dir):
+    """
+    Names of the complete `checkpoint-<step>` directories in `output_dir`, oldest first.
+
+    Checkpoints are complete when they carry the completion marker. Runs from before the marker
+    existed have none at all, their checkpoints are all taken as complete, unless a `.partial`
+    directory shows that the run already writes markers.
+    """
+    dirs = _checkpoint_dirs(output_dir)
+    complete = [d for d in dirs if is_complete(os.path.join(output_dir, d))]
+    if len(complete) > 0 or len(_partial_dirs(output_dir)) > 0:
+        return complete
+    return dirs
+
+
+def latest_checkpoint(output_dir):
+    """Name of the most recent complete checkpoint in `output_dir`, or None."""
+    checkpoints = list_checkpoints(output_dir)
+    return checkpoints[-1] if len(checkpoints) > 0 else None
+
+
+def rotate_checkpoints(output_dir, total_limit):
+    """
+    Remove the leftovers of interrupted writes, then the oldest complete checkpoints so that at most
+    `total_limit` remain.
+    """
+    checkpoints = list_checkpoints(output_dir)
+    removing = [d for d in _checkpoint_dirs(output_dir) if d not in checkpoints] + _partial_dirs(output_dir)
+    if len(removing) > 0:
+        logger.info(f"removing incomplete checkpoints: {', '.join(removing)}")
+    oldest = checkpoints[:max(len(checkpoints) - total_limit, 0)]
+    if len(oldest) > 0:
+        logger.info(f"{len(checkpoints)} checkpoints exist, removing {len(oldest)} checkpoints: {', '.join(oldest)}")
+    for checkpoint in removing + oldest:
+        shutil.rmtree(os.path.join(output_dir, checkpoint), ignore_errors=True)
+
+
+def is_sharded(accelerator):
+    """Whether the model and optimizer states are sharded across processes (DeepSpeed ZeRO, FSDP)."""
+    return accelerator.distributed_type in (DistributedType.DEEPSPEED, DistributedType.FSDP)
+
+
+def is_zero3(accelerator):
+    """Whether the parameters themselves are partitioned across processes by DeepSpeed ZeRO-3."""
+    return (accelerator.distributed_type == DistributedType.DEEPSPEED
+            and accelerator.state.deepspeed_plugin.zero_stage == 3)
+
+
+@contextlib.contextmanager
+def zero3_init_disabled(accelerator):
+    """
+    Context in which `from_pretrained` loads complete weights under ZeRO-3, for the frozen models that
+    are not passed to `accelerator.prepare`. transformers partitions every model it loads while the
+    ZeRO-3 config of the accelerator is registered with it, whatever `zero3_init_flag` says.
+    """
+    if not is_zero3(accelerator):
+        yield
+        return
+    from transformers.integrations import set_hf_deepspeed_config, unset_hf_deepspeed_config
+
+    unset_hf_deepspeed_config()
+    try:
+        yield
+    finally:
+        dschf = getattr(accelerator.state.deepspeed_plugin, "dschf", None)
+        if dschf is not None:
+            set_hf_deepspeed_config(dschf)
+
+
+def save_consolidated(accelerator, model, save_directory):
+    """
+    Write a prepared diffusers model as `save_directory/{config.json, diffusion_pytorch_model.safetensors}`
+    with its full weights, gathered from the shards under ZeRO-3 / FSDP.
+
+    Gathering is collective: every process must call this, only the main process writes.
+    ZeRO-3 needs `zero3_save_16bit_model: true` in the accelerate config (see configs/accelerate).
+    """
+    state_dict = accelerator.get_state_dict(model)
+    if accelerator.is_main_process:
+        os.makedirs(save_directory, exist_ok=True)
+        accelerator.unwrap_model(model).save_config(save_directory)
+        state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+        save_file(state_dict, os.path.join(save_directory, SAFETENSORS_WEIGHTS_NAME), metadata={"format": "pt"})
+
+
+class AsyncCheckpointer:
+    """
+    Checkpointing off the training loop.
+
+    `save` copies the training state (models, EMA models, optimizer, lr scheduler, grad scaler and
+    RNG states) into pinned host buffers, which are allocated once and reused, and returns as soon
+    as the copy is done. A background thread then writes the files in the layout of
+    `accelerator.save_state` with the trainers' hooks (diffusers-style model subfolders), so
+    `accelerator.load_state` resumes from them unchanged. The checkpoint is written to
+    `checkpoint-<step>.partial`, marked complete and renamed, so readers never see a half-written
+    checkpoint; old checkpoints are rotated by the same thread.
+
+    Only one write is in flight: `save` first waits for the previous one, whose error (if any) is
+    raised there.
+    """
+
+    def __init__(self, accelerator, output_dir, total_limit=None):
+        if is_sharded(accelerator):
+            raise ValueError("asynchronous checkpointing does not support sharded (DeepSpeed / FSDP) training states")
+        self.accelerator = accelerator
+        self.output_dir = output_dir
+        self.total_limit = total_limit
+        self.pin_memory = torch.cuda.is_available()
+        self._buffers = {}
+        self._thread = None
+        self._error = None
+
+    def _to_host(self, value, key):
+        if isinstance(value, torch.Tensor):
+            buffer = self._buffers.get(key)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = torch.empty(value.shape, dtype=value.dtype, device="cpu", pin_memory=self.pin_memory)
+                self._buffers[key] = buffer
+            return buffer.copy_(value.detach(), non_blocking=True)
+        if isinstance(value, dict):
+            return {k: self._to_host(v, f"{key}/{k}") for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._to_host(v, f"{key}/{i}") for i, v in enumerate(value))
+        return value
+
+    def _snapshot(self, models, ema_models):
+        accelerator = self.accelerator
+        snapshot = {"models": {}, "ema_models": {}}
+        for subfolder, model in models.items():
+            model = accelerator.unwrap_model(model)
+            snapshot["models"][subfolder] = (model.to_json_string(), self._to_host(model.state_dict(), subfolder))
+        for subfolder, (ema_model, model) in ema_models.items():
+            model = accelerator.unwrap_model(model)
+            # the EMA weights under the names of the model, like `EMAModel.save_pretrained`
+            state_dict = dict(model.state_dict())
+            for (name, _), shadow in zip(model.named_parameters(), ema_model.shadow_params):
+                state_dict[name] = shadow
+            config = json.loads(model.to_json_string())
+            config.update({k: v for k, v in ema_model.state_dict().items() if k != "shadow_params"})
+            snapshot["ema_models"][subfolder] = (json.dumps(config, indent=2, sort_keys=True) + "\n",
+                                                 self._to_host(state_dict, subfolder))
+        snapshot["optimizers"] = [self._to_host(optimizer.state_dict(), f"optimizer_{i}")
+                                  for i, optimizer in enumerate(accelerator._optimizers)]
+        snapshot["schedulers"] = [scheduler.state_dict() for scheduler in accelerator._schedulers]
+        snapshot["scaler"] = accelerator.scaler.state_dict() if accelerator.scaler is not None else None
+        rng_states = {
+            "step": accelerator.step,
+            "random_state": random.getstate(),
+            "numpy_random_seed": np.random.get_state(),
+            "torch_manual_seed": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            rng_states["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+        snapshot["rng_states"] = rng_states
+        if torch.cuda.is_available():
+            # the copies into the pinned buffers are asynchronous
+            torch.cuda.synchronize()
+        return snapshot
+
+    def _write(self, snapshot, save_path, on_write):
+        partial_path = save_path + PARTIAL_SUFFIX
+        shutil.rmtree(partial_path, ignore_errors=True)
+        for subfolder, (config, state_dict) in {**snapshot["models"], **snapshot["ema_models"]}.items():
+            os.makedirs(os.path.join(partial_path, subfolder))
+            with open(os.path.join(partial_path, subfolder, CONFIG_NAME), "w") as f:
+                f.write(config)
+            save_file(state_dict, os.path.join(partial_path, subfolder, SAFETENSORS_WEIGHTS_NAME), metadata={"format": "pt"})
+        for i, state_dict in enumerate(snapshot["optimizers"]):
+            torch.save(state_dict, os.path.join(partial_path, f"{OPTIMIZER_NAME}.bin" if i == 0 else f"{OPTIMIZER_NAME}_{i}.bin"))
+        for i, state_dict in enumerate(snapshot["schedulers"]):
+            torch.save(state_dict, os.path.join(partial_path, f"{SCHEDULER_NAME}.bin" if i == 0 else f"{SCHEDULER_NAME}_{i}.bin"))
+        if snapshot["scaler"] is not None:
+            torch.save(snapshot["scaler"], os.path.join(partial_path, SCALER_NAME))
+        torch.save(snapshot["rng_states"], os.path.join(partial_path, f"{RNG_STATE_NAME}_{self.accelerator.process_index}.pkl"))
+        if on_write is not None:
+            on_write(partial_path)
+        mark_complete(partial_path)
+        shutil.rmtree(save_path, ignore_errors=True)
+        os.replace(partial_path, save_path)
+        logger.info(f"Saved state to {save_path}")
+        if self.total_limit is not None:
+            rotate_checkpoints(self.output_dir, self.total_limit)
+
+    def _run(self, snapshot, save_path, on_write):
+        try:
+            self._write(snapshot, save_path, on_write)
+        except BaseException as e:
+            self._error = e
+
+    def save(self, global_step, models, ema_models=None, on_write=None):
+        """
+        Snapshot the training state and write it to `<output_dir>/checkpoint-<global_step>` in the background.
+
+        Args:
+            models (dict): subfolder -> model, e.g. {"unet": unet}.
+            ema_models (dict, optional): subfolder -> (EMAModel, model it averages), e.g. {"unet_ema": (ema_unet, unet)}.
+            on_write (callable, optional): called on the writer thread with the directory being written,
+                to add files to the checkpoint.
+
+        Returns:
+            the path of the checkpoint.
+        """
+        self.wait()
+        save_path = os.path.join(self.output_dir, f"checkpoint-{global_step}")
+        snapshot = self._snapshot(models, ema_models or {})
+        self._thread = threading.Thread(target=self._run, args=(snapshot, save_path, on_write), name="checkpoint-writer")
+        self._thread.start()
+        return save_path
+
+    def wait(self):
+        """Block until the checkpoint in flight is written, raising the error of a failed write."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("writing the checkpoint failed") from error
@@ -0,0 +1,56 @@
+import json
+import os
+
+STAGE_FILE = "resolution_stage.json"
+
+
+class ResolutionSchedule:
+    """
+    Progressive-resolution curriculum of the VAE / upsampler trainers.
+
+    The schedule is a comma-separated list of `step:resolution` pairs, e.g. "0:64,20000:128,60000:256"
+    trains at 64x64 until step 20000, then at 128x128 and from step 60000 on at 256x256. The last
+    resolution is the one the model is validated and used at.
+    """
+
+    def __init__(self, spec):
+        stages = []
+        for item in spec.split(","):
+            step, resolution = item.split(":")
+            stages.append((int(step), int(resolution)))
+        stages = sorted(stages)
+        if len(stages) == 0 or stages[0][0] != 0:
+            raise ValueError(f"the resolution schedule {spec!r} must start at step 0")
+        if len(set(step for step, _ in stages)) != len(stages):
+            raise ValueError(f"the resolution schedule {spec!r} has two stages starting at the same step")
+        self.stages = stages
+
+    def __call__(self, step):
+        """Return (stage index, resolution) at the global step `step`."""
+        stage = max(i for i, (start, _) in enumerate(self.stages) if start <= step)
+        return stage, self.stages[stage][1]
+
+    def __len__(self):
+        return len(self.stages)
+
+    @property
+    def resolutions(self):
+        return [resolution for _, resolution in self.stages]
+
+    def __repr__(self):
+        return ",".join(f"{step}:{resolution}" for step, resolution in self.stages)
+
+    def save(self, output_dir, step):
+        """Record the stage of the checkpoint written to `output_dir` at the global step `step`."""
+        stage, resolution = self(step)
+        with open(os.path.join(output_dir, STAGE_FILE), "w") as f:
+            json.dump({"step": step, "stage": stage, "resolution": resolution, "schedule": repr(self)}, f, indent=2)
+
+    @staticmethod
+    def load(input_dir):
+        """Return the stage record of a checkpoint, or None for checkpoints written without one."""
+        path = os.path.join(input_dir, STAGE_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
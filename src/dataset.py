@@ -1,21 +1,309 @@
 import glob
+import io
+import json
+import math
+import multiprocessing
 import os
 import random
+import subprocess
+import tarfile
+import urllib.request
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, Sampler, default_collate, get_worker_info
 from PIL import Image
-from scipy.sparse import csr_matrix
+from src.xray_io import load_occupancy, load_xray
 import torch.nn.functional as F
 import torchvision
 
 
-class DiffusionDataset(Dataset):
-    def __init__(self, root_dir, size, num_frames, near, far, phase="train"):
+def load_xrays(xrays_path, num_threads=1, num_layers=None):
+    """Load an X-Ray `.npz` of any codec from a path or a file-like object."""
+    return load_xray(xrays_path, num_threads=num_threads, num_layers=num_layers)
+
+
+def mask_iou(occupancy, image_values_pil):
+    """IoU between a (H, W) hit mask and the alpha mask of the RGBA condition image."""
+    _, _, _, mask = image_values_pil.split()
+    xray = occupancy.astype(np.float32)
+    mask = (np.array(mask.resize(xray.shape)) / 255 > 0.5).astype(np.float32)
+    return (mask * xray).sum() / np.maximum(mask, xray).sum()
+
+
+def read_sample(xray_file, image_file, size, num_frames, near, far, image_scale, upsample_lr, decode_threads=1):
+    """
+    Read an X-Ray and its condition image and turn them into a training sample.
+
+    The occupancy plane is read first, so samples whose image mask and first X-Ray layer do not
+    agree are rejected (AssertionError) without decoding depth, normals and colours.
+    """
+    image_values_pil = Image.open(image_file)
+    occupancy = load_occupancy(xray_file, num_layers=num_frames)
+    iou = mask_iou(occupancy[0], image_values_pil)
+    assert iou > 0.7, f"iou: {iou}"
+
+    if hasattr(xray_file, "seek"):
+        # file-like objects (shard members) are positioned wherever reading the occupancy left them
+        xray_file.seek(0)
+    xrays = load_xrays(xray_file, num_threads=decode_threads, num_layers=num_frames)
+    return xray_to_sample(xrays, image_values_pil, size, num_frames, near, far, image_scale, upsample_lr,
+                          occupancy=occupancy, check_iou=False)
+
+
+def xray_to_sample(xrays, image_values_pil, size, num_frames, near, far, image_scale, upsample_lr, occupancy=None,
+                   check_iou=True):
+    """
+    Turn a raw X-Ray array and its RGBA condition image into a training sample.
+
+    Args:
+        xrays (np.ndarray): raw X-Ray of shape (16, 7, 256, 256).
+        image_values_pil (PIL.Image.Image): RGBA condition image.
+        size (int): spatial size of the returned `xray`.
+        image_scale (int): the condition image is resized to `size * image_scale`.
+        upsample_lr (bool): whether `xray_lr` is upsampled back to `size`.
+        occupancy (np.ndarray, optional): hit mask of at least `num_frames` layers, computed from
+            the depth if not given.
+        check_iou (bool): reject samples whose image mask and first X-Ray layer do not agree, callers
+            that already checked them (`read_sample`) pass False.
+
+    Raises an AssertionError if `check_iou` is set and the image mask and the first X-Ray layer do
+    not agree.
+    """
+    if occupancy is None:
+        occupancy = xrays[:num_frames, 0] > 0
+    # filter
+    if check_iou:
+        iou = mask_iou(occupancy[0], image_values_pil)
+        assert iou > 0.7, f"iou: {iou}"
+
+    sample = {}
+    xray = torch.from_numpy(xrays[:num_frames].copy()).float()  # [8, 7, H, W]
+    hit = torch.from_numpy(occupancy[:num_frames, None]).float() * 2 - 1
+    xray[:, 0] = (xray[:, 0] - near) / (far - near) * 2 - 1
+    xray[:, 1:4] = F.normalize(xray[:, 1:4], dim=1)
+    xray[:, 4:7] = xray[:, 4:7] * 2 - 1
+    xray = torch.cat([xray, hit], dim=1)
+
+    sample["xray"] = torch.nn.functional.interpolate(xray, size=(size, size), mode="nearest")
+    xray_lr = torch.nn.functional.interpolate(xray, size=(size // 4, size // 4), mode="nearest")
+    if upsample_lr:
+        xray_lr = torch.nn.functional.interpolate(xray_lr, size=(size, size), mode="nearest")
+    sample["xray_lr"] = xray_lr
+
+    image_values_pil = image_values_pil.convert("RGB")
+    image_values = image_values_pil.resize((size * image_scale, size * image_scale), Image.BILINEAR)
+    image_values = torchvision.transforms.ToTensor()(image_values) * 2 - 1
+    sample["image_values"] = image_values
+    return sample
+
+
+def random_crop(sample, patch_size, lr_scale=4):
+    """
+    Crop aligned windows of `xray` and `xray_lr` for patch training of the upsampler.
+
+    The window is `patch_size` pixels of `xray` and starts at a multiple of `lr_scale`, so the
+    `xray_lr` window covers exactly the same region. It is centred on a random hit of the first
+    layer when there is one, so crops rarely miss the object. The condition image is kept whole:
+    its latents have the resolution of `xray_lr` and are cropped after encoding with `crop_windows`,
+    the same way they are computed for full-frame inference.
+
+    Returns the sample with the cropped X-Rays, `sample["crop"]`, the (y, x) offset of the window
+    in `xray`, and `sample["frame_size"]`, the size of the full frame.
+    """
+    size = sample["xray"].shape[-1]
+    assert patch_size % lr_scale == 0 and patch_size <= size, \
+        f"patch size {patch_size} must be a multiple of {lr_scale} and at most {size}"
+    hits = (sample["xray"][0, -1] > 0).nonzero()
+    if len(hits) > 0:
+        y, x = hits[random.randrange(len(hits))].tolist()
+    else:
+        y, x = random.randrange(size), random.randrange(size)
+    y, x = [min(max(c - patch_size // 2, 0), size - patch_size) // lr_scale * lr_scale for c in (y, x)]
+
+    sample["xray"] = sample["xray"][..., y:y + patch_size, x:x + patch_size]
+    lr_y, lr_x, lr_size = y // lr_scale, x // lr_scale, patch_size // lr_scale
+    sample["xray_lr"] = sample["xray_lr"][..., lr_y:lr_y + lr_size, lr_x:lr_x + lr_size]
+    sample["crop"] = torch.tensor([y, x])
+    sample["frame_size"] = size
+    return sample
+
+
+def crop_windows(values, offsets, size):
+    """
+    Gather one window per sample, e.g. the conditioning latents under the crops of `random_crop`.
+    :param values: (B, ..., H, W) torch.Tensor
+    :param offsets: (B, 2) torch.Tensor, (y, x) of every window in `values`
+    :param size: (h, w) of the windows
+    :return: (B, ..., h, w) torch.Tensor
+    """
+    rows = offsets[:, 0, None] + torch.arange(size[0], device=values.device)
+    cols = offsets[:, 1, None] + torch.arange(size[1], device=values.device)
+    batch = torch.arange(len(values), device=values.device)[:, None, None]
+    windows = values.movedim((-2, -1), (1, 2))[batch, rows[:, :, None], cols[:, None, :]]  # B x h x w x ...
+    return windows.movedim((1, 2), (-2, -1))
+
+
+def collate_same_size(samples):
+    """
+    `default_collate` for datasets whose resolution changes during training (`set_size`). A batch
+    that straddles a change keeps only the samples at the resolution of its last, newest sample.
+    """
+    last = samples[-1]
+    samples = [sample for sample in samples
+               if all(not torch.is_tensor(value) or value.shape == last[key].shape for key, value in sample.items())]
+    return default_collate(samples)
+
+
+class ResizableDataset:
+    """
+    Resolution shared with the dataloader workers, so `set_size` reaches running workers too.
+    """
+
+    @property
+    def size(self):
+        return self._size.value
+
+    @size.setter
+    def size(self, size):
+        if not hasattr(self, "_size"):
+            self._size = multiprocessing.RawValue("i", size)
+        self._size.value = size
+
+    def set_size(self, size):
+        """Change the resolution of the samples, workers pick it up with their next sample."""
+        self.size = size
+
+
+# per-view layer counts written by `scripts/build_manifest.py` into the dataset root
+MANIFEST_NAME = "manifest.json"
+
+
+def count_layers(xray_file):
+    """Effective number of layers of an X-Ray: the index of its deepest non-empty layer + 1."""
+    non_empty = np.flatnonzero(load_occupancy(xray_file).any(axis=(1, 2)))
+    return int(non_empty[-1]) + 1 if len(non_empty) > 0 else 0
+
+
+def load_manifest(root_dir):
+    """{X-Ray path relative to `root_dir`: number of layers}, or None if the dataset has no manifest."""
+    manifest_path = os.path.join(root_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)["num_layers"]
+
+
+def bucket_frames(num_layers, buckets):
+    """Frame count of the smallest bucket that holds `num_layers` layers, the largest bucket if none does or unknown."""
+    if num_layers is not None:
+        for frames in sorted(buckets):
+            if num_layers <= frames:
+                return frames
+    return max(buckets)
+
+
+class LayerBucketDataset:
+    """
+    Per-sample frame counts from the layer counts of the manifest, for `LayerBucketBatchSampler`.
+
+    With `frame_buckets`, e.g. (2, 4, 8), every sample is read with the frame count of its bucket
+    instead of `num_frames`, so the X-Rays of shallow objects are not padded with empty layers.
+    Views missing from the manifest go to the largest bucket.
+    """
+
+    def init_layer_buckets(self, frame_buckets):
+        self.frame_buckets = None
+        self.sample_num_frames = None
+        if frame_buckets is None:
+            return
+        manifest = load_manifest(self.base_folder)
+        if manifest is None:
+            raise FileNotFoundError(f"{os.path.join(self.base_folder, MANIFEST_NAME)} does not exist, "
+                                    "build it with scripts/build_manifest.py")
+        self.frame_buckets = sorted(set(min(frames, self.num_frames) for frames in frame_buckets))
+        self.sample_num_frames = [
+            bucket_frames(manifest.get(os.path.relpath(xray_path, self.base_folder)), self.frame_buckets)
+            for xray_path in self.xray_paths
+        ]
+
+    def frames_of(self, idx):
+        return self.num_frames if self.sample_num_frames is None else self.sample_num_frames[idx]
+
+
+class LayerBucketBatchSampler(Sampler):
+    """
+    Batches of samples with the same frame count (`LayerBucketDataset.sample_num_frames`), sharded
+    across processes.
+
+    Samples are shuffled within their bucket, with a seed that advances every epoch, identically on
+    every process. Every bucket is cut into rounds of `num_processes` full batches, one per process,
+    so all processes step through batches of the same bucket together; the rounds of all buckets are
+    shuffled together. The tail of a bucket is dropped with `drop_last`, and padded with samples from
+    the start of the bucket otherwise. The dataloader must not be sharded again by
+    `accelerator.prepare_data_loader`, whose batch sampler shard would mix the buckets.
+    """
+
+    def __init__(self, sample_num_frames, batch_size, drop_last=False, seed=0, num_processes=1, process_index=0):
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_processes = num_processes
+        self.process_index = process_index
+        self.epoch = 0
+        self.buckets = {}
+        for idx, frames in enumerate(sample_num_frames):
+            self.buckets.setdefault(frames, []).append(idx)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _num_rounds(self, num_samples):
+        round_size = self.batch_size * self.num_processes
+        return num_samples // round_size if self.drop_last else math.ceil(num_samples / round_size)
+
+    def __len__(self):
+        return sum(self._num_rounds(len(indices)) for indices in self.buckets.values())
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+        round_size = self.batch_size * self.num_processes
+        rounds = []
+        for frames in sorted(self.buckets):
+            indices = list(self.buckets[frames])
+            rng.shuffle(indices)
+            num_samples = self._num_rounds(len(indices)) * round_size
+            indices = (indices * math.ceil(num_samples / len(indices)))[:num_samples]
+            rounds += [indices[start:start + round_size] for start in range(0, num_samples, round_size)]
+        rng.shuffle(rounds)
+        for samples in rounds:
+            start = self.process_index * self.batch_size
+            yield samples[start:start + self.batch_size]
+
+
+def split_xray_paths(xray_paths, phase, holdout_stride, val_stride=None):
+    """
+    Train / val split of the X-Ray paths of a dataset, in sorted order so it is the same on every
+    process and for `scripts/pack_shards.py`: "train" drops every `holdout_stride`-th path, "val"
+    keeps every `val_stride`-th one (`holdout_stride` by default, a multiple of it keeps the
+    validation views out of "train"), any other phase keeps all of them.
+    """
+    xray_paths = sorted(xray_paths)
+    if phase == "train":
+        del xray_paths[::holdout_stride]
+    elif phase == "val":
+        xray_paths = xray_paths[::val_stride or holdout_stride]
+    return xray_paths
+
+
+class DiffusionDataset(LayerBucketDataset, Dataset):
+    def __init__(self, root_dir, size, num_frames, near, far, phase="train", decode_threads=1, frame_buckets=None):
         """
         Args:
             num_samples (int): Number of samples in the dataset.
             channels (int): Number of channels, default is 3 for RGB.
+            frame_buckets (tuple, optional): read samples with the frame count of their layer bucket, see `LayerBucketDataset`.
         """
         # Define the path to the folder containing video frames
         self.base_folder = root_dir
@@ -23,28 +311,19 @@ class DiffusionDataset(Dataset):
         self.near = near
         self.far = far
         self.num_frames = num_frames
-        self.xray_paths = glob.glob(os.path.join(root_dir, "xrays/**/*.npz"), recursive=True)
-        sorted(self.xray_paths)
+        self.decode_threads = decode_threads
+        self.xray_paths = split_xray_paths(glob.glob(os.path.join(root_dir, "xrays/**/*.npz"), recursive=True), phase,
+                                           holdout_stride=10, val_stride=20)
         if phase == "train":
-            del self.xray_paths[::10]
             random.shuffle(self.xray_paths)
-        elif phase == "val":
-            self.xray_paths = self.xray_paths[::20]
-        else:
-            self.xray_paths = self.xray_paths
         self.num_samples = len(self.xray_paths)        
+        self.init_layer_buckets(frame_buckets)
 
     def __len__(self):
         return self.num_samples
 
     def load_xrays(self, xrays_path):
-        loaded_data = np.load(xrays_path)
-
-        loaded_sparse_matrix = csr_matrix((loaded_data['data'], loaded_data['indices'], loaded_data['indptr']), shape=loaded_data['shape'])
-
-        original_shape = (16, 1+3+3, 256, 256)
-        restored_array = loaded_sparse_matrix.toarray().reshape(original_shape)
-        return restored_array
+        return load_xrays(xrays_path, num_threads=self.decode_threads)
     
     def __getitem__(self, idx):
         """
@@ -54,52 +333,78 @@ class DiffusionDataset(Dataset):
         Returns:
             dict: A dictionary containing the 'xray_lr' tensor of shape (16, channels, 320, 512).
         """
+        return self.get_sample(idx, self.frames_of(idx))
+
+    def get_sample(self, idx, num_frames):
+        # a rejected sample is replaced by the next one, read with the same frame count to stay in its batch's bucket
         try:
-            sample = {}
             xray_path = self.xray_paths[idx]
-            xray_path = xray_path
-            xrays = self.load_xrays(xray_path)
-
-            xray = torch.from_numpy(xrays.copy()).float()[:self.num_frames]  # [8, 7, H, W]
-            hit = (xray[:, 0:1] > 0).clone().float() * 2 - 1
-            xray[:, 0] = (xray[:, 0] - self.near) / (self.far - self.near) * 2 - 1
-            xray[:, 1:4] = F.normalize(xray[:, 1:4], dim=1)
-            xray[:, 4:7] = xray[:, 4:7] * 2 - 1
-            xray = torch.cat([xray, hit], dim=1)
-            
-            sample["xray"] = torch.nn.functional.interpolate(xray, size=(self.size, self.size), mode="nearest")
-            xray_lr = torch.nn.functional.interpolate(xray, size=(self.size // 4, self.size // 4), mode="nearest")
-            sample["xray_lr"] = torch.nn.functional.interpolate(xray_lr, size=(self.size, self.size), mode="nearest")
-
-            # read condition image
             image_path = xray_path.replace("xrays", "images").replace(".npz", ".png")
-            image_values_pil = Image.open(image_path)
-            
-            # filter
-            _, _, _, mask = image_values_pil.split()
-            xray = (xrays[0, 0] > 0).astype(np.float32)
-            mask = (np.array(mask.resize(xray.shape)) / 255 > 0.5).astype(np.float32)
-            iou = (mask * xray).sum() / np.maximum(mask, xray).sum()
-            assert iou > 0.7, f"iou: {iou}"
-
-            image_values_pil = image_values_pil.convert("RGB")
-            image_values = image_values_pil.resize((self.size * 8, self.size * 8), Image.BILINEAR)
-            image_values = torchvision.transforms.ToTensor()(image_values) * 2 - 1
-            sample["image_values"] = image_values
+
+            sample = read_sample(xray_path, image_path, self.size, num_frames, self.near, self.far,
+                                 image_scale=8, upsample_lr=True, decode_threads=self.decode_threads)
             sample["image_path"] = image_path
             return sample
         
         except Exception as e:
             # print("Error: ", e)
-            return self.__getitem__((idx + 1) % self.num_samples)
+            return self.get_sample((idx + 1) % self.num_samples, num_frames)
 
 
-class UpsamplerDataset(Dataset):
-    def __init__(self, root_dir, size, num_frames, near, far, type="diffusion", phase="train"):
+class LatentDataset(DiffusionDataset):
+    def __init__(self, root_dir, latent_dir, num_frames, phase="train", frame_buckets=None):
+        """
+        X-Ray VAE latents cached by `scripts/cache_latents.py` with their condition images, for
+        latent-space diffusion. Uses the same train / val split as `DiffusionDataset`.
+
+        Args:
+            latent_dir (str): cache directory, mirrors the `xrays` folder of `root_dir`.
+        """
+        with open(os.path.join(latent_dir, "latent_stats.json"), "r") as f:
+            self.stats = json.load(f)
+        super().__init__(root_dir, self.stats["latent_size"], num_frames, self.stats["near"], self.stats["far"], phase=phase,
+                         frame_buckets=frame_buckets)
+        self.latent_dir = latent_dir
+
+    def latent_path(self, xray_path):
+        relative_path = os.path.relpath(xray_path, os.path.join(self.base_folder, "xrays"))
+        return os.path.join(self.latent_dir, relative_path)
+
+    def get_sample(self, idx, num_frames):
+        """
+        Returns:
+            dict: 'latents' of shape (num_frames, latent_channels, latent_size, latent_size) sampled
+            from the cached posterior (not scaled), 'image_values' of shape (3, 8 * latent_size,
+            8 * latent_size) in [-1, 1], the same layout the pipeline encodes the condition image in.
+        """
+        try:
+            xray_path = self.xray_paths[idx]
+            image_path = xray_path.replace("xrays", "images").replace(".npz", ".png")
+
+            with np.load(self.latent_path(xray_path)) as data:
+                mean = torch.from_numpy(data["mean"][:num_frames]).float()
+                std = torch.from_numpy(data["std"][:num_frames]).float()
+            image_values = Image.open(image_path).convert("RGB").resize((self.size * 8, self.size * 8), Image.BILINEAR)
+            return {
+                "latents": mean + std * torch.randn_like(std),
+                "image_values": torchvision.transforms.ToTensor()(image_values) * 2 - 1,
+                "image_path": image_path,
+            }
+
+        except Exception as e:
+            # print("Error: ", e)
+            return self.get_sample((idx + 1) % self.num_samples, num_frames)
+
+
+class UpsamplerDataset(ResizableDataset, LayerBucketDataset, Dataset):
+    def __init__(self, root_dir, size, num_frames, near, far, type="diffusion", phase="train", decode_threads=1,
+                 patch_size=None, frame_buckets=None):
         """
         Args:
             num_samples (int): Number of samples in the dataset.
             channels (int): Number of channels, default is 3 for RGB.
+            patch_size (int, optional): return aligned random crops of this size, see `random_crop`.
+            frame_buckets (tuple, optional): read samples with the frame count of their layer bucket, see `LayerBucketDataset`.
         """
         # Define the path to the folder containing video frames
         self.base_folder = root_dir
@@ -107,26 +412,20 @@ class UpsamplerDataset(Dataset):
         self.near = near
         self.far = far
         self.num_frames = num_frames
-        self.xray_paths = glob.glob(os.path.join(root_dir, "xrays/**/*.npz"), recursive=True)
-        sorted(self.xray_paths)
+        self.decode_threads = decode_threads
+        self.patch_size = patch_size
+        self.xray_paths = split_xray_paths(glob.glob(os.path.join(root_dir, "xrays/**/*.npz"), recursive=True), phase,
+                                           holdout_stride=30)
         if phase == "train":
-            del self.xray_paths[::30]
             random.shuffle(self.xray_paths)
-        elif phase == "val":
-            self.xray_paths = self.xray_paths[::30]
-        else:
-            self.xray_paths = self.xray_paths
         self.num_samples = len(self.xray_paths)        
+        self.init_layer_buckets(frame_buckets)
 
     def __len__(self):
         return self.num_samples
 
     def load_xrays(self, xrays_path):
-        loaded_data = np.load(xrays_path)
-        loaded_sparse_matrix = csr_matrix((loaded_data['data'], loaded_data['indices'], loaded_data['indptr']), shape=loaded_data['shape'])
-        original_shape = (16, 1+3+3, 256, 256)
-        restored_array = loaded_sparse_matrix.toarray().reshape(original_shape)
-        return restored_array
+        return load_xrays(xrays_path, num_threads=self.decode_threads)
     
     def __getitem__(self, idx):
         """
@@ -136,40 +435,360 @@ class UpsamplerDataset(Dataset):
         Returns:
             dict: A dictionary containing the 'xray_lr' tensor of shape (16, channels, 320, 512).
         """
+        return self.get_sample(idx, self.frames_of(idx))
+
+    def get_sample(self, idx, num_frames):
         try:
-            sample = {}
             xray_path = self.xray_paths[idx]
-            xray_path = xray_path
-            xrays = self.load_xrays(xray_path)
-
-            xray = torch.from_numpy(xrays.copy()).float()[:self.num_frames]  # [8, 7, H, W]
-            hit = (xray[:, 0:1] > 0).clone().float() * 2 - 1
-            xray[:, 0] = (xray[:, 0] - self.near) / (self.far - self.near) * 2 - 1
-            xray[:, 1:4] = F.normalize(xray[:, 1:4], dim=1)
-            xray[:, 4:7] = xray[:, 4:7] * 2 - 1
-            xray = torch.cat([xray, hit], dim=1)
-            
-            sample["xray"] = torch.nn.functional.interpolate(xray, size=(self.size, self.size), mode="nearest")
-            sample["xray_lr"] = torch.nn.functional.interpolate(xray, size=(self.size // 4, self.size // 4), mode="nearest")
-
-            # read condition image
             image_path = xray_path.replace("xrays", "images").replace(".npz", ".png")
-            image_values_pil = Image.open(image_path)
-            
-            # filter
-            _, _, _, mask = image_values_pil.split()
-            xray = (xrays[0, 0] > 0).astype(np.float32)
-            mask = (np.array(mask.resize(xray.shape)) / 255 > 0.5).astype(np.float32)
-            iou = (mask * xray).sum() / np.maximum(mask, xray).sum()
-            assert iou > 0.7, f"iou: {iou}"
-
-            image_values_pil = image_values_pil.convert("RGB")
-            image_values = image_values_pil.resize((self.size * 2, self.size * 2), Image.BILINEAR)
-            image_values = torchvision.transforms.ToTensor()(image_values) * 2 - 1
-            sample["image_values"] = image_values
+
+            size = self.size
+            sample = read_sample(xray_path, image_path, size, num_frames, self.near, self.far,
+                                 image_scale=2, upsample_lr=False, decode_threads=self.decode_threads)
+            if self.patch_size is not None:
+                sample = random_crop(sample, min(self.patch_size, size))
             sample["image_path"] = image_path
             return sample
         
         except Exception as e:
             # print("Error: ", e)
-            return self.__getitem__((idx + 1) % self.num_samples)
\ No newline at end of file
+            return self.get_sample((idx + 1) % self.num_samples, num_frames)
+
+
+def _open_shard(url):
+    """
+    Open a shard for sequential reading. Supports local paths, http(s) urls and `pipe:<command>`.
+
+    Returns the stream and the process writing it for `pipe:` urls (None otherwise), to be reaped
+    with `_close_shard`.
+    """
+    if url.startswith("pipe:"):
+        process = subprocess.Popen(url[len("pipe:"):], shell=True, stdout=subprocess.PIPE, bufsize=1 << 20)
+        return process.stdout, process
+    if url.startswith("http://") or url.startswith("https://"):
+        return urllib.request.urlopen(url), None
+    return open(url, "rb", buffering=1 << 20), None
+
+
+def _close_shard(stream, process, timeout=10):
+    stream.close()
+    if process is None:
+        return
+    # a command stopped early gets SIGPIPE on its next write, one that ignores it is killed
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def _get_rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+class ShardDataset(ResizableDataset, IterableDataset):
+    def __init__(self, shards, size, num_frames, near, far, type="diffusion", shuffle_buffer=1000, seed=0, decode_threads=1,
+                 patch_size=None):
+        """
+        Streaming X-Ray dataset over tar shards written by `scripts/pack_shards.py`.
+
+        Shards are read sequentially, split across ranks and dataloader workers, and samples are
+        shuffled with a bounded buffer. Each rank yields `len(self)` samples per epoch and loops over
+        its shards if they run out, so all ranks take the same number of steps.
+
+        Args:
+            shards (str): the `index.json` written by the packing tool, a directory containing it,
+                or a single shard url.
+            type (str): "diffusion" or "upsampler", selects the same sample layout as
+                `DiffusionDataset` or `UpsamplerDataset`.
+            shuffle_buffer (int): number of samples kept in the shuffle buffer of every worker.
+            decode_threads (int): threads used to decode the layers of zstd/lz4 X-Rays.
+            patch_size (int, optional): "upsampler" samples are aligned random crops of this size,
+                see `random_crop`.
+        """
+        self.size = size
+        self.near = near
+        self.far = far
+        self.num_frames = num_frames
+        self.type = type
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.decode_threads = decode_threads
+        self.patch_size = patch_size
+        self.epoch = 0
+
+        if os.path.isdir(shards):
+            shards = os.path.join(shards, "index.json")
+        if shards.endswith(".json"):
+            with open(shards, "r") as f:
+                index = json.load(f)
+            base_dir = os.path.dirname(shards)
+            self.shards = [s["url"] if "://" in s["url"] or s["url"].startswith("pipe:") else os.path.join(base_dir, s["url"])
+                           for s in index["shards"]]
+            total_samples = sum(s["num_samples"] for s in index["shards"])
+        else:
+            self.shards = [shards]
+            total_samples = None
+
+        self.rank, self.world_size = _get_rank_and_world_size()
+        if total_samples is None:
+            self.num_samples = None
+        else:
+            self.num_samples = total_samples // self.world_size
+
+    def __len__(self):
+        if self.num_samples is None:
+            raise TypeError("the length of a ShardDataset is only known when built from an index.json")
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _worker_shards(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        # same permutation on every rank, then a disjoint slice per rank and worker
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        if len(shards) >= self.world_size * num_workers:
+            shards = shards[self.rank * num_workers + worker_id::self.world_size * num_workers]
+        else:
+            shards = shards[(self.rank * num_workers + worker_id) % len(shards)::len(shards)]
+
+        if self.num_samples is None:
+            num_samples = None
+        else:
+            num_samples = self.num_samples // num_workers + int(worker_id < self.num_samples % num_workers)
+        return shards, num_samples
+
+    def _iter_shard(self, url):
+        stream, process = _open_shard(url)
+        try:
+            current_key, current = None, {}
+            with tarfile.open(fileobj=stream, mode="r|") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    key, ext = os.path.splitext(member.name)
+                    if key != current_key:
+                        if current:
+                            yield current_key, current
+                        current_key, current = key, {}
+                    current[ext[1:]] = tar.extractfile(member).read()
+            if current:
+                yield current_key, current
+        finally:
+            _close_shard(stream, process)
+
+    def _decode(self, key, files):
+        xray_file, image_file = io.BytesIO(files["npz"]), io.BytesIO(files["png"])
+        size = self.size
+        if self.type == "diffusion":
+            sample = read_sample(xray_file, image_file, size, self.num_frames, self.near, self.far,
+                                 image_scale=8, upsample_lr=True, decode_threads=self.decode_threads)
+        else:
+            sample = read_sample(xray_file, image_file, size, self.num_frames, self.near, self.far,
+                                 image_scale=2, upsample_lr=False, decode_threads=self.decode_threads)
+            if self.patch_size is not None:
+                sample = random_crop(sample, min(self.patch_size, size))
+        sample["image_path"] = key + ".png"
+        return sample
+
+    def _iter_samples(self, shards):
+        while True:
+            num_decoded = 0
+            for url in shards:
+                for key, files in self._iter_shard(url):
+                    try:
+                        sample = self._decode(key, files)
+                    except Exception as e:
+                        # print("Error: ", e)
+                        continue
+                    num_decoded += 1
+                    yield sample
+            # a nominal epoch loops over the shards again, unless there is nothing to loop over
+            if self.num_samples is None or num_decoded == 0:
+                return
+
+    def __iter__(self):
+        shards, num_samples = self._worker_shards()
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        rng = random.Random((self.seed + self.epoch) * 1000003 + self.rank * 1009 + worker_id)
+
+        buffer = []
+        count = 0
+        for sample in self._iter_samples(shards):
+            if num_samples is not None and count >= num_samples:
+                return
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = sample
+            count += 1
+
+        rng.shuffle(buffer)
+        for sample in buffer:
+            if num_samples is not None and count >= num_samples:
+                return
+            yield sample
+            count += 1
+
+
+class MeshXRayDataset(ResizableDataset, IterableDataset):
+    def __init__(self, mesh_dir, size, num_frames, near, far, type="diffusion", image_root=None, num_samples=None,
+                 pool_size=8, views_per_mesh=16, seed=0, patch_size=None):
+        """
+        Streaming X-Ray dataset that ray casts its samples from meshes in the dataloader workers.
+
+        Every worker keeps a pool of `pool_size` meshes written by `scripts/prepare_meshes.py`, each
+        with its BVH (see `src.raycast.MeshCaster`), and renders every sample from a random mesh of
+        the pool. A mesh is swapped for the next one of the worker after `views_per_mesh` views.
+        Meshes are split across ranks and workers like the shards of `ShardDataset`.
+
+        Args:
+            mesh_dir (str): directory of `<uid>.npz` meshes.
+            type (str): "diffusion" or "upsampler", selects the same sample layout as
+                `DiffusionDataset` or `UpsamplerDataset`.
+            image_root (str, optional): the `images` directory of a rendered dataset. Views are then
+                the cameras of `<image_root>/<uid>/transforms.json` with their renders as condition
+                images, only the X-Rays are cast. By default views are random cameras around the
+                object and the condition images are flat shaded renders of the ray caster.
+            num_samples (int, optional): samples per epoch over all ranks, `views_per_mesh` per mesh
+                by default.
+            patch_size (int, optional): "upsampler" samples are aligned random crops of this size,
+                see `random_crop`.
+        """
+        self.size = size
+        self.near = near
+        self.far = far
+        self.num_frames = num_frames
+        self.type = type
+        self.image_root = image_root
+        self.pool_size = pool_size
+        self.views_per_mesh = views_per_mesh
+        self.seed = seed
+        self.patch_size = patch_size
+        self.epoch = 0
+
+        self.mesh_paths = sorted(glob.glob(os.path.join(mesh_dir, "**/*.npz"), recursive=True))
+        if len(self.mesh_paths) == 0:
+            raise ValueError(f"no meshes found in {mesh_dir}")
+        if num_samples is None:
+            num_samples = len(self.mesh_paths) * views_per_mesh
+        self.rank, self.world_size = _get_rank_and_world_size()
+        self.num_samples = num_samples // self.world_size
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _worker_meshes(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        mesh_paths = list(self.mesh_paths)
+        random.Random(self.seed + self.epoch).shuffle(mesh_paths)
+        if len(mesh_paths) >= self.world_size * num_workers:
+            mesh_paths = mesh_paths[self.rank * num_workers + worker_id::self.world_size * num_workers]
+        else:
+            mesh_paths = mesh_paths[(self.rank * num_workers + worker_id) % len(mesh_paths)::len(mesh_paths)]
+        num_samples = self.num_samples // num_workers + int(worker_id < self.num_samples % num_workers)
+        return mesh_paths, num_samples
+
+    def _load(self, mesh_path):
+        from src.raycast import MeshCaster
+
+        uid = os.path.splitext(os.path.basename(mesh_path))[0]
+        views = None
+        if self.image_root is not None:
+            with open(os.path.join(self.image_root, uid, "transforms.json"), "r") as f:
+                meta = json.load(f)
+            views = [(np.array(frame["c2w"]), os.path.join(self.image_root, uid, frame["file_path"]),
+                      float(meta["camera_angle_x"])) for frame in meta["frames"]]
+        return {"uid": uid, "caster": MeshCaster.load(mesh_path), "views": views, "uses": 0}
+
+    def _iter_meshes(self, mesh_paths, rng):
+        # loops over the worker's meshes, skipping those that fail to load, until none loads
+        while True:
+            num_loaded = 0
+            for mesh_path in rng.sample(mesh_paths, len(mesh_paths)):
+                try:
+                    entry = self._load(mesh_path)
+                except Exception as e:
+                    # print("Error: ", e)
+                    continue
+                num_loaded += 1
+                yield entry
+            if num_loaded == 0:
+                return
+
+    def _render(self, entry, rng):
+        from src.geometry import CAMERA_ANGLE_X
+        from src.raycast import sample_camera
+
+        size = self.size
+        image_scale = 8 if self.type == "diffusion" else 2
+        if entry["views"] is None:
+            c2w = sample_camera(rng)
+            camera_angle_x = CAMERA_ANGLE_X
+            image_values_pil = entry["caster"].image(c2w, size * image_scale)
+            name = f"{entry['uid']}/{entry['uses']:03d}.png"
+        else:
+            c2w, image_path, camera_angle_x = entry["views"][rng.randrange(len(entry["views"]))]
+            image_values_pil = Image.open(image_path)
+            name = os.path.join(entry["uid"], os.path.basename(image_path))
+        xrays = entry["caster"].xray(c2w, num_layers=self.num_frames, camera_angle_x=camera_angle_x)
+        # renders of the caster match its X-Rays by construction, only the dataset renders are checked
+        check_iou = entry["views"] is not None
+
+        if self.type == "diffusion":
+            sample = xray_to_sample(xrays, image_values_pil, size, self.num_frames, self.near, self.far,
+                                    image_scale=8, upsample_lr=True, check_iou=check_iou)
+        else:
+            sample = xray_to_sample(xrays, image_values_pil, size, self.num_frames, self.near, self.far,
+                                    image_scale=2, upsample_lr=False, check_iou=check_iou)
+            if self.patch_size is not None:
+                sample = random_crop(sample, min(self.patch_size, size))
+        sample["image_path"] = name
+        return sample
+
+    def __iter__(self):
+        mesh_paths, num_samples = self._worker_meshes()
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        rng = random.Random((self.seed + self.epoch) * 1000003 + self.rank * 1009 + worker_id)
+
+        meshes = self._iter_meshes(mesh_paths, rng)
+        pool = [entry for _, entry in zip(range(self.pool_size), meshes)]
+        count, num_failed = 0, 0
+        # stop if every view of every mesh of the worker got rejected in a row
+        while count < num_samples and len(pool) > 0 and num_failed < len(mesh_paths) * self.views_per_mesh:
+            slot = rng.randrange(len(pool))
+            entry = pool[slot]
+            try:
+                sample = self._render(entry, rng)
+            except Exception as e:
+                # print("Error: ", e)
+                sample = None
+            entry["uses"] += 1
+            if entry["uses"] >= self.views_per_mesh:
+                # the BVH of the next mesh is built here, in the worker, off the training process
+                replacement = next(meshes, None)
+                if replacement is None:
+                    del pool[slot]
+                else:
+                    pool[slot] = replacement
+            if sample is None:
+                num_failed += 1
+                continue
+            num_failed = 0
+            yield sample
+            count += 1
@@ -0,0 +1,137 @@
+import torch
+from diffusers.training_utils import EMAModel
+
+
+class IntervalEMAModel(EMAModel):
+    """
+    `EMAModel` that is updated every `update_every` optimizer steps and can keep its shadow weights
+    in pinned host memory.
+
+    `step` is still called once per optimizer step and counts it, but the shadow weights are only
+    updated on every `update_every`-th call, with the decay raised to the power `update_every`.
+    That is exact for weights that stay constant within the interval and, at decays close to 1, a
+    close approximation otherwise; `optimization_step` (and so the warmup schedule and checkpoints)
+    keeps counting optimizer steps. The update is a multi-tensor `torch._foreach_lerp_`.
+
+    With `offload=True` the shadow weights live in pinned CPU memory, `to(device)` keeps them there
+    (only dtype changes apply). An update copies the parameters to the host bucket by bucket,
+    through one reusable pinned buffer of `bucket_numel` elements, and averages them there. The
+    full-parameter pass then costs a device-to-host copy every `update_every` steps and no device
+    memory at all.
+
+    With `zero3=True` the parameters are DeepSpeed ZeRO-3 partitions. They are gathered for the
+    update `bucket_numel` elements at a time, so a process never holds more than one bucket of
+    full parameters next to its partition; that is collective, every process has to call `step`.
+    The shadow weights are complete on every process, `zero3` implies `offload` so they take host
+    memory instead of the device memory ZeRO-3 frees.
+
+    State dicts and `save_pretrained` directories are those of `EMAModel`.
+    """
+
+    def __init__(self, parameters, update_every=1, offload=False, zero3=False, bucket_numel=2 ** 26, **kwargs):
+        super().__init__(parameters, **kwargs)
+        if update_every < 1:
+            raise ValueError(f"update_every must be a positive integer, got {update_every}")
+        self.update_every = update_every
+        self.offload = offload or zero3
+        self.zero3 = zero3
+        self.bucket_numel = bucket_numel
+        self._skipped = 0
+        self._staging = {}
+        if self.offload:
+            self.to()
+
+    def to(self, device=None, dtype=None, non_blocking=False):
+        if not self.offload:
+            return super().to(device=device, dtype=dtype, non_blocking=non_blocking)
+        pin = torch.cuda.is_available()
+        shadow_params = []
+        for p in self.shadow_params:
+            p = p.to(device="cpu", dtype=dtype if p.is_floating_point() else None)
+            shadow_params.append(p.pin_memory() if pin and not p.is_pinned() else p)
+        self.shadow_params = shadow_params
+
+    def load_state_dict(self, state_dict):
+        super().load_state_dict(state_dict)
+        if self.offload:
+            self.to()
+
+    def _staging_buffer(self, dtype, numel):
+        staging = self._staging.get(dtype)
+        if staging is None or staging.numel() < numel:
+            staging = torch.empty(max(numel, self.bucket_numel), dtype=dtype, pin_memory=True)
+            self._staging[dtype] = staging
+        return staging
+
+    def _host_buckets(self, s_params, params):
+        """Yield (shadow params, host copies of params) in buckets that fit the staging buffer."""
+        bucket, offset = [], 0
+        for s_param, param in zip(s_params, params):
+            if param.device.type == "cpu":
+                yield [s_param], [param]
+                continue
+            if len(bucket) > 0 and (offset + param.numel() > self.bucket_numel or param.dtype != bucket[0][1].dtype):
+                torch.cuda.synchronize(param.device)
+                yield [s for s, _ in bucket], [h for _, h in bucket]
+                bucket, offset = [], 0
+            staging = self._staging_buffer(param.dtype, offset + param.numel())
+            host = staging[offset:offset + param.numel()].view(param.shape)
+            host.copy_(param, non_blocking=True)
+            bucket.append((s_param, host))
+            offset += param.numel()
+        if len(bucket) > 0:
+            torch.cuda.synchronize()
+            yield [s for s, _ in bucket], [h for _, h in bucket]
+
+    @torch.no_grad()
+    def step(self, parameters):
+        parameters = list(parameters)
+        self._skipped += 1
+        self.optimization_step += 1
+        if self._skipped < self.update_every:
+            return
+        interval, self._skipped = self._skipped, 0
+
+        decay = self.get_decay(self.optimization_step) ** interval
+        self.cur_decay_value = decay
+
+        if not self.zero3:
+            self._update(self.shadow_params, parameters, decay)
+            return
+
+        import deepspeed
+
+        for s_params, params in self._gather_buckets(self.shadow_params, parameters):
+            with deepspeed.zero.GatheredParameters(params, modifier_rank=None):
+                self._update(s_params, params, decay)
+
+    def _gather_buckets(self, s_params, params):
+        """Split (shadow params, ZeRO-3 params) into runs of at most `bucket_numel` full elements."""
+        bucket, numel = [], 0
+        for s_param, param in zip(s_params, params):
+            param_numel = getattr(param, "ds_numel", param.numel())
+            if len(bucket) > 0 and numel + param_numel > self.bucket_numel:
+                yield [s for s, _ in bucket], [p for _, p in bucket]
+                bucket, numel = [], 0
+            bucket.append((s_param, param))
+            numel += param_numel
+        if len(bucket) > 0:
+            yield [s for s, _ in bucket], [p for _, p in bucket]
+
+    def _update(self, shadow_params, parameters, decay):
+        trainable = [(s_param, param) for s_param, param in zip(shadow_params, parameters) if param.requires_grad]
+        frozen = [(s_param, param) for s_param, param in zip(shadow_params, parameters) if not param.requires_grad]
+        for s_param, param in frozen:
+            s_param.copy_(param)
+        if len(trainable) == 0:
+            return
+        s_params, params = zip(*trainable)
+        if not self.offload:
+            # the parameters may be in half precision, e.g. under DeepSpeed
+            params = [p if p.dtype == s.dtype else p.to(s.dtype) for p, s in zip(params, s_params)]
+            torch._foreach_lerp_(list(s_params), params, 1 - decay)
+            return
+        for shadow, host_params in self._host_buckets(s_params, params):
+            if host_params[0].dtype != shadow[0].dtype:
+                host_params = [p.to(s.dtype) for p, s in zip(host_params, shadow)]
+            torch._foreach_lerp_(shadow, host_params, 1 - decay)
@@ -0,0 +1,92 @@
+import numpy as np
+import torch
+
+# horizontal field of view of every rendered view, the camera sits at the origin looking down -z
+CAMERA_ANGLE_X = 0.8575560450553894
+
+_ray_directions = {}
+
+
+def get_ray_directions(height, width, camera_angle_x=CAMERA_ANGLE_X, device=None):
+    """
+    Unit ray directions of a (height, width) view in camera space.
+
+    Tables are built once per (height, width, camera_angle_x, device) and shared, do not modify them.
+
+    Args:
+        device (torch.device or str, optional): return a float32 torch tensor on this device instead
+            of a float64 NumPy array.
+
+    Returns:
+        array of shape (H, W, 3).
+    """
+    if device is not None:
+        device = torch.device(device)
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+    key = (height, width, camera_angle_x, device)
+    if key not in _ray_directions:
+        if device is None:
+            fx = 0.5 * width / np.tan(0.5 * camera_angle_x)
+            j, i = np.mgrid[0:height, 0:width]
+            cx = width / 2.0
+            cy = height / 2.0
+            directions = np.stack([(i - cx) / fx, -(j - cy) / fx, -np.ones_like(i)], -1)  # (H, W, 3)
+            directions = directions / (np.linalg.norm(directions, axis=-1, keepdims=True) + 1e-8)
+        else:
+            directions = get_ray_directions(height, width, camera_angle_x)
+            directions = torch.from_numpy(directions).float().to(device)
+        _ray_directions[key] = directions
+    return _ray_directions[key]
+
+
+def xray_to_pcd(depths, normals=None, colors=None, hits=None, camera_angle_x=CAMERA_ANGLE_X, return_batch_index=False,
+                directions=None):
+    """
+    Unproject X-Ray layers into a point cloud.
+
+    Works on NumPy arrays and torch tensors alike. Any number of leading dimensions is accepted,
+    e.g. (layers, C, H, W) or (batch, layers, C, H, W); only the hit pixels are gathered, so no
+    per-layer copies of the ray table are made.
+
+    Args:
+        depths: depth along the ray, shape (..., 1, H, W).
+        normals (optional): normals, shape (..., 3, H, W).
+        colors (optional): colours, shape (..., 3, H, W).
+        hits (optional): a pixel is used where `hits > 0`, shape (..., 1, H, W). Defaults to `depths > 0`.
+        return_batch_index (bool): also return the index along the first dimension of every point.
+        directions (optional): a ray table from `get_ray_directions` on the right device, training
+            loops keep one around instead of looking it up on every step. Torch inputs also accept one
+            table per frame, shape (frames, H, W, 3), e.g. windows of the full-frame table for crops.
+
+    Returns:
+        xyz (N, 3), normals (N, 3) or None, colors (N, 3) or None[, batch_index (N,)]
+    """
+    height, width = depths.shape[-2:]
+    valid = (depths if hits is None else hits)[..., 0, :, :] > 0
+
+    if isinstance(depths, torch.Tensor):
+        if directions is None:
+            directions = get_ray_directions(height, width, camera_angle_x, device=depths.device)
+        assert directions.shape[-3:-1] == (height, width), f"ray table {tuple(directions.shape)} does not match {height}x{width}"
+        # flat gather: one nonzero over all frames, then index the (frames, C, H * W) views directly
+        index = valid.reshape(-1).nonzero().squeeze(1)
+        frame, pixel = index // (height * width), index % (height * width)
+        gather = lambda x: x.reshape(-1, x.shape[-3], height * width)[frame, :, pixel]
+        rays = directions.reshape(-1, 3).index_select(0, pixel if directions.dim() == 3 else index)
+        xyz = rays * depths.reshape(-1).index_select(0, index)[:, None]
+        batch_index = index // valid[0].numel()
+    else:
+        if directions is None:
+            directions = get_ray_directions(height, width, camera_angle_x)
+        index = np.nonzero(valid)
+        gather = lambda x: np.moveaxis(x, -3, -1)[index]
+        xyz = directions[index[-2], index[-1]] * gather(depths)
+        batch_index = index[0]
+
+    normals = gather(normals) if normals is not None else None
+    colors = gather(colors) if colors is not None else None
+
+    if return_batch_index:
+        return xyz, normals, colors, batch_index
+    return xyz, normals, colors
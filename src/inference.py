@@ -0,0 +1,130 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from diffusers.utils import load_image
+from PIL import Image
+from torch.utils.data import Dataset
+
+from src.geometry import xray_to_pcd
+
+try:
+    import open3d as o3d
+except ImportError:
+    o3d = None
+
+
+class ConditionImageDataset(Dataset):
+    """
+    Condition images of the inference scripts, decoded and resized in dataloader workers.
+
+    Items hold the resized image as loaded, the pipeline takes `image.convert("RGB")`. An image
+    whose mask covers less than `min_mask_ratio` of the frame is filtered out: its item is None and
+    `collate_images` drops it.
+
+    Args:
+        size (int): images are resized to (size, size).
+    """
+
+    def __init__(self, image_paths, size, min_mask_ratio=0.05):
+        self.image_paths = image_paths
+        self.size = size
+        self.min_mask_ratio = min_mask_ratio
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        image_path = self.image_paths[idx]
+        image = load_image(image_path).resize((self.size, self.size), Image.BILINEAR)
+        mask = (np.array(image.split()[-1]) > 0).astype(np.float32)
+        if mask.mean() < self.min_mask_ratio:  # filter invalid image
+            return None
+        return {"uid": os.path.basename(image_path).split(".")[0], "image_path": image_path, "image": image}
+
+
+def collate_images(samples):
+    """Batch `ConditionImageDataset` items as lists, without the filtered ones."""
+    samples = [sample for sample in samples if sample is not None]
+    return {key: [sample[key] for sample in samples] for key in ("uid", "image_path", "image")}
+
+
+def lr_xray_to_pcd(outputs, near, far):
+    """
+    Point cloud of a generated low-res (frames, 8, H, W) X-Ray, centred at the origin.
+
+    Depths out of (near, far) are dropped, and so is every hit that is nearer than the one of the
+    previous layer.
+    """
+    outputs = outputs.float()
+    depths = (outputs[:, 0:1].numpy() * 0.5 + 0.5) * (far - near) + near
+    depths[depths <= near] = 0
+    depths[depths >= far] = 0
+    depths_ori = depths.copy()
+    depths[1:] = np.where(depths_ori[1:] < depths_ori[:-1], 0, depths_ori[1:])
+
+    normals = F.normalize(outputs[:, 1:4], dim=1).numpy()
+    colors = outputs[:, 4:7].numpy() * 0.5 + 0.5
+    points, normals, colors = xray_to_pcd(depths, normals, colors)
+    return points - np.mean(points, axis=0), normals, colors
+
+
+def hr_xray_to_pcd(outputs, near, far):
+    """
+    Point cloud of an upsampled (frames, 8, H, W) X-Ray, centred at the origin.
+
+    Only pixels with a positive hit channel and a depth in (near, far) are kept, and no hit that is
+    nearer than the one of the previous layer.
+    """
+    outputs = outputs.float()
+    depths = (outputs[:, 0:1] * 0.5 + 0.5) * (far - near) + near
+    hits = outputs[:, 7:8] > 0
+    depths[~hits] = 0
+    depths[depths <= near] = 0
+    depths[depths >= far] = 0
+    normals = torch.where(hits, F.normalize(outputs[:, 1:4], dim=1), 0)
+    colors = torch.where(hits, outputs[:, 4:7] * 0.5 + 0.5, 0)
+
+    depths = depths.numpy()
+    depths_ori = depths.copy()
+    depths[1:] = np.where(depths_ori[1:] < depths_ori[:-1], 0, depths_ori[1:])
+    points, normals, colors = xray_to_pcd(depths, normals.numpy(), colors.numpy())
+    return points - np.mean(points, axis=0), normals, colors
+
+
+def _write_pcd(path, points, normals, colors):
+    if o3d is None:
+        raise ImportError("Please install open3d to write point clouds: `pip install open3d`")
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points)
+    pcd.normals = o3d.utility.Vector3dVector(normals)
+    pcd.colors = o3d.utility.Vector3dVector(colors[..., :3])
+    o3d.io.write_point_cloud(path, pcd)
+
+
+def save_hr_outputs(outputs, image, prefix, near, far):
+    """
+    Write an upsampled X-Ray as the point cloud `<prefix>_prd.ply` and its condition image as
+    `<prefix>.png` (unless `image` is None).
+
+    Meant to run on a `src.background.BackgroundWriter`, so `outputs` should be a CPU tensor.
+    """
+    if image is not None:
+        image.save(f"{prefix}.png")
+    _write_pcd(f"{prefix}_prd.ply", *hr_xray_to_pcd(outputs, near, far))
+
+
+def save_lr_outputs(outputs, image, prefix, near, far, save_pt=True):
+    """
+    Write a generated low-res X-Ray as `<prefix>.pt`, its condition image as `<prefix>.png` (unless
+    `image` is None) and its point cloud as `<prefix>_prd.ply`, the files `inference_hr.py` and the
+    evaluation read.
+
+    Meant to run on a `src.background.BackgroundWriter`, so `outputs` should be a CPU tensor.
+    """
+    if save_pt:
+        torch.save(outputs, f"{prefix}.pt")
+    if image is not None:
+        image.save(f"{prefix}.png")
+    _write_pcd(f"{prefix}_prd.ply", *lr_xray_to_pcd(outputs, near, far))
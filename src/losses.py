@@ -0,0 +1,241 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from src.geometry import get_ray_directions, xray_to_pcd
+
+try:
+    from pytorch3d.ops import knn_points
+except ImportError:
+    knn_points = None
+
+
+def normal_similarity_loss(points, k=20, k_similarity=10, normalize=False):
+    """
+    Calculate the loss function for normal similarity, which encourages neighboring points to have similar normals.
+    :param points: (B, N, 3) torch.Tensor, point cloud data
+    :param k: int, number of neighboring points used to estimate the normals
+    :param k_similarity: int, number of neighboring points compared with each normal
+    :param normalize: bool, renormalize the estimated normals
+    :return: torch.Tensor, normal similarity loss
+    """
+    if knn_points is None:
+        raise ImportError(
+            "Please install pytorch3d to use the knn normal loss. You can do so by following "
+            "https://github.com/facebookresearch/pytorch3d/blob/main/INSTALL.md, or use `--normal_loss grid`"
+        )
+    B, N, _ = points.shape
+
+    # Perform kNN search using PyTorch3D
+    knn = knn_points(points, points, K=k, return_nn=True)
+    neighbors = knn.knn
+
+    centroid = torch.mean(neighbors, dim=2, keepdim=True)  # B x N x 1 x 3
+    neighbors_centered = neighbors - centroid  # B x N x k x 3
+
+    cov_matrix = torch.matmul(neighbors_centered.transpose(3, 2), neighbors_centered)  # B x N x 3 x 3
+    eigvals, eigvecs = torch.linalg.eigh(cov_matrix)  # B x N x 3 x 3
+
+    normals = eigvecs[:, :, :, 0]  # B x N x 3
+    if normalize:
+        normals = F.normalize(normals, p=2, dim=-1)  # B x N x 3
+
+    # 计算相邻点法向量相似性损失
+    knn = knn_points(points, points, K=k_similarity, return_nn=True)
+    loss = compute_similarity_loss(normals, knn.idx)
+
+    return loss
+
+
+def compute_similarity_loss(normals, knn_idx):
+    """
+    Calculate the loss function for normal similarity, which encourages neighboring points to have similar normals.
+    :param normals: (B, N, 3) torch.Tensor, normal vectors
+    :param knn_idx: (B, N, k) torch.Tensor, k-nearest neighbor indices
+    :return: torch.Tensor, similarity loss
+    """
+    B, N, k = knn_idx.shape
+
+    # Get the normals of neighboring points
+    knn_idx = knn_idx.view(B, -1)  # Flatten the indices
+    neighbor_normals = normals.gather(1, knn_idx.unsqueeze(-1).expand(-1, -1, 3))  # Get neighbor normals
+    neighbor_normals = neighbor_normals.view(B, N, k, 3)  # Reshape back to neighbor normals shape
+
+    # Expand normals
+    normals_expanded = normals.unsqueeze(2).expand(-1, -1, k, -1)  # B x N x k x 3
+
+    # Calculate cosine similarity
+    cos_sim = F.cosine_similarity(normals_expanded, neighbor_normals, dim=-1)  # B x N x k
+
+    # Similarity loss, 1 minus cosine similarity is used as the loss since higher cosine similarity means more similarity
+    similarity_loss = 1 - cos_sim.abs()
+
+    return similarity_loss.mean()
+
+
+def _grid_neighbours(values, frame, y, x, radius):
+    """
+    Gather the (2 * radius + 1) ** 2 image-space neighbours of the pixels (frame, y, x).
+    :param values: (F, H, W, C) torch.Tensor
+    :return: (N, K, C) torch.Tensor, (N, K) bool torch.Tensor that is False outside the image
+    """
+    _, H, W, _ = values.shape
+    offsets = torch.arange(-radius, radius + 1, device=values.device)
+    dy, dx = torch.meshgrid(offsets, offsets, indexing="ij")
+    yy = y[:, None] + dy.reshape(1, -1)
+    xx = x[:, None] + dx.reshape(1, -1)
+    inside = (yy >= 0) & (yy < H) & (xx >= 0) & (xx < W)
+    return values[frame[:, None], yy.clamp(0, H - 1), xx.clamp(0, W - 1)], inside
+
+
+def grid_pca_normals(depths, valid, directions, radius=2, depth_threshold=0.05):
+    """
+    Estimate normals by PCA over image-space neighbourhoods of every layer, the grid analogue of
+    kNN + PCA. Neighbours that are not hits or lie across a depth discontinuity are masked out.
+    :param depths: (F, 1, H, W) torch.Tensor, depth along the ray of every frame (layer)
+    :param valid: (F, 1, H, W) torch.Tensor, pixels used where valid > 0
+    :param directions: (H, W, 3) torch.Tensor, ray directions from `src.geometry.get_ray_directions`,
+        or (F, H, W, 3) with one table per frame
+    :param radius: int, the neighbourhood is (2 * radius + 1) ** 2 pixels
+    :param depth_threshold: float, neighbours whose depth differs more than this are ignored
+    :return: normals (N, 3), (N,) mask of the defined normals, pixel index (frame, y, x) of the N valid pixels
+    """
+    num_frames, _, H, W = depths.shape
+    depth = depths[:, 0]
+    valid = (valid[:, 0] > 0) & (depth > 0)
+    points = depth[..., None] * directions  # F x H x W x 3
+
+    index = valid.reshape(-1).nonzero().squeeze(1)
+    frame, y, x = index // (H * W), (index % (H * W)) // W, index % W
+
+    neighbours, inside = _grid_neighbours(torch.cat([points, depth[..., None], valid[..., None].float()], dim=-1),
+                                          frame, y, x, radius)
+    center_depth = depth[frame, y, x]
+    weight = inside & (neighbours[..., 4] > 0) & ((neighbours[..., 3] - center_depth[:, None]).abs() < depth_threshold)
+    weight = weight.float()
+    count = weight.sum(dim=1)
+
+    neighbours = neighbours[..., :3]
+    centroid = (neighbours * weight[..., None]).sum(dim=1, keepdim=True) / count.clamp(min=1)[:, None, None]  # N x 1 x 3
+    neighbours_centered = (neighbours - centroid) * weight[..., None]  # N x K x 3
+    cov_matrix = torch.matmul(neighbours_centered.transpose(2, 1), neighbours_centered)  # N x 3 x 3
+
+    # the normal is only defined for neighbourhoods that span a plane; the eigh gradient is infinite
+    # for repeated eigenvalues (e.g. collinear neighbours), so those get a zero normal and no gradient
+    with torch.no_grad():
+        eigvals = torch.linalg.eigvalsh(cov_matrix)
+        defined = (count >= 3) & (eigvals[:, 1] - eigvals[:, 0] > 1e-3 * eigvals[:, 2])
+    defined_index = defined.nonzero().squeeze(1)
+    eigvals, eigvecs = torch.linalg.eigh(cov_matrix[defined_index])
+    normals = points.new_zeros(len(index), 3).index_copy(0, defined_index, eigvecs[:, :, 0])
+    return normals, defined, (frame, y, x)
+
+
+def grid_normal_similarity_loss(depths, valid, directions, radius=2, similarity_radius=1, depth_threshold=0.05):
+    """
+    Normal similarity loss on the per-layer pixel grid instead of a kNN graph over the whole batch.
+    Normals come from `grid_pca_normals` and are compared with the normals of the neighbouring
+    pixels of the same layer, so the cost is linear in the number of hits and nothing leaks
+    across samples or layers.
+    :param depths: (F, 1, H, W) torch.Tensor, depth along the ray of every frame (layer)
+    :param valid: (F, 1, H, W) torch.Tensor, pixels used where valid > 0
+    :param directions: (H, W, 3) torch.Tensor, ray directions from `src.geometry.get_ray_directions`,
+        or (F, H, W, 3) with one table per frame
+    :return: torch.Tensor, normal similarity loss
+    """
+    num_frames, _, H, W = depths.shape
+    normals, defined, (frame, y, x) = grid_pca_normals(depths, valid, directions, radius, depth_threshold)
+    if not defined.any():
+        return depths.sum() * 0
+
+    index = (frame * H + y) * W + x
+    normal_map = depths.new_zeros(num_frames * H * W, 4).index_copy(
+        0, index, torch.cat([normals, defined[:, None].float()], dim=-1))
+    depth_map = depths[:, 0].reshape(-1, 1)
+    neighbours, inside = _grid_neighbours(torch.cat([normal_map, depth_map], dim=-1).view(num_frames, H, W, 5),
+                                          frame, y, x, similarity_radius)
+    weight = inside & (neighbours[..., 3] > 0) & defined[:, None]
+    weight = weight & ((neighbours[..., 4] - depth_map[index]).abs() < depth_threshold)
+    weight = weight.float()
+
+    cos_sim = F.cosine_similarity(normals[:, None].expand_as(neighbours[..., :3]), neighbours[..., :3], dim=-1)  # N x K
+    similarity_loss = (1 - cos_sim.abs()) * weight
+    return similarity_loss.sum() / weight.sum().clamp(min=1)
+
+
+class XRayLoss(nn.Module):
+    """
+    Training loss of the X-Ray VAE and upsampler: hit BCE, surface MSE on the target hits and the
+    normal consistency term of the predicted depths, computed in one pass.
+
+    The dense part uses masked reductions and `torch.where` instead of boolean gathers and in-place
+    masked assignments, so its shapes are static and it can be wrapped with `torch.compile`. Only the
+    normal term gathers the hit pixels (its size depends on the prediction) and stays eager.
+    """
+
+    def __init__(self, height, width, near, far, normal_loss="knn", normal_weight=0.001, knn_kwargs=None,
+                 compile=False):
+        """
+        :param height, width: int, full-frame resolution of the X-Rays
+        :param near, far: float, depth range the depth channel is normalized with
+        :param normal_loss: str, `knn` (needs pytorch3d) or `grid`, see `grid_normal_similarity_loss`
+        :param normal_weight: float, weight of the normal consistency term
+        :param knn_kwargs: dict, keyword arguments of `normal_similarity_loss`
+        :param compile: bool, compile the dense part with `torch.compile`
+        """
+        super().__init__()
+        assert normal_loss in ("knn", "grid"), f"unknown normal loss {normal_loss}"
+        self.near, self.far = near, far
+        self.normal_loss = normal_loss
+        self.normal_weight = normal_weight
+        self.knn_kwargs = knn_kwargs or {}
+        self.register_buffer("directions", get_ray_directions(height, width, device="cpu").clone(), persistent=False)
+        self.dense_terms = torch.compile(self._dense_terms, dynamic=False) if compile else self._dense_terms
+
+    def _dense_terms(self, model_pred, xray):
+        target_hits = xray[:, :, -1:]
+        hit_loss = F.binary_cross_entropy_with_logits(model_pred[:, :, -1:], target_hits * 0.5 + 0.5)
+
+        # mean over the hit pixels of all 7 surface channels, without materializing the gathered values
+        mask = (target_hits > 0).to(model_pred.dtype)
+        squared_error = (model_pred[:, :, :-1] - xray[:, :, :-1]).square() * mask
+        surface_loss = squared_error.sum() / (mask.sum() * squared_error.shape[2]).clamp(min=1)
+
+        # predicted depth, zero where the prediction is no hit or leaves the (near, far) range
+        depths = (model_pred[:, :, 0:1] * 0.5 + 0.5) * (self.far - self.near) + self.near
+        hits = (model_pred[:, :, -1:] > 0).detach()
+        depths = torch.where(hits & (depths > self.near) & (depths < self.far), depths, torch.zeros_like(depths))
+        return hit_loss, surface_loss, depths, hits.to(depths.dtype)
+
+    def forward(self, model_pred, xray, offsets=None, frame_size=None):
+        """
+        :param model_pred: (B, F, 8, H, W) torch.Tensor, predicted X-Ray with the hit logit last
+        :param xray: (B, F, 8, H, W) torch.Tensor, target X-Ray with the hit channel in [-1, 1] last
+        :param offsets: (B, 2) torch.Tensor, optional (y, x) position of the inputs in the full frame
+            when training on crops (`sample["crop"]` of the datasets), the rays are unprojected from there
+        :param frame_size: int, optional size of the full frame of the crops when it is not the
+            resolution the module was built for, e.g. during a progressive-resolution schedule
+        :return: hit_loss, surface_loss, weighted normal_loss
+        """
+        hit_loss, surface_loss, depths, hits = self.dense_terms(model_pred.float(), xray.float())
+
+        num_frames, height, width = depths.shape[1], depths.shape[-2], depths.shape[-1]
+        frame = (height, width) if offsets is None else tuple(self.directions.shape[:2])
+        if frame_size is not None:
+            frame = (frame_size, frame_size)
+        directions = self.directions
+        if frame != tuple(directions.shape[:2]):
+            directions = get_ray_directions(*frame, device=directions.device)
+        if offsets is not None:
+            # the window of the full-frame ray table under every crop, repeated for its frames
+            rows = offsets[:, 0, None] + torch.arange(height, device=offsets.device)
+            cols = offsets[:, 1, None] + torch.arange(width, device=offsets.device)
+            directions = directions[rows[:, :, None], cols[:, None, :]].repeat_interleave(num_frames, dim=0)
+        depths = depths.reshape(-1, 1, height, width)
+        hits = hits.reshape(-1, 1, height, width)
+        if self.normal_loss == "grid":
+            normal_loss = grid_normal_similarity_loss(depths, hits, directions)
+        else:
+            points, _, _ = xray_to_pcd(depths, hits=hits, directions=directions)
+            normal_loss = normal_similarity_loss(points[None], **self.knn_kwargs)
+        return hit_loss, surface_loss, self.normal_weight * normal_loss
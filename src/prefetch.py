@@ -0,0 +1,98 @@
+import torch
+
+
+class DevicePrefetcher:
+    """
+    Wraps a dataloader so that its batches arrive on `device`, with floating point tensors cast to
+    `dtype` there.
+
+    On CUDA the host-to-device copy of the next batch is issued on a side stream from pinned
+    memory while the current step runs, and the cast runs on the device instead of the CPU. Use
+    it with `pin_memory=True` dataloaders, batches that are not pinned are pinned here, on the
+    main thread. Without CUDA it is a plain iterator that moves and casts every batch. The
+    `end_of_dataloader` flag of a dataloader prepared by accelerate is that of the yielded batch, not
+    of the one read ahead, so `accelerator.accumulate` syncs at the true end of the epoch.
+
+    Args:
+        keep_on_cpu (tuple): keys of batch entries that stay on the host, e.g. values read with
+            `int(...)` in the training step, which would otherwise synchronize the device.
+    """
+
+    def __init__(self, loader, device, dtype=None, keep_on_cpu=()):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.keep_on_cpu = set(keep_on_cpu)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, value, key=None):
+        if isinstance(value, torch.Tensor):
+            if key in self.keep_on_cpu:
+                return value
+            if self.stream is not None and not value.is_pinned():
+                value = value.pin_memory()
+            value = value.to(self.device, non_blocking=True)
+            if self.dtype is not None and value.is_floating_point():
+                value = value.to(self.dtype)
+            return value
+        if isinstance(value, dict):
+            return {k: self._to_device(v, k) for k, v in value.items()}
+        if isinstance(value, (list, tuple)) and any(isinstance(v, torch.Tensor) for v in value):
+            return type(value)(self._to_device(v, key) for v in value)
+        return value
+
+    def _preload(self, iterator):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None, False
+        # a dataloader prepared by accelerate flags its last batch as soon as it is fetched
+        end = getattr(self.loader, "end_of_dataloader", False)
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch), end
+
+    def _set_end_of_dataloader(self, end):
+        # `accelerator.accumulate` syncs the gradients early when the flag is set, restore the one of the yielded batch
+        if hasattr(self.loader, "end_of_dataloader"):
+            self.loader.end_of_dataloader = end
+
+    def _record_stream(self, value, stream):
+        # the tensors were allocated on the side stream, keep the allocator from reusing their memory
+        # before the work queued on `stream` is done with them
+        if isinstance(value, torch.Tensor):
+            if value.device.type == "cuda":
+                value.record_stream(stream)
+        elif isinstance(value, dict):
+            for v in value.values():
+                self._record_stream(v, stream)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                self._record_stream(v, stream)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self._to_device(batch)
+            return
+
+        iterator = iter(self.loader)
+        next_batch, next_end = self._preload(iterator)
+        while next_batch is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_stream(self.stream)
+            batch, end = next_batch, next_end
+            self._record_stream(batch, stream)
+            if end:
+                # reading past the last batch would end accelerate's gradient state of the dataloader during its step
+                next_batch = None
+            else:
+                # issue the copy of the following batch before the step on this one starts
+                next_batch, next_end = self._preload(iterator)
+            self._set_end_of_dataloader(end)
+            yield batch
+        # let the dataloader finish its epoch
+        for _ in iterator:
+            pass
@@ -0,0 +1,130 @@
+import collections
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+
+class StepTimer:
+    """
+    Per-phase timing of a training loop.
+
+    The loop calls `lap(name)` at the end of every phase; the time since the previous lap (or since
+    the end of the previous step for the first phase, i.e. the dataloader wait) is attributed to
+    `name`. `end_step(global_step)` closes the step and attributes the rest of it to "other".
+    Each phase gets its wall time and, on CUDA, the time between CUDA events recorded on the
+    current stream at the laps; wall times of asynchronous kernels only show launch cost, the
+    event times show what the GPU spent. Events are resolved once they completed, so the timer
+    never synchronizes the device.
+
+    `summary()` returns p50 / p90 / p99 of the last `window` steps for `accelerator.log`. With
+    `trace_steps=(start, end)` the phases of the global steps in [start, end) are written as a
+    Chrome trace (chrome://tracing, Perfetto) to `trace_path` once the step `end` is reached.
+
+    A disabled timer returns from every call right away.
+    """
+
+    def __init__(self, enabled=False, window=100, trace_steps=None, trace_path=None, device=None, process_index=0):
+        self.enabled = enabled or trace_steps is not None
+        self.trace_steps = trace_steps
+        self.trace_path = trace_path
+        self.process_index = process_index
+        self.cuda = device is not None and torch.device(device).type == "cuda" and torch.cuda.is_available()
+        self.wall_ms = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.cuda_ms = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.trace_events = []
+        self._pending = collections.deque()  # (phase, start event, end event, trace) waiting for the GPU
+        self._trace_reference = None  # (wall time, CUDA event) the CUDA timeline of the trace is aligned to
+        self._step_start = None
+        self._last_wall = None
+        self._last_event = None
+        self._step_phases = []
+        if self.enabled:
+            self._reset_reference()
+
+    def _record_event(self):
+        event = torch.cuda.Event(enable_timing=True)
+        event.record()
+        return event
+
+    def _reset_reference(self):
+        self._last_wall = time.perf_counter()
+        self._last_event = self._record_event() if self.cuda else None
+        self._step_start = self._last_wall
+
+    def _in_trace(self, global_step):
+        return self.trace_steps is not None and self.trace_steps[0] <= global_step < self.trace_steps[1]
+
+    def lap(self, name):
+        """Close the phase `name`, which ran since the previous lap."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        event = self._record_event() if self.cuda else None
+        self._step_phases.append((name, self._last_wall, now, self._last_event, event))
+        self._last_wall, self._last_event = now, event
+
+    def _resolve(self, block=False):
+        while len(self._pending) > 0:
+            name, start, end, trace = self._pending[0]
+            if not block and not end.query():
+                break
+            if block:
+                end.synchronize()
+            self._pending.popleft()
+            ms = start.elapsed_time(end)
+            self.cuda_ms[name].append(ms)
+            if trace:
+                reference_wall, reference_event = self._trace_reference
+                self.trace_events.append({
+                    "name": name, "ph": "X", "pid": self.process_index, "tid": 1,
+                    "ts": 1e6 * reference_wall + 1e3 * reference_event.elapsed_time(start), "dur": 1e3 * ms,
+                })
+
+    def end_step(self, global_step):
+        """Close the step, call once per iteration of the training loop."""
+        if not self.enabled:
+            return
+        # whatever ran after the last phase, e.g. progress bar updates and `.item()` syncs
+        self.lap("other")
+        trace = self._in_trace(global_step)
+        if trace and self.cuda and self._trace_reference is None and len(self._step_phases) > 0:
+            self._trace_reference = (self._step_start, self._step_phases[0][3])
+        for name, start, end, start_event, end_event in self._step_phases:
+            self.wall_ms[name].append(1e3 * (end - start))
+            if trace:
+                self.trace_events.append({"name": name, "ph": "X", "pid": self.process_index, "tid": 0,
+                                          "ts": 1e6 * start, "dur": 1e6 * (end - start)})
+            if self.cuda and start_event is not None:
+                self._pending.append((name, start_event, end_event, trace))
+        self.wall_ms["step"].append(1e3 * (self._last_wall - self._step_start))
+        self._step_phases = []
+        self._step_start = self._last_wall
+        self._resolve()
+        if self.trace_steps is not None and global_step >= self.trace_steps[1] and self.trace_path is not None:
+            self.save_trace()
+
+    def summary(self, prefix="time"):
+        """p50 / p90 / p99 in milliseconds of every phase over the window, e.g. {"time/forward_p50": 12.3, ...}."""
+        logs = {}
+        for kind, values in [("", self.wall_ms), ("cuda_", self.cuda_ms)]:
+            for name, ms in values.items():
+                if len(ms) == 0:
+                    continue
+                p50, p90, p99 = np.percentile(np.asarray(ms), [50, 90, 99])
+                logs.update({f"{prefix}/{kind}{name}_p50": float(p50), f"{prefix}/{kind}{name}_p90": float(p90),
+                             f"{prefix}/{kind}{name}_p99": float(p99)})
+        return logs
+
+    def save_trace(self):
+        """Write the traced steps as a Chrome trace, waiting for their CUDA events."""
+        self._resolve(block=True)
+        os.makedirs(os.path.dirname(os.path.abspath(self.trace_path)), exist_ok=True)
+        names = [{"name": "thread_name", "ph": "M", "pid": self.process_index, "tid": tid, "args": {"name": name}}
+                 for tid, name in [(0, "wall"), (1, "cuda")]]
+        with open(self.trace_path, "w") as f:
+            json.dump({"traceEvents": names + self.trace_events, "displayTimeUnit": "ms"}, f)
+        self.trace_events = []
+        self.trace_steps = None
@@ -0,0 +1,133 @@
+import numpy as np
+import trimesh
+from PIL import Image
+
+try:
+    # embree BVH, what `preprocess/get_xray` renders the datasets with
+    from trimesh.ray.ray_pyembree import RayMeshIntersector
+except ImportError:
+    from trimesh.ray.ray_triangle import RayMeshIntersector
+
+from src.geometry import CAMERA_ANGLE_X, get_ray_directions
+
+# distance of the rendering cameras to the origin, see preprocess/render/blender_script.py
+CAMERA_DISTANCE = 1.2
+# polar angles of the rendered views, from the top views (pi / 3) down to the horizon
+POLAR_RANGE = (np.pi / 3, np.pi / 2)
+
+
+def normalize_mesh(mesh):
+    """
+    Bring a loaded `.glb` into the frame the dataset cameras look at, as `gen_objaverse.py` does:
+    y-up to z-up, unit extent, centred at the origin, with per-face colours.
+
+    Returns:
+        vertices (float32, (V, 3)), faces (int32, (F, 3)), face_colors (uint8, (F, 3)).
+    """
+    vertices = np.array(mesh.vertices, dtype=np.float64)
+    vertices[:, [1, 2]] = vertices[:, [2, 1]]
+    vertices[:, 1] *= -1
+    vertices /= np.max(np.abs(vertices.max(0) - vertices.min(0)))
+    vertices -= (vertices.max(0) + vertices.min(0)) / 2
+
+    visual = mesh.visual.to_color() if mesh.visual.kind == "texture" else mesh.visual
+    face_colors = np.asarray(visual.face_colors)
+    if face_colors.ndim == 1:
+        face_colors = np.tile(face_colors[None], (len(mesh.faces), 1))
+    return vertices.astype(np.float32), np.asarray(mesh.faces, dtype=np.int32), face_colors[:, :3].astype(np.uint8)
+
+
+def look_at(azimuth, polar, distance=CAMERA_DISTANCE):
+    """
+    Camera-to-world matrix (3, 4) of a camera on the sphere of radius `distance`, looking at the
+    origin with the world z axis up, the camera placement of `blender_script.py`.
+    """
+    eye = distance * np.array([np.sin(polar) * np.cos(azimuth), np.sin(polar) * np.sin(azimuth), np.cos(polar)])
+    back = eye / np.linalg.norm(eye)  # the camera looks down its -z
+    right = np.cross([0.0, 0.0, 1.0], back)
+    if np.linalg.norm(right) < 1e-6:
+        # straight above or below, any azimuth-aligned right vector will do
+        right = np.array([-np.sin(azimuth), np.cos(azimuth), 0.0])
+    right = right / np.linalg.norm(right)
+    up = np.cross(back, right)
+    return np.stack([right, up, back, eye], axis=1)
+
+
+def sample_camera(rng, polar_range=POLAR_RANGE, distance=CAMERA_DISTANCE):
+    """A random `look_at` camera, uniform in azimuth and in polar angle within `polar_range`."""
+    return look_at(rng.uniform(0, 2 * np.pi), rng.uniform(*polar_range), distance)
+
+
+class MeshCaster:
+    """
+    A normalized mesh with its BVH, renders X-Rays and condition images from any camera.
+
+    The BVH is built once, in the constructor, in world space; rays are moved into the world
+    frame instead of the mesh into the camera frame, so every view of a mesh reuses it. The
+    per-hit results are sorted along their rays and scattered into the layers with array ops.
+
+    Args:
+        vertices, faces, face_colors: as returned by `normalize_mesh`.
+    """
+
+    def __init__(self, vertices, faces, face_colors):
+        self.mesh = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+        self.face_normals = np.asarray(self.mesh.face_normals, dtype=np.float32)
+        self.face_colors = np.asarray(face_colors, dtype=np.float32)[:, :3] / 255.0
+        self.intersector = RayMeshIntersector(self.mesh)
+
+    @classmethod
+    def load(cls, path):
+        """Load a mesh written by `scripts/prepare_meshes.py`."""
+        with np.load(path) as data:
+            return cls(data["vertices"], data["faces"], data["face_colors"])
+
+    def _rays(self, c2w, height, width, camera_angle_x):
+        directions = get_ray_directions(height, width, camera_angle_x).reshape(-1, 3)
+        rays_d = directions @ c2w[:3, :3].T
+        rays_o = np.broadcast_to(c2w[:3, 3], rays_d.shape)
+        return rays_o, rays_d
+
+    def xray(self, c2w, height=256, width=256, num_layers=16, camera_angle_x=CAMERA_ANGLE_X):
+        """
+        Raw X-Ray of a view, the layout of the dataset `.npz` files.
+
+        Returns:
+            float32 array of shape (num_layers, 7, height, width): depth along the ray, normal in the
+            camera frame and colour in [0, 1] of the first `num_layers` hits of every pixel.
+        """
+        c2w = np.asarray(c2w, dtype=np.float64)
+        rays_o, rays_d = self._rays(c2w, height, width, camera_angle_x)
+        faces, rays, points = self.intersector.intersects_id(
+            ray_origins=rays_o, ray_directions=rays_d, multiple_hits=True, return_locations=True)
+        xray = np.zeros((num_layers, height * width, 7), dtype=np.float32)
+        if len(rays) > 0:
+            depth = np.linalg.norm(points - c2w[:3, 3], axis=1)
+            order = np.lexsort((depth, rays))
+            faces, rays, depth = faces[order], rays[order], depth[order]
+            # index of every hit along its ray
+            starts = np.flatnonzero(np.r_[True, rays[1:] != rays[:-1]])
+            layer = np.arange(len(rays)) - np.repeat(starts, np.diff(np.r_[starts, len(rays)]))
+            keep = layer < num_layers
+            faces, rays, depth, layer = faces[keep], rays[keep], depth[keep], layer[keep]
+
+            xray[layer, rays, 0] = depth
+            # world to camera frame, R^T n for row vectors
+            xray[layer, rays, 1:4] = self.face_normals[faces] @ c2w[:3, :3].astype(np.float32)
+            xray[layer, rays, 4:7] = self.face_colors[faces]
+        return np.ascontiguousarray(xray.reshape(num_layers, height, width, 7).transpose(0, 3, 1, 2))
+
+    def image(self, c2w, size=512, camera_angle_x=CAMERA_ANGLE_X, ambient=0.3):
+        """
+        RGBA condition image of a view: face colours of the first hit under a headlight, on a
+        transparent black background like the Blender renders.
+        """
+        c2w = np.asarray(c2w, dtype=np.float64)
+        rays_o, rays_d = self._rays(c2w, size, size, camera_angle_x)
+        faces = self.intersector.intersects_first(ray_origins=rays_o, ray_directions=rays_d)
+        hit = faces >= 0
+        shade = np.abs(np.einsum("ij,ij->i", self.face_normals[faces[hit]], rays_d[hit]))
+        rgba = np.zeros((size * size, 4), dtype=np.float32)
+        rgba[hit, :3] = self.face_colors[faces[hit]] * (ambient + (1 - ambient) * shade[:, None])
+        rgba[hit, 3] = 1
+        return Image.fromarray((rgba.reshape(size, size, 4) * 255).round().astype(np.uint8), mode="RGBA")
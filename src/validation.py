@@ -0,0 +1,100 @@
+import os
+
+import torch
+import torch.nn.functional as F
+import torchvision
+from PIL import Image
+
+from src.background import to_host
+from src.geometry import xray_to_pcd
+
+try:
+    import open3d as o3d
+except ImportError:
+    o3d = None
+
+
+def save_images(images, output_dir):
+    """
+    Write {name: (N, C, H, W) tensor} as normalized image grids `<output_dir>/<name>.png`, e.g. the
+    training sample dumps. Meant to run on a `src.background.BackgroundWriter`, like `save_xray`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for name, image in images.items():
+        torchvision.utils.save_image(image.float(), os.path.join(output_dir, f"{name}.png"), normalize=True, nrow=4)
+
+
+def save_xray(xray, prefix, near, far, images=True, point_cloud=True, depth_hits=False):
+    """
+    Write a generated (frames, 8, H, W) X-Ray in the normalized training layout as
+    `<prefix>_{depths,normals,colors}.png` and `<prefix>.ply`.
+
+    Meant to run on a `src.background.BackgroundWriter`, so `xray` should be a CPU tensor.
+    With `depth_hits` the points are the pixels whose depth lies in (near, far) instead of those
+    with a positive hit channel, for inputs without a meaningful one (e.g. noisy low-res X-Rays).
+    """
+    xray = xray.float().clip(-1, 1)
+    if images:
+        torchvision.utils.save_image(xray[:, 0:1], f"{prefix}_depths.png", normalize=True, nrow=4)
+        torchvision.utils.save_image(xray[:, 1:4], f"{prefix}_normals.png", normalize=True, nrow=4)
+        torchvision.utils.save_image(xray[:, 4:7], f"{prefix}_colors.png", normalize=True, nrow=4)
+    if point_cloud:
+        if o3d is None:
+            raise ImportError("Please install open3d to write point clouds: `pip install open3d`")
+        depths = (xray[:, 0:1].numpy() * 0.5 + 0.5) * (far - near) + near
+        if not depth_hits:
+            depths[xray[:, -1:].numpy() < 0] = 0
+        depths[depths <= near] = 0
+        depths[depths >= far] = 0
+        normals = F.normalize(xray[:, 1:4], dim=1).numpy()
+        colors = xray[:, 4:7].numpy() * 0.5 + 0.5
+        points, normals, colors = xray_to_pcd(depths, normals, colors)
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(points)
+        pcd.normals = o3d.utility.Vector3dVector(normals)
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+        o3d.io.write_point_cloud(f"{prefix}.ply", pcd)
+
+
+class DiffusionValidator:
+    """
+    Validation of `train_diffusion.py`.
+
+    The pipeline is built once from the live training modules (so the weights it samples with are
+    always the current ones, EMA swaps included) and the validation images are loaded once. Every
+    call generates all validation images in one batched pipeline call and hands the PNG / PLY writes
+    to `writer`, a `src.background.BackgroundWriter`.
+    """
+
+    def __init__(self, pipeline, image_paths, output_dir, height, width, num_frames, near, far, writer):
+        self.pipeline = pipeline
+        self.pipeline.set_progress_bar_config(disable=True)
+        self.output_dir = output_dir
+        self.height, self.width = height, width
+        self.num_frames = num_frames
+        self.near, self.far = near, far
+        self.writer = writer
+        # the pipeline conditions on images at 8x the resolution of what the unet denoises
+        size = (width // pipeline.xray_vae_scale_factor * 8, height // pipeline.xray_vae_scale_factor * 8)
+        self.images = [Image.open(image_path).convert("RGB").resize(size) for image_path in image_paths]
+        os.makedirs(output_dir, exist_ok=True)
+
+    @torch.no_grad()
+    def __call__(self, global_step):
+        outputs = self.pipeline(
+            self.images,
+            height=self.height,
+            width=self.width,
+            num_frames=self.num_frames,
+            decode_chunk_size=8,
+            motion_bucket_id=127,
+            fps=7,
+            noise_aug_strength=0.0,
+            output_type="latent",
+        ).frames
+        # one device to host copy for the whole batch, everything after it runs on the writer thread
+        outputs = to_host(outputs.clip(-1, 1).float())
+        for val_img_idx, (image, xray) in enumerate(zip(self.images, outputs)):
+            prefix = os.path.join(self.output_dir, f"step_{global_step}_val_img_{val_img_idx}")
+            self.writer.submit(image.save, f"{prefix}_original.png")
+            self.writer.submit(save_xray, xray, prefix, self.near, self.far)
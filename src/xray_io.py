@@ -0,0 +1,336 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+XRAY_SHAPE = (16, 1+3+3, 256, 256)
+CODECS = ["zlib", "zstd", "lz4", "none", "quant"]
+LOSSY_CODECS = ["quant"]
+
+
+def _import_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "Please install zstandard to use the zstd X-Ray codec. You can do so by running `pip install zstandard`"
+        )
+    return zstandard
+
+
+def _import_lz4():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise ImportError(
+            "Please install lz4 to use the lz4 X-Ray codec. You can do so by running `pip install lz4`"
+        )
+    return lz4.frame
+
+
+def compress(buffer, codec, level=None):
+    if codec == "zstd":
+        zstandard = _import_zstd()
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(buffer)
+    elif codec == "lz4":
+        lz4_frame = _import_lz4()
+        return lz4_frame.compress(buffer, compression_level=0 if level is None else level)
+    elif codec == "none":
+        return bytes(buffer)
+    raise ValueError(f"unknown codec {codec}, choose from {CODECS}")
+
+
+def decompress(buffer, codec):
+    if codec == "zstd":
+        zstandard = _import_zstd()
+        return zstandard.ZstdDecompressor().decompress(buffer)
+    elif codec == "lz4":
+        lz4_frame = _import_lz4()
+        return lz4_frame.decompress(buffer)
+    elif codec == "none":
+        return buffer
+    raise ValueError(f"unknown codec {codec}, choose from {CODECS}")
+
+
+# one decode pool per process, dataloader workers are forked after the parent may have created one
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(num_threads):
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid() or _pool._max_workers < num_threads:
+            if _pool is not None and _pool_pid == os.getpid():
+                # a larger pool replaces it, its threads exit once their pending decodes are done
+                _pool.shutdown(wait=False)
+            _pool = ThreadPoolExecutor(max_workers=num_threads)
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def _to_csr(matrix):
+    # same arrays as scipy's csr_matrix, but without its dtype restrictions (the ShapeNet X-Rays are float16)
+    rows, indices = np.nonzero(matrix)
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=matrix.shape[0]))
+    return matrix[rows, indices], indices.astype(np.int32), indptr, matrix.shape
+
+
+def _from_csr(data, indices, indptr, shape, num_rows=None):
+    # dense array of the first `num_rows` rows of CSR arrays, the rest stay zero; any dtype, unlike csr_matrix.toarray
+    num_rows = shape[0] if num_rows is None else min(num_rows, shape[0])
+    dense = np.zeros(shape, dtype=data.dtype)
+    end = indptr[num_rows]
+    rows = np.repeat(np.arange(num_rows), np.diff(indptr[:num_rows + 1]))
+    dense[rows, indices[:end]] = data[:end]
+    return dense
+
+
+def _encode_indices(indices):
+    # column indices are sorted within a layer: delta coding plus a byte shuffle turns them into long zero runs
+    deltas = np.diff(indices.astype(np.int32), prepend=np.int32(0)).astype(np.int32)
+    return deltas.view(np.uint8).reshape(-1, 4).T.tobytes()
+
+
+def _decode_indices(buffer):
+    deltas = np.frombuffer(buffer, dtype=np.uint8).reshape(4, -1).T.copy().view(np.int32).reshape(-1)
+    return np.cumsum(deltas, dtype=np.int32)
+
+
+def _pack_chunks(chunks):
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in chunks])
+    return np.frombuffer(b"".join(chunks), dtype=np.uint8), offsets
+
+
+def pack_occupancy(xray):
+    """Bit-pack the hit mask (depth > 0) of an X-Ray, one row of H * W / 8 bytes per layer."""
+    hit = np.asarray(xray)[:, 0] > 0
+    return np.packbits(hit.reshape(hit.shape[0], -1), axis=1)
+
+
+def unpack_occupancy(occupancy, height, width, num_layers=None):
+    occupancy = occupancy.reshape(occupancy.shape[0], -1)[:num_layers]
+    return np.unpackbits(occupancy, axis=1, count=height * width).reshape(-1, height, width).astype(bool)
+
+
+def octahedral_encode(normals):
+    """Map unit vectors of shape (N, 3) to the octahedral square [-1, 1]^2."""
+    normals = normals / np.maximum(np.abs(normals).sum(axis=-1, keepdims=True), 1e-12)
+    uv = normals[:, :2].copy()
+    lower = normals[:, 2] < 0
+    sign = np.where(uv[lower] >= 0, 1.0, -1.0)
+    uv[lower] = (1 - np.abs(uv[lower][:, ::-1])) * sign
+    return uv
+
+
+def octahedral_decode(uv):
+    """Inverse of `octahedral_encode`, returns unit vectors of shape (N, 3)."""
+    z = 1 - np.abs(uv).sum(axis=-1)
+    t = np.maximum(-z, 0)
+    xy = uv - np.where(uv >= 0, t[:, None], -t[:, None])
+    normals = np.concatenate([xy, z[:, None]], axis=-1)
+    return normals / np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-12)
+
+
+def _save_quantized(path, xray, depth_range, normal_bits):
+    # only hit pixels (depth > 0) are stored, in (layer, row, column) order of the occupancy mask
+    hit = xray[:, 0] > 0
+    values = xray.transpose(0, 2, 3, 1)[hit].astype(np.float32)  # [N, 7]
+    depth, normals, colors = values[:, 0], values[:, 1:4], values[:, 4:7]
+
+    # the range grows to cover depths outside [near, far] instead of clipping them
+    near = min(depth_range[0], float(depth.min())) if len(depth) else depth_range[0]
+    far = max(depth_range[1], float(depth.max())) if len(depth) else depth_range[1]
+    depth = np.round((depth - near) / (far - near) * 65535).astype(np.uint16)
+
+    normal_max = 2 ** normal_bits - 1
+    normals = np.round((octahedral_encode(normals) * 0.5 + 0.5) * normal_max)
+    normals = normals.astype(np.uint8 if normal_bits == 8 else np.uint16)
+
+    colors = np.round(np.clip(colors, 0, 1) * 255).astype(np.uint8)
+
+    np.savez_compressed(path,
+                        codec=np.array("quant"),
+                        xray_shape=np.array(xray.shape),
+                        dtype=np.array(xray.dtype.str),
+                        occupancy=pack_occupancy(xray),
+                        depth_range=np.array([near, far], dtype=np.float64),
+                        depth=depth,
+                        normals=normals,
+                        colors=colors)
+
+
+def _load_quantized(loaded_data, num_layers=None):
+    xray_shape = tuple(loaded_data["xray_shape"])
+    hit = np.zeros(xray_shape[:1] + xray_shape[2:], dtype=bool)
+    decoded_hit = unpack_occupancy(loaded_data["occupancy"], *xray_shape[2:], num_layers=num_layers)
+    hit[:len(decoded_hit)] = decoded_hit
+    num_hits = int(hit.sum())
+
+    near, far = loaded_data["depth_range"]
+    depth = loaded_data["depth"][:num_hits].astype(np.float32) / 65535 * (far - near) + near
+    normals = loaded_data["normals"][:num_hits]
+    normals = octahedral_decode(normals.astype(np.float32) / np.iinfo(normals.dtype).max * 2 - 1)
+    colors = loaded_data["colors"][:num_hits].astype(np.float32) / 255
+
+    # channel-major scatter with flat indices, much cheaper than boolean indexing of a (layers, H, W, 7) array
+    index = np.flatnonzero(hit)
+    dense = np.zeros((xray_shape[1], hit.size), dtype=np.dtype(str(loaded_data["dtype"])))
+    dense[0, index] = depth
+    dense[1:4, index] = normals.T
+    dense[4:7, index] = colors.T
+    return dense.reshape(xray_shape[1:2] + xray_shape[:1] + xray_shape[2:]).transpose(1, 0, 2, 3)
+
+
+def save_xray(path, xray, codec="zlib", level=None, depth_range=(0.6, 1.8), normal_bits=16):
+    """
+    Save an X-Ray array of shape (layers, 7, H, W) as a sparse `.npz` container.
+
+    The "zlib" codec writes the original `np.savez_compressed` layout. The "zstd", "lz4" and "none"
+    codecs compress every layer of the CSR matrix independently so that layers can be decoded in
+    parallel; the column indices of a layer are delta coded and byte shuffled before compression.
+
+    Every container also carries the bit-packed hit mask of each layer (`occupancy`, 8 KB per
+    layer at 256x256), which `load_occupancy` reads without touching the rest of the file.
+
+    The lossy "quant" codec stores an occupancy bit mask plus, for every hit, the depth as uint16
+    relative to `depth_range`, the normal as two octahedral coordinates of `normal_bits` (8 or 16)
+    bits and the colour as uint8.
+    """
+    xray = np.asarray(xray)
+    if codec == "quant":
+        if normal_bits not in (8, 16):
+            raise ValueError(f"normal_bits must be 8 or 16, got {normal_bits}")
+        _save_quantized(path, xray, depth_range, normal_bits)
+        return
+
+    data, indices, indptr, shape = _to_csr(xray.reshape(xray.shape[0], -1))
+
+    if codec == "zlib":
+        # original keys plus the extras, readers of the original layout ignore the extras
+        np.savez_compressed(path,
+                            data=data,
+                            indices=indices,
+                            indptr=indptr,
+                            shape=shape,
+                            xray_shape=np.array(xray.shape),
+                            occupancy=pack_occupancy(xray))
+        return
+
+    data_chunks, indices_chunks = [], []
+    for i in range(xray.shape[0]):
+        data_chunks.append(compress(data[indptr[i]:indptr[i + 1]].tobytes(), codec, level))
+        indices_chunks.append(compress(_encode_indices(indices[indptr[i]:indptr[i + 1]]), codec, level))
+    data, data_offsets = _pack_chunks(data_chunks)
+    indices, indices_offsets = _pack_chunks(indices_chunks)
+
+    # the payload is already compressed, so the container itself is stored uncompressed
+    np.savez(path,
+             codec=np.array(codec),
+             xray_shape=np.array(xray.shape),
+             dtype=np.array(xray.dtype.str),
+             indptr=indptr,
+             shape=np.array(shape),
+             data=data,
+             data_offsets=data_offsets,
+             indices=indices,
+             indices_offsets=indices_offsets,
+             occupancy=pack_occupancy(xray))
+
+
+def encode_xray(xray, codec="zlib", level=None, **kwargs):
+    """Encode an X-Ray array into the bytes of an `.npz` container."""
+    buffer = io.BytesIO()
+    save_xray(buffer, xray, codec=codec, level=level, **kwargs)
+    return buffer.getvalue()
+
+
+def _decode_layer(dense, i, data, data_offsets, indices, indices_offsets, codec):
+    layer_data = decompress(data[data_offsets[i]:data_offsets[i + 1]].tobytes(), codec)
+    layer_indices = decompress(indices[indices_offsets[i]:indices_offsets[i + 1]].tobytes(), codec)
+    dense[i, _decode_indices(layer_indices)] = np.frombuffer(layer_data, dtype=dense.dtype)
+
+
+def load_xray(xray_path, num_threads=1, num_layers=None):
+    """
+    Load an X-Ray container written by `save_xray` (or by the original generators).
+
+    Args:
+        xray_path (str or file-like): the `.npz` file.
+        num_threads (int): layers are decoded on this many threads. zstd and lz4 release the GIL,
+            the "quant" codec is vectorised and ignores it.
+        num_layers (int, optional): only decode the first `num_layers` layers, the rest stay zero.
+
+    Returns:
+        np.ndarray of shape (16, 7, 256, 256).
+    """
+    loaded_data = np.load(xray_path)
+
+    if "codec" not in loaded_data.files:
+        xray_shape = tuple(loaded_data["xray_shape"]) if "xray_shape" in loaded_data.files else XRAY_SHAPE
+        restored_array = _from_csr(loaded_data['data'], loaded_data['indices'], loaded_data['indptr'],
+                                   tuple(loaded_data['shape']), num_rows=num_layers)
+        return restored_array.reshape(xray_shape)
+
+    codec = str(loaded_data["codec"])
+    if codec == "quant":
+        return _load_quantized(loaded_data, num_layers=num_layers)
+
+    xray_shape = tuple(loaded_data["xray_shape"])
+    shape = tuple(loaded_data["shape"])
+    data, data_offsets = loaded_data["data"], loaded_data["data_offsets"]
+    indices, indices_offsets = loaded_data["indices"], loaded_data["indices_offsets"]
+
+    dense = np.zeros(shape, dtype=np.dtype(str(loaded_data["dtype"])))
+    layers = range(shape[0] if num_layers is None else min(num_layers, shape[0]))
+    if num_threads > 1:
+        pool = _get_pool(num_threads)
+        futures = [pool.submit(_decode_layer, dense, i, data, data_offsets, indices, indices_offsets, codec) for i in layers]
+        for future in futures:
+            future.result()
+    else:
+        for i in layers:
+            _decode_layer(dense, i, data, data_offsets, indices, indices_offsets, codec)
+    return dense.reshape(xray_shape)
+
+
+def load_occupancy(xray_path, num_layers=None):
+    """
+    Load the hit mask of an X-Ray without decoding depth, normals and colours.
+
+    Files written before the `occupancy` plane existed fall back to the CSR column indices: depth
+    is the first channel and always positive, so a hit is a stored index below H * W.
+
+    Args:
+        xray_path (str or file-like): the `.npz` file.
+        num_layers (int, optional): only return the first `num_layers` layers.
+
+    Returns:
+        np.ndarray of bools with shape (layers, H, W).
+    """
+    loaded_data = np.load(xray_path)
+    xray_shape = tuple(loaded_data["xray_shape"]) if "xray_shape" in loaded_data.files else XRAY_SHAPE
+    height, width = xray_shape[2:]
+    if "occupancy" in loaded_data.files:
+        return unpack_occupancy(loaded_data["occupancy"], height, width, num_layers=num_layers)
+
+    indptr = loaded_data["indptr"]
+    codec = str(loaded_data["codec"]) if "codec" in loaded_data.files else None
+    if codec is None:
+        indices = loaded_data["indices"]
+    else:
+        indices, indices_offsets = loaded_data["indices"], loaded_data["indices_offsets"]
+
+    hit = np.zeros((xray_shape[0] if num_layers is None else min(num_layers, xray_shape[0]), height * width), dtype=bool)
+    for i in range(len(hit)):
+        if codec is None:
+            layer_indices = indices[indptr[i]:indptr[i + 1]]
+        else:
+            layer_indices = _decode_indices(decompress(indices[indices_offsets[i]:indices_offsets[i + 1]].tobytes(), codec))
+        hit[i, layer_indices[layer_indices < height * width]] = True
+    return hit.reshape(-1, height, width)
@@ -93,9 +93,14 @@ class XRayDiffusionPipeline(DiffusionPipeline):
             A scheduler to be used in combination with `unet` to denoise the encoded image latents.
         feature_extractor ([`~transformers.CLIPImageProcessor`]):
             A `CLIPImageProcessor` to extract features from generated images.
+        xray_vae ([`AutoencoderKLTemporalDecoder`], *optional*):
+            X-Ray VAE trained with `train_vae.py`. When given, `unet` denoises X-Ray VAE latents (latent-space
+            diffusion, `train_diffusion.py --latent_dir`) and the X-Rays are decoded with it; otherwise `unet`
+            denoises X-Rays directly.
     """
 
-    model_cpu_offload_seq = "image_encoder->unet->vae"
+    model_cpu_offload_seq = "image_encoder->unet->xray_vae->vae"
+    _optional_components = ["xray_vae"]
     _callback_tensor_inputs = ["latents"]
 
     def __init__(
@@ -105,6 +110,7 @@ class XRayDiffusionPipeline(DiffusionPipeline):
         unet: UNetSpatioTemporalConditionModel,
         scheduler: EulerDiscreteScheduler,
         feature_extractor: CLIPImageProcessor,
+        xray_vae: Optional[AutoencoderKLTemporalDecoder] = None,
     ):
         super().__init__()
 
@@ -114,8 +120,11 @@ class XRayDiffusionPipeline(DiffusionPipeline):
             unet=unet,
             scheduler=scheduler,
             feature_extractor=feature_extractor,
+            xray_vae=xray_vae,
         )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        # X-Ray pixels per latent pixel, 1 when the unet works on X-Rays directly
+        self.xray_vae_scale_factor = 2 ** (len(xray_vae.config.block_out_channels) - 1) if xray_vae is not None else 1
         self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor)
 
     def _encode_image(self, image, device, num_videos_per_prompt, do_classifier_free_guidance):
@@ -242,6 +251,12 @@ class XRayDiffusionPipeline(DiffusionPipeline):
         frames = frames.float()
         return frames
 
+    def decode_xray_latents(self, latents, num_frames):
+        """Decode X-Ray VAE latents of shape (batch, frames, channels, h, w) into X-Rays (batch, frames, 8, H, W)."""
+        latents = 1 / self.xray_vae.config.scaling_factor * latents.to(self.xray_vae.dtype)
+        xrays = [self.xray_vae.decode(sample, num_frames=num_frames).sample for sample in latents]
+        return torch.stack(xrays).float()
+
     def check_inputs(self, image, height, width):
         if (
             not isinstance(image, torch.Tensor)
@@ -255,6 +270,8 @@ class XRayDiffusionPipeline(DiffusionPipeline):
 
         if height % 8 != 0 or width % 8 != 0:
             raise ValueError(f"`height` and `width` have to be divisible by 8 but are {height} and {width}.")
+        if height % self.xray_vae_scale_factor != 0 or width % self.xray_vae_scale_factor != 0:
+            raise ValueError(f"`height` and `width` have to be divisible by {self.xray_vae_scale_factor} but are {height} and {width}.")
 
     def prepare_latents(
         self,
@@ -335,9 +352,9 @@ class XRayDiffusionPipeline(DiffusionPipeline):
                 Image or images to guide image generation. If you provide a tensor, it needs to be compatible with
                 [`CLIPImageProcessor`](https://huggingface.co/lambdalabs/sd-image-variations-diffusers/blob/main/feature_extractor/preprocessor_config.json).
             height (`int`, *optional*, defaults to `self.unet.config.sample_size * self.vae_scale_factor`):
-                The height in pixels of the generated image.
+                The height in pixels of the generated X-Ray; the unet runs at `height / self.xray_vae_scale_factor`.
             width (`int`, *optional*, defaults to `self.unet.config.sample_size * self.vae_scale_factor`):
-                The width in pixels of the generated image.
+                The width in pixels of the generated X-Ray.
             num_frames (`int`, *optional*):
                 The number of video frames to generate. Defaults to 14 for `stable-video-diffusion-img2vid` and to 25 for `stable-video-diffusion-img2vid-xt`
             num_inference_steps (`int`, *optional*, defaults to 25):
@@ -368,7 +385,8 @@ class XRayDiffusionPipeline(DiffusionPipeline):
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
                 tensor is generated by sampling using the supplied random `generator`.
             output_type (`str`, *optional*, defaults to `"pil"`):
-                The output format of the generated image. Choose between `PIL.Image` or `np.array`.
+                The output format of the generated image. Choose between `PIL.Image` or `np.array`. `"latent"`
+                returns the X-Rays as a tensor, decoded with `xray_vae` in latent-space diffusion.
             callback_on_step_end (`Callable`, *optional*):
                 A function that calls at the end of each denoising steps during the inference. The function is called
                 with the following arguments: `callback_on_step_end(self: DiffusionPipeline, step: int, timestep: int,
@@ -412,6 +430,7 @@ class XRayDiffusionPipeline(DiffusionPipeline):
         self.check_inputs(image, height, width)
 
         # 2. Define call parameters
+        height, width = height // self.xray_vae_scale_factor, width // self.xray_vae_scale_factor
         if isinstance(image, PIL.Image.Image):
             batch_size = 1
         elif isinstance(image, list):
@@ -469,7 +488,7 @@ class XRayDiffusionPipeline(DiffusionPipeline):
         timesteps = self.scheduler.timesteps
 
         # 5. Prepare latent variables
-        num_channels_latents = self.unet.config.latent_channels
+        num_channels_latents = self.unet.config.out_channels
         latents = self.prepare_latents(
             batch_size * num_videos_per_prompt,
             num_frames,
@@ -537,6 +556,8 @@ class XRayDiffusionPipeline(DiffusionPipeline):
                 self.vae.to(dtype=torch.float16)
             frames = self.decode_latents(latents, num_frames, decode_chunk_size)
             frames = tensor2vid(frames, self.image_processor, output_type=output_type)
+        elif self.xray_vae is not None:
+            frames = self.decode_xray_latents(latents, num_frames)
         else:
             frames = latents
 
@@ -16,12 +16,13 @@
 
 """Script to fine-tune Stable Video Diffusion."""
 import argparse
+import json
 import random
 import logging
 import math
 import os
-import torchvision
 import shutil
+import torchvision
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -35,7 +36,7 @@ from torch.utils.data import RandomSampler
 import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
+from accelerate.utils import DistributedType, ProjectConfiguration, set_seed
 from huggingface_hub import create_repo, upload_folder
 from packaging import version
 from tqdm.auto import tqdm
@@ -50,8 +51,15 @@ from diffusers.optimization import get_scheduler
 from diffusers.training_utils import EMAModel
 from diffusers.utils import check_min_version, deprecate, is_wandb_available, load_image
 from diffusers.utils.import_utils import is_xformers_available
-import open3d as o3d
-from src.dataset import DiffusionDataset
+from src.augment import XRayAugmentation
+from src.background import BackgroundWriter, to_host
+from src.checkpoint import (AsyncCheckpointer, is_sharded, is_zero3, latest_checkpoint, mark_complete, rotate_checkpoints,
+                            save_consolidated, zero3_init_disabled)
+from src.dataset import DiffusionDataset, LatentDataset, LayerBucketBatchSampler, ShardDataset, MeshXRayDataset
+from src.ema import IntervalEMAModel
+from src.prefetch import DevicePrefetcher
+from src.profiler import StepTimer
+from src.validation import DiffusionValidator, save_images
 
 # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
 check_min_version("0.24.0.dev0")
@@ -65,57 +73,6 @@ def rand_log_normal(shape, loc=0., scale=1., device='cpu', dtype=torch.float32):
     return torch.distributions.Normal(loc, scale).icdf(u).exp()
 
 
-def get_rays(directions, c2w):
-    # Rotate ray directions from camera coordinate to the world coordinate
-    rays_d = directions @ c2w[:3, :3].T # (H, W, 3)
-    rays_d = rays_d / (np.linalg.norm(rays_d, axis=-1, keepdims=True) + 1e-8)
-    
-    # The origin of all rays is the camera origin in world coordinate
-    rays_o = np.broadcast_to(c2w[:3, 3], rays_d.shape) # (H, W, 3)
-
-    return rays_o, rays_d
-
-
-def xray_to_pcd(GenDepths, GenNormals, GenColors):
-    camera_angle_x = 0.8575560450553894
-    image_width = GenDepths.shape[-1]
-    image_height = GenDepths.shape[-2]
-    fx = 0.5 * image_width / np.tan(0.5 * camera_angle_x)
-
-    rays_screen_coords = np.mgrid[0:image_height, 0:image_width].reshape(
-            2, image_height * image_width).T  # [h, w, 2]
-
-    grid = rays_screen_coords.reshape(image_height, image_width, 2)
-
-    cx = image_width / 2.0
-    cy = image_height / 2.0
-
-    i, j = grid[..., 1], grid[..., 0]
-
-    directions = np.stack([(i-cx)/fx, -(j-cy)/fx, -np.ones_like(i)], -1) # (H, W, 3)
-
-    c2w = np.eye(4).astype(np.float32)
-
-    rays_origins, ray_directions = get_rays(directions, c2w)
-    rays_origins = rays_origins[None].repeat(GenDepths.shape[0], 0)
-    ray_directions = ray_directions[None].repeat(GenDepths.shape[0], 0)
-
-    GenDepths = GenDepths.transpose(0, 2, 3, 1)
-    GenNormals = GenNormals.transpose(0, 2, 3, 1)
-    GenColors = GenColors.transpose(0, 2, 3, 1)
-    
-    valid_index = GenDepths[..., 0] > 0
-    rays_origins = rays_origins[valid_index]
-    ray_directions = ray_directions[valid_index]
-    GenDepths = GenDepths[valid_index]
-    normals = GenNormals[valid_index]
-    colors = GenColors[valid_index]
-    xyz = rays_origins + ray_directions * GenDepths
-
-    return xyz, normals, colors
-
-
-
 # resizing utils
 # TODO: clean up later
 def _resize_with_antialiasing(input, size, interpolation="bicubic", align_corners=True):
@@ -362,9 +319,27 @@ def parse_args():
             " https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices"
         ),
     )
+    parser.add_argument(
+        "--unet_config",
+        type=str,
+        default="src/xray_unet.json",
+        help="Config of the UNet trained from scratch, e.g. src/xray_unet_small.json for CPU smoke tests.",
+    )
     parser.add_argument(
         "--use_ema", action="store_true", help="Whether to use EMA model."
     )
+    parser.add_argument(
+        "--ema_update_every",
+        type=int,
+        default=1,
+        help="Update the EMA weights every N optimizer steps, with the decay raised to the power N.",
+    )
+    parser.add_argument(
+        "--ema_offload",
+        action="store_true",
+        help=("Keep the EMA weights in pinned host memory and average them on the CPU, which frees their GPU memory."
+              " Always on under DeepSpeed ZeRO-3."),
+    )
     parser.add_argument(
         "--non_ema_revision",
         type=str,
@@ -474,6 +449,38 @@ def parse_args():
         default=2,
         help=("Max number of checkpoints to store."),
     )
+    parser.add_argument(
+        "--timing_log_steps",
+        type=int,
+        default=None,
+        help=(
+            "Record the wall and CUDA time of every phase of the training step (data, forward, loss, backward, ...)"
+            " and log their p50 / p90 / p99 over the last 100 steps every X steps."
+        ),
+    )
+    parser.add_argument(
+        "--trace_steps",
+        type=str,
+        default=None,
+        help="Write the phases of the training steps START:END as a Chrome trace to `output_dir`/trace_rank<process>.json.",
+    )
+    parser.add_argument(
+        "--max_pending_artifacts",
+        type=int,
+        default=8,
+        help=(
+            "Training sample dumps are written in a background thread; while this many writes are pending"
+            " new dumps are dropped instead of stalling training. Validation outputs are never dropped."
+        ),
+    )
+    parser.add_argument(
+        "--async_checkpointing",
+        action="store_true",
+        help=(
+            "Snapshot the training state into pinned host memory and write checkpoints in a background thread."
+            " Needs host memory for a copy of the model and optimizer states."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -509,6 +516,73 @@ def parse_args():
         help=("the data root path."),
     )
 
+    parser.add_argument(
+        "--train_shards",
+        type=str,
+        default=None,
+        help=("stream training samples from tar shards written by scripts/pack_shards.py (index.json or its directory)."
+              " Validation still reads from `--data_root`."),
+    )
+    parser.add_argument(
+        "--train_meshes",
+        type=str,
+        default=None,
+        help=("ray cast training samples on the fly from the meshes written by scripts/prepare_meshes.py in this directory."
+              " Validation still reads from `--data_root`."),
+    )
+    parser.add_argument(
+        "--train_mesh_images",
+        type=str,
+        default=None,
+        help=("with `--train_meshes`, the rendered `images` directory of the meshes: their cameras and renders are used"
+              " instead of random cameras and flat shaded condition images."),
+    )
+    parser.add_argument(
+        "--mesh_pool_size",
+        type=int,
+        default=8,
+        help=("the number of meshes each dataloader worker keeps loaded when using `--train_meshes`."),
+    )
+    parser.add_argument(
+        "--views_per_mesh",
+        type=int,
+        default=16,
+        help=("views rendered from a mesh before it is replaced in the pool when using `--train_meshes`."),
+    )
+
+    parser.add_argument(
+        "--layer_buckets",
+        type=str,
+        default=None,
+        help=("frame counts of layer buckets, e.g. 2,4,8: batches hold views of one bucket, read with its frame count"
+              " instead of `--num_frames`. Needs the manifest of scripts/build_manifest.py."),
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        type=int,
+        default=1000,
+        help=("the number of samples in the shuffle buffer of each dataloader worker when using `--train_shards`."),
+    )
+    parser.add_argument(
+        "--decode_threads",
+        type=int,
+        default=1,
+        help=("threads used by every dataloader worker to decode zstd / lz4 X-Rays."),
+    )
+    parser.add_argument(
+        "--latent_dir",
+        type=str,
+        default=None,
+        help=("train in the latent space of the X-Ray VAE on latents cached by scripts/cache_latents.py. "
+              "--height / --width are then the X-Ray resolution of the cache."),
+    )
+    parser.add_argument(
+        "--xray_vae",
+        type=str,
+        default=None,
+        help=("X-Ray VAE checkpoint (with a `vae` subfolder) that decodes the latents, defaults to the one the cache was written with."),
+    )
+
     parser.add_argument(
         "--near",
         type=float,
@@ -522,8 +596,32 @@ def parse_args():
         default=1.8,
         help=("the farest distance"),
     )
+    parser.add_argument(
+        "--augment_hflip",
+        type=float,
+        default=0.0,
+        help=("the probability of mirroring a training sample horizontally, normals and condition image included."),
+    )
+    parser.add_argument(
+        "--augment_depth_scale",
+        type=float,
+        default=0.0,
+        help=("scale the depths of a training sample by a random factor within 1 +- this, kept within --near / --far."),
+    )
+    parser.add_argument(
+        "--augment_color",
+        type=float,
+        default=0.0,
+        help=("the relative strength of the brightness and saturation jitter of the colours and condition image."),
+    )
 
     args = parser.parse_args()
+    if args.train_shards is not None and args.train_meshes is not None:
+        raise ValueError("--train_shards and --train_meshes are two sources of training samples, pass only one")
+    if args.latent_dir is not None and (args.train_shards is not None or args.train_meshes is not None):
+        raise ValueError("--latent_dir reads cached latents and can not be combined with --train_shards or --train_meshes")
+    if args.latent_dir is not None and (args.augment_hflip > 0 or args.augment_depth_scale > 0 or args.augment_color > 0):
+        raise ValueError("--augment_* work on X-Rays, cached latents can not be augmented")
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
         args.local_rank = env_local_rank
@@ -614,11 +712,26 @@ def main():
     feature_extractor = CLIPImageProcessor.from_pretrained(
         args.pretrained_model_name_or_path, subfolder="feature_extractor", revision=args.revision
     )
-    image_encoder = CLIPVisionModelWithProjection.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="image_encoder", revision=args.revision, variant="fp16"
-    )
-    vae = AutoencoderKLTemporalDecoder.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision, variant="fp16")
+    # the frozen models are not prepared, so under ZeRO-3 they must not be partitioned while loading
+    with zero3_init_disabled(accelerator):
+        image_encoder = CLIPVisionModelWithProjection.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="image_encoder", revision=args.revision, variant="fp16"
+        )
+        vae = AutoencoderKLTemporalDecoder.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="vae", revision=args.revision, variant="fp16")
+
+    # latent-space diffusion: the unet denoises X-Ray VAE latents, the X-Ray VAE only decodes for validation
+    xray_vae = None
+    if args.latent_dir is not None:
+        with open(os.path.join(args.latent_dir, "latent_stats.json"), "r") as f:
+            latent_stats = json.load(f)
+        args.height = args.width = latent_stats["height"]
+        args.near, args.far = latent_stats["near"], latent_stats["far"]
+        with zero3_init_disabled(accelerator):
+            xray_vae = AutoencoderKLTemporalDecoder.from_pretrained(args.xray_vae or latent_stats["xray_vae"],
+                                                                    subfolder="vae")
+        xray_vae.register_to_config(scaling_factor=latent_stats["scaling_factor"])
+        xray_vae.requires_grad_(False)
 
     if args.pretrain_unet is not None:
         unet = UNetSpatioTemporalConditionModel.from_pretrained(
@@ -628,10 +741,16 @@ def main():
         global_step = int(args.pretrain_unet.split("-")[1])
         first_epoch = 0
     else:
+        unet_kwargs = {}
+        if xray_vae is not None:
+            # noisy X-Ray latents concatenated with the image latents in, X-Ray latents out
+            unet_kwargs = {"in_channels": xray_vae.config.latent_channels + vae.config.latent_channels,
+                           "out_channels": xray_vae.config.latent_channels}
         unet = UNetSpatioTemporalConditionModel.from_config(
-            "src/xray_unet.json",
+            UNetSpatioTemporalConditionModel.load_config(args.unet_config),
             low_cpu_mem_usage=True,
             variant="fp16",
+            **unet_kwargs,
         )
 
     # Freeze vae and image_encoder
@@ -649,12 +768,19 @@ def main():
     # Move image_encoder and vae to gpu and cast to weight_dtype
     image_encoder.to(accelerator.device, dtype=weight_dtype)
     vae.to(accelerator.device, dtype=weight_dtype)
+    if xray_vae is not None:
+        xray_vae.to(accelerator.device, dtype=weight_dtype)
     # unet.to(accelerator.device, dtype=weight_dtype)
 
     # Create EMA for the unet.
     if args.use_ema:
-        ema_unet = EMAModel(unet.parameters(
-        ), model_cls=UNetSpatioTemporalConditionModel, model_config=unet.config)
+        if accelerator.distributed_type == DistributedType.FSDP:
+            raise ValueError("--use_ema is not supported with FSDP, use DeepSpeed ZeRO (configs/accelerate) instead")
+        # created before `prepare` partitions the parameters, so the shadow weights are complete on every process;
+        # under ZeRO-3 they are kept on the host and the partitions are gathered a bucket at a time for the update
+        ema_unet = IntervalEMAModel(unet.parameters(), update_every=args.ema_update_every, offload=args.ema_offload,
+                                    zero3=is_zero3(accelerator),
+                                    model_cls=UNetSpatioTemporalConditionModel, model_config=unet.config)
 
     if args.enable_xformers_memory_efficient_attention:
         if is_xformers_available():
@@ -674,10 +800,15 @@ def main():
     if version.parse(accelerate.__version__) >= version.parse("0.16.0"):
         # create custom saving & loading hooks so that `accelerator.save_state(...)` serializes in a nice format
         def save_model_hook(models, weights, output_dir):
-            if args.use_ema:
+            if args.use_ema and accelerator.is_main_process:
                 ema_unet.save_pretrained(os.path.join(output_dir, "unet_ema"))
 
             for i, model in enumerate(models):
+                if is_sharded(accelerator):
+                    # DeepSpeed / FSDP save their sharded states themselves (`weights` is empty), the
+                    # consolidated copy in `unet` is what evaluation and export read
+                    save_consolidated(accelerator, model, os.path.join(output_dir, "unet"))
+                    continue
                 model.save_pretrained(os.path.join(output_dir, "unet"))
 
                 # make sure to pop weight so that corresponding model is not saved again
@@ -746,16 +877,66 @@ def main():
     # DataLoaders creation:
     args.global_batch_size = args.per_gpu_batch_size * accelerator.num_processes
 
-    train_dataset = DiffusionDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="train")
-    train_dataset[0]
-    val_dataset = DiffusionDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="val")
-    sampler = RandomSampler(train_dataset)
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        sampler=sampler,
-        batch_size=args.per_gpu_batch_size,
-        num_workers=args.num_workers,
-    )
+    frame_buckets = tuple(int(frames) for frames in args.layer_buckets.split(",")) if args.layer_buckets is not None else None
+    streaming = args.train_shards is not None or args.train_meshes is not None
+    if streaming and frame_buckets is not None:
+        raise ValueError("--layer_buckets needs random access to the dataset, it cannot be used with --train_shards"
+                         " or --train_meshes")
+    if args.train_meshes is not None:
+        # meshes are split across ranks and workers by the dataset itself
+        train_dataset = MeshXRayDataset(args.train_meshes, args.height, args.num_frames, near=args.near, far=args.far,
+                                        type="diffusion", image_root=args.train_mesh_images, pool_size=args.mesh_pool_size,
+                                        views_per_mesh=args.views_per_mesh, seed=args.seed or 0)
+    if args.train_shards is not None:
+        # shards are split across ranks and workers by the dataset itself
+        train_dataset = ShardDataset(args.train_shards, args.height, args.num_frames, near=args.near, far=args.far,
+                                     type="diffusion", shuffle_buffer=args.shuffle_buffer, seed=args.seed or 0,
+                                     decode_threads=args.decode_threads)
+    if streaming:
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=args.per_gpu_batch_size,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+        )
+    elif args.latent_dir is not None:
+        train_dataset = LatentDataset(args.data_root, args.latent_dir, args.num_frames, phase="train",
+                                      frame_buckets=frame_buckets)
+        train_dataset[0]
+        sampler = RandomSampler(train_dataset)
+        batching = {"sampler": sampler, "batch_size": args.per_gpu_batch_size}
+        if frame_buckets is not None:
+            # every batch holds views of one layer bucket, all read with its frame count
+            batching = {"batch_sampler": LayerBucketBatchSampler(train_dataset.sample_num_frames, args.per_gpu_batch_size,
+                                                                 seed=args.seed or 0,
+                                                                 num_processes=accelerator.num_processes,
+                                                                 process_index=accelerator.process_index)}
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            **batching,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+        )
+    else:
+        train_dataset = DiffusionDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="train",
+                                         decode_threads=args.decode_threads, frame_buckets=frame_buckets)
+        train_dataset[0]
+        sampler = RandomSampler(train_dataset)
+        batching = {"sampler": sampler, "batch_size": args.per_gpu_batch_size}
+        if frame_buckets is not None:
+            # every batch holds views of one layer bucket, all read with its frame count
+            batching = {"batch_sampler": LayerBucketBatchSampler(train_dataset.sample_num_frames, args.per_gpu_batch_size,
+                                                                 seed=args.seed or 0,
+                                                                 num_processes=accelerator.num_processes,
+                                                                 process_index=accelerator.process_index)}
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            **batching,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+        )
+    val_dataset = DiffusionDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="val",
+                                   decode_threads=args.decode_threads)
 
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
@@ -773,9 +954,21 @@ def main():
     )
 
     # Prepare everything with our `accelerator`.
-    unet, optimizer, lr_scheduler, train_dataloader = accelerator.prepare(
-        unet, optimizer, lr_scheduler, train_dataloader
+    if accelerator.distributed_type == DistributedType.DEEPSPEED:
+        # the dataloader is prepared on its own below, DeepSpeed cannot infer the batch size from it
+        accelerator.state.deepspeed_plugin.deepspeed_config["train_micro_batch_size_per_gpu"] = args.per_gpu_batch_size
+    unet, optimizer, lr_scheduler = accelerator.prepare(
+        unet, optimizer, lr_scheduler
     )
+    if not streaming and frame_buckets is None:
+        # sharded across processes by accelerate (the layer bucket sampler shards itself), moved to the device by the
+        # prefetcher below
+        train_dataloader = accelerator.prepare_data_loader(train_dataloader, device_placement=False)
+    # pinned host-to-device copies of the next batch overlap with the current step, the cast to weight_dtype runs on the device
+    train_dataloader = DevicePrefetcher(train_dataloader, accelerator.device, dtype=weight_dtype)
+    # random flips and jitter of the batches, on the device
+    augment = XRayAugmentation(args.near, args.far, hflip=args.augment_hflip, depth_scale=args.augment_depth_scale,
+                               color=args.augment_color)
 
     if args.use_ema:
         ema_unet.to(accelerator.device)
@@ -794,6 +987,30 @@ def main():
     if accelerator.is_main_process:
         accelerator.init_trackers("X-Ray", config=vars(args))
 
+    # The validation pipeline is built once around the live modules, the models need unwrapping
+    # for compatibility in distributed training mode.
+    validator = None
+    if accelerator.is_main_process:
+        writer = BackgroundWriter(max_pending=args.max_pending_artifacts)
+    if is_zero3(accelerator):
+        # a forward pass of the partitioned unet needs every process, validation runs on the main one only
+        logger.warning("Validation during training is disabled with ZeRO-3, evaluate the saved checkpoints instead.")
+    elif accelerator.is_main_process:
+        validator = DiffusionValidator(
+            XRayDiffusionPipeline(
+                vae=accelerator.unwrap_model(vae),
+                image_encoder=accelerator.unwrap_model(image_encoder),
+                unet=accelerator.unwrap_model(unet),
+                scheduler=EulerDiscreteScheduler.from_config(noise_scheduler.config),
+                feature_extractor=feature_extractor,
+                xray_vae=xray_vae,
+            ),
+            [xray_path.replace("xrays", "images").replace(".npz", ".png")
+             for xray_path in val_dataset.xray_paths[:args.num_validation_images]],
+            os.path.join(args.output_dir, "validation_images"),
+            args.height, args.width, args.num_frames, args.near, args.far, writer,
+        )
+
     # Train!
     total_batch_size = args.per_gpu_batch_size * \
         accelerator.num_processes * args.gradient_accumulation_steps
@@ -836,32 +1053,36 @@ def main():
         noise_aug_strength,
         dtype,
         batch_size,
+        device=None,
     ):
-        add_time_ids = [fps, motion_bucket_id, noise_aug_strength]
-
-        passed_add_embed_dim = unet.module.config.addition_time_embed_dim * \
-            len(add_time_ids)
-        expected_add_embed_dim = unet.module.add_embedding.linear_1.in_features
+        # noise_aug_strength is a float or a (batch_size,) tensor with the augmentation level of every sample
+        noise_aug_strength = torch.as_tensor(noise_aug_strength, dtype=dtype, device=device).reshape(-1).expand(batch_size)
+        add_time_ids = torch.stack([
+            torch.full_like(noise_aug_strength, fps),
+            torch.full_like(noise_aug_strength, motion_bucket_id),
+            noise_aug_strength,
+        ], dim=1)
+
+        passed_add_embed_dim = accelerator.unwrap_model(unet).config.addition_time_embed_dim * \
+            add_time_ids.shape[1]
+        expected_add_embed_dim = accelerator.unwrap_model(unet).add_embedding.linear_1.in_features
 
         if expected_add_embed_dim != passed_add_embed_dim:
             raise ValueError(
                 f"Model expects an added time embedding vector of length {expected_add_embed_dim}, but a vector of {passed_add_embed_dim} was created. The model has an incorrect config. Please check `unet.config.time_embedding_type` and `text_encoder_2.config.projection_dim`."
             )
 
-        add_time_ids = torch.tensor([add_time_ids], dtype=dtype)
-        add_time_ids = add_time_ids.repeat(batch_size, 1)
         return add_time_ids
 
+    checkpointer = AsyncCheckpointer(accelerator, args.output_dir, args.checkpoints_total_limit) if args.async_checkpointing else None
+
     # Potentially load in the weights and states from a previous save
     if args.resume_from_checkpoint:
         if args.resume_from_checkpoint != "latest":
             path = os.path.basename(args.resume_from_checkpoint)
         else:
-            # Get the most recent checkpoint
-            dirs = os.listdir(args.output_dir)
-            dirs = [d for d in dirs if d.startswith("checkpoint")]
-            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
-            path = dirs[-1] if len(dirs) > 0 else None
+            # Get the most recent checkpoint that was completely written
+            path = latest_checkpoint(args.output_dir)
 
         if path is None:
             accelerator.print(
@@ -880,30 +1101,45 @@ def main():
     progress_bar.set_description("Steps")
 
     progress_bar.update(global_step)
+
+    # per-phase timing of the training step, free when neither --timing_log_steps nor --trace_steps is set
+    timer = StepTimer(
+        enabled=args.timing_log_steps is not None,
+        trace_steps=tuple(int(step) for step in args.trace_steps.split(":")) if args.trace_steps is not None else None,
+        trace_path=os.path.join(args.output_dir, f"trace_rank{accelerator.process_index}.json"),
+        device=accelerator.device,
+        process_index=accelerator.process_index,
+    )
+
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
+        if streaming:
+            train_dataset.set_epoch(epoch)
         train_loss = 0.0
         for step, batch in enumerate(train_dataloader):
+            timer.lap("data")
+            batch = augment(batch)
 
             with accelerator.accumulate(unet):
                 # first, convert images to latent space.
-                xray = batch["xray"].to(weight_dtype).to(
-                    accelerator.device, non_blocking=True
-                )
-                conditional_pixel_values = batch["image_values"].to(weight_dtype).to(
-                    accelerator.device, non_blocking=True)
+                if xray_vae is not None:
+                    xray = batch["latents"] * xray_vae.config.scaling_factor
+                else:
+                    xray = batch["xray"]
+                conditional_pixel_values = batch["image_values"]
+                timer.lap("to_device")
 
                 # save xray and conditional_pixel_values as images.
-                if global_step % 50 == 0 and accelerator.is_main_process:
-                    os.makedirs(os.path.join(args.output_dir, "samples"), exist_ok=True)
-                    torchvision.utils.save_image(xray[0, :, 0:1], os.path.join(args.output_dir, "samples", "depths.png"), normalize=True, nrow=4)
-                    torchvision.utils.save_image(xray[0, :, 1:4], os.path.join(args.output_dir, "samples", "normals.png"), normalize=True, nrow=4)
-                    torchvision.utils.save_image(xray[0, :, 4:7], os.path.join(args.output_dir, "samples", "colors.png"), normalize=True, nrow=4)
-                    torchvision.utils.save_image(conditional_pixel_values[0:1], os.path.join(args.output_dir, "samples", "images.png"), normalize=True)
+                if global_step % 50 == 0 and accelerator.is_main_process and xray_vae is None:
                     visual = torch.nn.functional.interpolate(xray[0, :1, :1], (args.height * 8, args.width * 8))
                     visual = visual.clip(-1, 1)
                     visual = (visual + conditional_pixel_values[0:1]) / 2
-                    torchvision.utils.save_image(visual, os.path.join(args.output_dir, "samples", "pixel_value_aligned.png"), normalize=True)
+                    sample = to_host(xray[0])
+                    writer.try_submit(save_images, {
+                        "depths": sample[:, 0:1], "normals": sample[:, 1:4], "colors": sample[:, 4:7],
+                        "images": to_host(conditional_pixel_values[0:1]), "pixel_value_aligned": to_host(visual),
+                    }, os.path.join(args.output_dir, "samples"))
+                timer.lap("samples")
 
                 latents = xray
 
@@ -911,31 +1147,32 @@ def main():
                 noise = torch.randn_like(latents)
                 bsz = latents.shape[0]
 
-                cond_sigmas = rand_log_normal(shape=[bsz,], loc=-3.0, scale=0.5).to(latents)
-                noise_aug_strength = cond_sigmas[0] # TODO: support batch > 1
+                # one conditioning augmentation level per sample, also passed to the unet in added_time_ids
+                cond_sigmas = rand_log_normal(shape=[bsz,], loc=-3.0, scale=0.5, device=latents.device).to(latents)
+                noise_aug_strength = cond_sigmas
                 cond_sigmas = cond_sigmas[:, None, None, None]
                 conditional_pixel_values = \
                     torch.randn_like(conditional_pixel_values) * cond_sigmas + conditional_pixel_values
                 
                 conditional_latents = F.interpolate(conditional_pixel_values, (512, 512), mode="bilinear")
                 conditional_latents = vae.encode(conditional_latents).latent_dist.mode()
-                conditional_latents = F.interpolate(conditional_latents, (args.height, args.width), mode="bilinear")
+                conditional_latents = F.interpolate(conditional_latents, latents.shape[-2:], mode="bilinear")
 
                 # Sample a random timestep for each image
                 # P_mean=0.7 P_std=1.6
-                sigmas = rand_log_normal(shape=[bsz,], loc=0.7, scale=1.6).to(latents.device)
+                sigmas = rand_log_normal(shape=[bsz,], loc=0.7, scale=1.6, device=latents.device)
+                timesteps = 0.25 * sigmas.log()
                 # Add noise to the latents according to the noise magnitude at each timestep
                 # (this is the forward diffusion process)
                 sigmas = sigmas[:, None, None, None, None]
                 noisy_latents = latents + noise * sigmas
-                timesteps = torch.Tensor(
-                    [0.25 * sigma.log() for sigma in sigmas]).to(accelerator.device)
 
                 inp_noisy_latents = noisy_latents / ((sigmas**2 + 1) ** 0.5)
 
                 # Get the text embedding for conditioning.
                 encoder_hidden_states = encode_image(
                     conditional_pixel_values.float())
+                timer.lap("encode")
 
                 # Here I input a fixed numerical value for 'motion_bucket_id', which is not reasonable.
                 # However, I am unable to fully align with the calculation method of the motion score,
@@ -943,11 +1180,11 @@ def main():
                 added_time_ids = _get_add_time_ids(
                     7,
                     127, # motion_bucket_id = 127
-                    noise_aug_strength, # noise_aug_strength == 0.0
+                    noise_aug_strength, # (bsz,) per-sample augmentation levels
                     encoder_hidden_states.dtype,
                     bsz,
+                    device=latents.device,
                 )
-                added_time_ids = added_time_ids.to(latents.device)
 
                 # Conditioning dropout to support classifier-free guidance during inference. For more details
                 # check out the section 3.2.1 of the original paper https://arxiv.org/abs/2211.09800.
@@ -983,6 +1220,7 @@ def main():
                 with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=True, enable_mem_efficient=False):
                     model_pred = unet(
                         inp_noisy_latents, timesteps, encoder_hidden_states, added_time_ids=added_time_ids).sample
+                timer.lap("forward")
 
                 # Denoise the latents
                 c_out = -sigmas / ((sigmas**2 + 1)**0.5)
@@ -997,154 +1235,115 @@ def main():
                     dim=1,
                 )
                 loss = loss.mean()
+                timer.lap("loss")
 
                 # Gather the losses across all processes for logging (if we use distributed training).
                 avg_loss = accelerator.gather(
                     loss.repeat(args.per_gpu_batch_size)).mean()
                 train_loss += avg_loss.item() / args.gradient_accumulation_steps
+                timer.lap("gather")
 
                 # Backpropagate
                 accelerator.backward(loss)
+                timer.lap("backward")
                 if accelerator.sync_gradients:
                     accelerator.clip_grad_norm_(unet.parameters(), args.max_grad_norm)
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad()
+                timer.lap("optimizer")
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
                 if args.use_ema:
                     ema_unet.step(unet.parameters())
+                    timer.lap("ema")
                 progress_bar.update(1)
                 global_step += 1
                 accelerator.log({"train_loss": train_loss}, step=global_step)
                 train_loss = 0.0
+                if args.timing_log_steps is not None and global_step % args.timing_log_steps == 0:
+                    accelerator.log(timer.summary(), step=global_step)
+
+                if is_sharded(accelerator) and global_step % args.checkpointing_steps == 0:
+                    # saving sharded states is collective, every process takes part
+                    if accelerator.is_main_process and args.checkpoints_total_limit is not None:
+                        rotate_checkpoints(args.output_dir, args.checkpoints_total_limit - 1)
+                    accelerator.wait_for_everyone()
+                    save_path = os.path.join(args.output_dir, f"checkpoint-{global_step}")
+                    accelerator.save_state(save_path)
+                    accelerator.wait_for_everyone()
+                    if accelerator.is_main_process:
+                        mark_complete(save_path)
+                        logger.info(f"Saved state to {save_path}")
+                    timer.lap("checkpoint")
 
                 if accelerator.is_main_process:
                     # save checkpoints!
-                    if global_step % args.checkpointing_steps == 0:
-                        # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                        if args.checkpoints_total_limit is not None:
-                            checkpoints = os.listdir(args.output_dir)
-                            checkpoints = [
-                                d for d in checkpoints if d.startswith("checkpoint")]
-                            checkpoints = sorted(
-                                checkpoints, key=lambda x: int(x.split("-")[1]))
-
-                            # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                            if len(checkpoints) >= args.checkpoints_total_limit:
-                                num_to_remove = len(
-                                    checkpoints) - args.checkpoints_total_limit + 1
-                                removing_checkpoints = checkpoints[0:num_to_remove]
-
-                                logger.info(
-                                    f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
-                                )
-                                logger.info(
-                                    f"removing checkpoints: {', '.join(removing_checkpoints)}")
-
-                                for removing_checkpoint in removing_checkpoints:
-                                    removing_checkpoint = os.path.join(
-                                        args.output_dir, removing_checkpoint)
-                                    shutil.rmtree(removing_checkpoint)
-
-                        save_path = os.path.join(
-                            args.output_dir, f"checkpoint-{global_step}")
-                        accelerator.save_state(save_path)
-                        # accelerator.unwrap_model(unet).save_pretrained(save_path, variant="fp16")
-
-                        logger.info(f"Saved state to {save_path}")
+                    if global_step % args.checkpointing_steps == 0 and not is_sharded(accelerator):
+                        if checkpointer is not None:
+                            save_path = checkpointer.save(
+                                global_step, {"unet": unet}, ema_models={"unet_ema": (ema_unet, unet)} if args.use_ema else None)
+                            logger.info(f"Saving state to {save_path} in the background")
+                        else:
+                            # _before_ saving state, make sure this save does not set us over the `checkpoints_total_limit`
+                            if args.checkpoints_total_limit is not None:
+                                rotate_checkpoints(args.output_dir, args.checkpoints_total_limit - 1)
+
+                            save_path = os.path.join(
+                                args.output_dir, f"checkpoint-{global_step}")
+                            accelerator.save_state(save_path)
+                            mark_complete(save_path)
+                            logger.info(f"Saved state to {save_path}")
+                        timer.lap("checkpoint")
                     # sample images!
-                    if (
+                    if validator is not None and (
                         (global_step % args.validation_steps == 0)
                         or (global_step == 1)
                     ):
                         logger.info(
                             f"Running validation... \n Generating {args.num_validation_images} videos."
                         )
-                        # create pipeline
                         if args.use_ema:
                             # Store the UNet parameters temporarily and load the EMA parameters to perform inference.
                             ema_unet.store(unet.parameters())
                             ema_unet.copy_to(unet.parameters())
-                        # The models need unwrapping because for compatibility in distributed training mode.
-                        pipeline = XRayDiffusionPipeline.from_pretrained(
-                            args.pretrained_model_name_or_path,
-                            unet=accelerator.unwrap_model(unet),
-                            image_encoder=accelerator.unwrap_model(
-                                image_encoder),
-                            vae=accelerator.unwrap_model(vae),
-                            revision=args.revision,
-                            torch_dtype=weight_dtype,
-                        )
-                        pipeline = pipeline.to(accelerator.device)
-                        pipeline.set_progress_bar_config(disable=True)
-
-                        # run inference
-                        val_save_dir = os.path.join(
-                            args.output_dir, "validation_images")
-
-                        if not os.path.exists(val_save_dir):
-                            os.makedirs(val_save_dir)
 
                         with torch.autocast(
                             str(accelerator.device).replace(":0", ""), enabled=accelerator.mixed_precision == "fp16"
                         ):
-                            # val_image_paths = val_dataset.xray_paths[:args.num_validation_images]
-                            for val_img_idx in range(args.num_validation_images):
-                                num_frames = args.num_frames
-                                image_path = val_dataset.xray_paths[val_img_idx].replace("xrays", "images").replace(".npz", ".png")
-                                image_val = load_image(image_path).convert("RGB").resize((args.width * 8, args.height * 8))
-                                image_val.save(f"{val_save_dir}/step_{global_step}_val_img_{val_img_idx}_original.png")
-                                outputs = pipeline(
-                                    image_val,
-                                    height=args.height,
-                                    width=args.width,
-                                    num_frames=num_frames,
-                                    decode_chunk_size=8,
-                                    motion_bucket_id=127,
-                                    fps=7,
-                                    noise_aug_strength=0.0,
-                                    output_type="latent",
-                                ).frames[0]
-
-                                # save the generated images
-                                outputs = outputs.clip(-1, 1)
-                                torchvision.utils.save_image(outputs[:, 0:1], f"{val_save_dir}/step_{global_step}_val_img_{val_img_idx}_depths.png", normalize=True, nrow=4)
-                                torchvision.utils.save_image(outputs[:, 1:4], f"{val_save_dir}/step_{global_step}_val_img_{val_img_idx}_normals.png", normalize=True, nrow=4)
-                                torchvision.utils.save_image(outputs[:, 4:7], f"{val_save_dir}/step_{global_step}_val_img_{val_img_idx}_colors.png", normalize=True, nrow=4)
-                                GenHits = outputs[:, -1:].cpu().numpy()
-                                GenDepths = (outputs[:, 0:1].cpu().numpy() * 0.5 + 0.5) * (args.far - args.near) + args.near
-                                GenDepths[GenHits < 0] = 0
-                                GenDepths[GenDepths <= args.near] = 0
-                                GenDepths[GenDepths >= args.far] = 0
-                                GenNormals = F.normalize(outputs[:, 1:4], dim=1).cpu().numpy()
-                                GenColors = outputs[:, 4:7].cpu().numpy() * 0.5 + 0.5
-                                gen_pts, gen_normals, gen_colors = xray_to_pcd(GenDepths, GenNormals, GenColors)
-                                pcd = o3d.geometry.PointCloud()
-                                pcd.points = o3d.utility.Vector3dVector(gen_pts)
-                                pcd.normals = o3d.utility.Vector3dVector(gen_normals)
-                                pcd.colors = o3d.utility.Vector3dVector(gen_colors)
-                                o3d.io.write_point_cloud(f"{val_save_dir}/step_{global_step}_val_img_{val_img_idx}.ply", pcd)
+                            validator(global_step)
 
                         if args.use_ema:
                             # Switch back to the original UNet parameters.
                             ema_unet.restore(unet.parameters())
 
-                        del pipeline
                         torch.cuda.empty_cache()
+                        timer.lap("validation")
 
             logs = {"step_loss": loss.detach().item(
             ), "lr": lr_scheduler.get_last_lr()[0]}
             progress_bar.set_postfix(**logs)
+            timer.end_step(global_step)
 
             if global_step >= args.max_train_steps:
                 break
 
     # Create the pipeline using the trained modules and save it.
+    if checkpointer is not None:
+        checkpointer.wait()
     accelerator.wait_for_everyone()
+    if is_sharded(accelerator):
+        # rebuild the unet from the gathered weights, the prepared one only holds this process's shard
+        save_consolidated(accelerator, unet, os.path.join(args.output_dir, "unet_consolidated"))
+        accelerator.wait_for_everyone()
     if accelerator.is_main_process:
-        unet = accelerator.unwrap_model(unet)
+        writer.close()
+        if is_sharded(accelerator):
+            unet = UNetSpatioTemporalConditionModel.from_pretrained(args.output_dir, subfolder="unet_consolidated")
+            shutil.rmtree(os.path.join(args.output_dir, "unet_consolidated"))
+        else:
+            unet = accelerator.unwrap_model(unet)
         if args.use_ema:
             ema_unet.copy_to(unet.parameters())
 
@@ -1152,6 +1351,7 @@ def main():
             args.pretrained_model_name_or_path,
             image_encoder=accelerator.unwrap_model(image_encoder),
             vae=accelerator.unwrap_model(vae),
+            xray_vae=xray_vae,
             unet=unet,
             revision=args.revision,
         )
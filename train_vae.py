@@ -21,8 +21,6 @@ import random
 import logging
 import math
 import os
-import torchvision
-import shutil
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -47,9 +45,15 @@ from diffusers import AutoencoderKLTemporalDecoder
 from diffusers.optimization import get_scheduler
 from diffusers.utils import check_min_version, deprecate, is_wandb_available, load_image
 from diffusers import AutoencoderKL
-import open3d as o3d
-from src.dataset import UpsamplerDataset
-from pytorch3d.ops import knn_points
+from src.augment import XRayAugmentation
+from src.background import BackgroundWriter, to_host
+from src.checkpoint import AsyncCheckpointer, latest_checkpoint, mark_complete, rotate_checkpoints
+from src.curriculum import ResolutionSchedule
+from src.dataset import LayerBucketBatchSampler, UpsamplerDataset, ShardDataset, MeshXRayDataset, collate_same_size
+from src.losses import XRayLoss
+from src.prefetch import DevicePrefetcher
+from src.profiler import StepTimer
+from src.validation import save_images, save_xray
 
 # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
 check_min_version("0.24.0.dev0")
@@ -57,161 +61,6 @@ check_min_version("0.24.0.dev0")
 logger = get_logger(__name__, log_level="INFO")
 
 
-def normal_similarity_loss(points, k=20):
-    """
-    Calculate the loss function for normal similarity, which encourages neighboring points to have similar normals.
-    :param points: (B, N, 3) torch.Tensor, point cloud data
-    :param k: int, number of neighboring points
-    :return: torch.Tensor, normal similarity loss
-    """
-    B, N, _ = points.shape
-
-    # Perform kNN search using PyTorch3D
-    knn = knn_points(points, points, K=k, return_nn=True)
-    neighbors = knn.knn
-
-    centroid = torch.mean(neighbors, dim=2, keepdim=True)  # B x N x 1 x 3
-    neighbors_centered = neighbors - centroid  # B x N x k x 3
-
-    cov_matrix = torch.matmul(neighbors_centered.transpose(3, 2), neighbors_centered)  # B x N x 3 x 3
-    eigvals, eigvecs = torch.linalg.eigh(cov_matrix)  # B x N x 3 x 3
-
-    normals = eigvecs[:, :, :, 0]  # B x N x 3
-
-    # 计算相邻点法向量相似性损失
-    knn = knn_points(points, points, K=10, return_nn=True)
-    loss = compute_similarity_loss(normals, knn.idx)
-
-    return loss
-
-def compute_similarity_loss(normals, knn_idx):
-    """
-    Calculate the loss function for normal similarity, which encourages neighboring points to have similar normals.
-    :param normals: (B, N, 3) torch.Tensor, normal vectors
-    :param knn_idx: (B, N, k) torch.Tensor, k-nearest neighbor indices
-    :return: torch.Tensor, similarity loss
-    """
-    B, N, k = knn_idx.shape
-
-    # Get the normals of neighboring points
-    knn_idx = knn_idx.view(B, -1)  # Flatten the indices
-    neighbor_normals = normals.gather(1, knn_idx.unsqueeze(-1).expand(-1, -1, 3))  # Get neighbor normals
-    neighbor_normals = neighbor_normals.view(B, N, k, 3)  # Reshape back to neighbor normals shape
-
-    # Expand normals
-    normals_expanded = normals.unsqueeze(2).expand(-1, -1, k, -1)  # B x N x k x 3
-
-    # Calculate cosine similarity
-    cos_sim = F.cosine_similarity(normals_expanded, neighbor_normals, dim=-1)  # B x N x k
-
-    # Similarity loss, 1 minus cosine similarity is used as the loss since higher cosine similarity means more similarity
-    similarity_loss = 1 - cos_sim.abs()
-
-    return similarity_loss.mean()
-
-
-def get_rays(directions, c2w):
-    # Rotate ray directions from camera coordinate to the world coordinate
-    rays_d = directions @ c2w[:3, :3].T # (H, W, 3)
-    rays_d = rays_d / (np.linalg.norm(rays_d, axis=-1, keepdims=True) + 1e-8)
-    
-    # The origin of all rays is the camera origin in world coordinate
-    rays_o = np.broadcast_to(c2w[:3, 3], rays_d.shape) # (H, W, 3)
-
-    return rays_o, rays_d
-
-def xray_to_pcd(GenDepths, GenNormals, GenColors):
-    camera_angle_x = 0.8575560450553894
-    image_width = GenDepths.shape[-1]
-    image_height = GenDepths.shape[-2]
-    fx = 0.5 * image_width / np.tan(0.5 * camera_angle_x)
-
-    rays_screen_coords = np.mgrid[0:image_height, 0:image_width].reshape(
-            2, image_height * image_width).T  # [h, w, 2]
-
-    grid = rays_screen_coords.reshape(image_height, image_width, 2)
-
-    cx = image_width / 2.0
-    cy = image_height / 2.0
-
-    i, j = grid[..., 1], grid[..., 0]
-
-    directions = np.stack([(i-cx)/fx, -(j-cy)/fx, -np.ones_like(i)], -1) # (H, W, 3)
-
-    c2w = np.eye(4).astype(np.float32)
-
-    rays_origins, ray_directions = get_rays(directions, c2w)
-    rays_origins = rays_origins[None].repeat(GenDepths.shape[0], 0)
-    ray_directions = ray_directions[None].repeat(GenDepths.shape[0], 0)
-
-    GenDepths = GenDepths.transpose(0, 2, 3, 1)
-    GenNormals = GenNormals.transpose(0, 2, 3, 1)
-    GenColors = GenColors.transpose(0, 2, 3, 1)
-    
-    valid_index = GenDepths[..., 0] > 0
-    rays_origins = rays_origins[valid_index]
-    ray_directions = ray_directions[valid_index]
-    GenDepths = GenDepths[valid_index]
-    normals = GenNormals[valid_index]
-    colors = GenColors[valid_index]
-    xyz = rays_origins + ray_directions * GenDepths
-
-    return xyz, normals, colors
-
-
-def get_rays_torch(directions, c2w):
-    # Rotate ray directions from camera coordinate to the world coordinate
-    rays_d = torch.matmul(directions, c2w[:3, :3].T)  # (H, W, 3)
-    rays_d = rays_d / (torch.norm(rays_d, dim=-1, keepdim=True) + 1e-8)
-    # The origin of all rays is the camera origin in world coordinate
-    rays_o = c2w[:3, 3].expand_as(rays_d)  # (H, W, 3)
-    return rays_o, rays_d
-
-def xray_to_pcd_torch(GenDepths, GenHits, GenNormals=None):
-    camera_angle_x = 0.8575560450553894
-    image_width = GenDepths.shape[-1]
-    image_height = GenDepths.shape[-2]
-    fx = 0.5 * image_width / math.tan(0.5 * camera_angle_x)
-
-    rays_screen_coords = torch.stack(torch.meshgrid(
-        torch.arange(image_height, dtype=torch.float32),
-        torch.arange(image_width, dtype=torch.float32)
-    ), -1).reshape(-1, 2)  # [h, w, 2]
-
-    grid = rays_screen_coords.reshape(image_height, image_width, 2)
-
-    cx = image_width / 2.0
-    cy = image_height / 2.0
-
-    i, j = grid[..., 1], grid[..., 0]
-
-    directions = torch.stack([(i - cx) / fx, -(j - cy) / fx, -torch.ones_like(i)], -1)  # (H, W, 3)
-
-    c2w = torch.eye(4, dtype=torch.float32)
-
-    rays_origins, ray_directions = get_rays_torch(directions, c2w)
-    rays_origins = rays_origins.unsqueeze(0).expand(GenDepths.shape[0], -1, -1, -1).to(GenDepths.device)
-    ray_directions = ray_directions.unsqueeze(0).expand(GenDepths.shape[0], -1, -1, -1).to(GenDepths.device)
-
-    GenDepths = GenDepths.permute(0, 2, 3, 1)
-    GenHits = GenHits.permute(0, 2, 3, 1)
-    
-    valid_index = GenHits[..., 0] > 0
-    rays_origins = rays_origins[valid_index]
-    ray_directions = ray_directions[valid_index]
-    GenDepths = GenDepths[valid_index]
-    xyz = rays_origins + ray_directions * GenDepths
-
-    if GenNormals is not None:
-        GenNormals = GenNormals.permute(0, 2, 3, 1)
-        normals = GenNormals[valid_index]
-        return xyz, normals
-    else:
-        return xyz
-
-
-
-
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Script to train Stable Diffusion XL for InstructPix2Pix."
@@ -457,6 +306,38 @@ def parse_args():
         default=2,
         help=("Max number of checkpoints to store."),
     )
+    parser.add_argument(
+        "--timing_log_steps",
+        type=int,
+        default=None,
+        help=(
+            "Record the wall and CUDA time of every phase of the training step (data, forward, loss, backward, ...)"
+            " and log their p50 / p90 / p99 over the last 100 steps every X steps."
+        ),
+    )
+    parser.add_argument(
+        "--trace_steps",
+        type=str,
+        default=None,
+        help="Write the phases of the training steps START:END as a Chrome trace to `output_dir`/trace_rank<process>.json.",
+    )
+    parser.add_argument(
+        "--max_pending_artifacts",
+        type=int,
+        default=8,
+        help=(
+            "Training sample dumps are written in a background thread; while this many writes are pending"
+            " new dumps are dropped instead of stalling training. Validation outputs are never dropped."
+        ),
+    )
+    parser.add_argument(
+        "--async_checkpointing",
+        action="store_true",
+        help=(
+            "Snapshot the training state into pinned host memory and write checkpoints in a background thread."
+            " Needs host memory for a copy of the model and optimizer states."
+        ),
+    )
     parser.add_argument(
         "--resume_from_checkpoint",
         type=str,
@@ -492,6 +373,80 @@ def parse_args():
         help=("the data root path."),
     )
 
+    parser.add_argument(
+        "--train_shards",
+        type=str,
+        default=None,
+        help=("stream training samples from tar shards written by scripts/pack_shards.py (index.json or its directory)."
+              " Validation still reads from `--data_root`."),
+    )
+    parser.add_argument(
+        "--train_meshes",
+        type=str,
+        default=None,
+        help=("ray cast training samples on the fly from the meshes written by scripts/prepare_meshes.py in this directory."
+              " Validation still reads from `--data_root`."),
+    )
+    parser.add_argument(
+        "--train_mesh_images",
+        type=str,
+        default=None,
+        help=("with `--train_meshes`, the rendered `images` directory of the meshes: their cameras and renders are used"
+              " instead of random cameras and flat shaded condition images."),
+    )
+    parser.add_argument(
+        "--mesh_pool_size",
+        type=int,
+        default=8,
+        help=("the number of meshes each dataloader worker keeps loaded when using `--train_meshes`."),
+    )
+    parser.add_argument(
+        "--views_per_mesh",
+        type=int,
+        default=16,
+        help=("views rendered from a mesh before it is replaced in the pool when using `--train_meshes`."),
+    )
+
+    parser.add_argument(
+        "--layer_buckets",
+        type=str,
+        default=None,
+        help=("frame counts of layer buckets, e.g. 2,4,8: batches hold views of one bucket, read with its frame count"
+              " instead of `--num_frames`. Needs the manifest of scripts/build_manifest.py."),
+    )
+    parser.add_argument(
+        "--shuffle_buffer",
+        type=int,
+        default=1000,
+        help=("the number of samples in the shuffle buffer of each dataloader worker when using `--train_shards`."),
+    )
+    parser.add_argument(
+        "--decode_threads",
+        type=int,
+        default=1,
+        help=("threads used by every dataloader worker to decode zstd / lz4 X-Rays."),
+    )
+    parser.add_argument(
+        "--normal_loss",
+        type=str,
+        default="knn",
+        choices=["knn", "grid"],
+        help=("normal consistency loss: `knn` builds a kNN graph over all points of the batch (needs pytorch3d), "
+              "`grid` uses the image-space neighbourhoods of every layer and is linear in the number of hits."),
+    )
+    parser.add_argument(
+        "--compile_loss",
+        action="store_true",
+        help=("compile the dense hit / surface part of the loss with `torch.compile`."),
+    )
+    parser.add_argument(
+        "--resolution_schedule",
+        type=str,
+        default=None,
+        help=("progressive-resolution curriculum as `step:resolution` pairs, e.g. `0:64,20000:128,60000:256`. "
+              "The last resolution must be --height; validation always runs at --height."),
+    )
+
     parser.add_argument(
         "--near",
         type=float,
@@ -505,8 +460,32 @@ def parse_args():
         default=1.8,
         help=("the farest distance"),
     )
+    parser.add_argument(
+        "--augment_hflip",
+        type=float,
+        default=0.0,
+        help=("the probability of mirroring a training sample horizontally, normals and condition image included."),
+    )
+    parser.add_argument(
+        "--augment_depth_scale",
+        type=float,
+        default=0.0,
+        help=("scale the depths of a training sample by a random factor within 1 +- this, kept within --near / --far."),
+    )
+    parser.add_argument(
+        "--augment_color",
+        type=float,
+        default=0.0,
+        help=("the relative strength of the brightness and saturation jitter of the colours and condition image."),
+    )
 
     args = parser.parse_args()
+    if args.train_shards is not None and args.train_meshes is not None:
+        raise ValueError("--train_shards and --train_meshes are two sources of training samples, pass only one")
+    if args.resolution_schedule is not None:
+        resolutions = ResolutionSchedule(args.resolution_schedule).resolutions
+        if resolutions[-1] != args.height or args.height != args.width or any(r % 8 != 0 for r in resolutions):
+            raise ValueError("the resolutions of --resolution_schedule must be multiples of 8 and end at --height == --width")
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
         args.local_rank = env_local_rank
@@ -615,6 +594,9 @@ def main():
             vae = models[0]
             vae.save_pretrained(os.path.join(output_dir, "vae"))
 
+            # the encoder and decoder are part of the vae, make sure that no model is saved again
+            weights.clear()
+
         def load_model_hook(models, input_dir):
             # if args.use_ema:
             #     load_model = EMAModel.from_pretrained(os.path.join(input_dir, "vae_ema"), AutoencoderKL)
@@ -622,6 +604,8 @@ def main():
             #     ema_vae.to(accelerator.device)
             #     del load_model
             vae = models[0]
+            # the encoder and decoder are part of the vae, make sure that no model is loaded again
+            models.clear()
             # load diffusers style into model
             load_model = AutoencoderKLTemporalDecoder.from_pretrained(input_dir, subfolder="vae")
             vae.register_to_config(**load_model.config)
@@ -667,16 +651,50 @@ def main():
     # DataLoaders creation:
     args.global_batch_size = args.per_gpu_batch_size * accelerator.num_processes
 
-    train_dataset = UpsamplerDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="train")
-    train_dataset[0]
-    val_dataset = UpsamplerDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="val")
-    sampler = RandomSampler(train_dataset)
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        sampler=sampler,
-        batch_size=args.per_gpu_batch_size,
-        num_workers=args.num_workers,
-    )
+    frame_buckets = tuple(int(frames) for frames in args.layer_buckets.split(",")) if args.layer_buckets is not None else None
+    streaming = args.train_shards is not None or args.train_meshes is not None
+    if streaming and frame_buckets is not None:
+        raise ValueError("--layer_buckets needs random access to the dataset, it cannot be used with --train_shards"
+                         " or --train_meshes")
+    if args.train_meshes is not None:
+        # meshes are split across ranks and workers by the dataset itself
+        train_dataset = MeshXRayDataset(args.train_meshes, args.height, args.num_frames, near=args.near, far=args.far,
+                                        type="upsampler", image_root=args.train_mesh_images, pool_size=args.mesh_pool_size,
+                                        views_per_mesh=args.views_per_mesh, seed=args.seed or 0)
+    if args.train_shards is not None:
+        # shards are split across ranks and workers by the dataset itself
+        train_dataset = ShardDataset(args.train_shards, args.height, args.num_frames, near=args.near, far=args.far,
+                                     type="upsampler", shuffle_buffer=args.shuffle_buffer, seed=args.seed or 0,
+                                     decode_threads=args.decode_threads)
+    if streaming:
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=args.per_gpu_batch_size,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            collate_fn=collate_same_size,
+        )
+    else:
+        train_dataset = UpsamplerDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="train",
+                                         decode_threads=args.decode_threads, frame_buckets=frame_buckets)
+        train_dataset[0]
+        sampler = RandomSampler(train_dataset)
+        batching = {"sampler": sampler, "batch_size": args.per_gpu_batch_size}
+        if frame_buckets is not None:
+            # every batch holds views of one layer bucket, all read with its frame count
+            batching = {"batch_sampler": LayerBucketBatchSampler(train_dataset.sample_num_frames, args.per_gpu_batch_size,
+                                                                 seed=args.seed or 0,
+                                                                 num_processes=accelerator.num_processes,
+                                                                 process_index=accelerator.process_index)}
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            **batching,
+            num_workers=args.num_workers,
+            pin_memory=torch.cuda.is_available(),
+            collate_fn=collate_same_size,
+        )
+    val_dataset = UpsamplerDataset(args.data_root, args.height, args.num_frames, near=args.near, far=args.far, phase="val",
+                                   decode_threads=args.decode_threads)
 
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
@@ -694,9 +712,18 @@ def main():
     )
 
     # Prepare everything with our `accelerator`.
-    vae, vae.encoder, vae.decoder, optimizer, lr_scheduler, train_dataloader = accelerator.prepare(
-        vae, vae.encoder, vae.decoder, optimizer, lr_scheduler, train_dataloader
-    )
+    vae, vae.encoder, vae.decoder, optimizer, lr_scheduler = accelerator.prepare(
+        vae, vae.encoder, vae.decoder, optimizer, lr_scheduler
+    )
+    if not streaming and frame_buckets is None:
+        # sharded across processes by accelerate (the layer bucket sampler shards itself), moved to the device by the
+        # prefetcher below
+        train_dataloader = accelerator.prepare_data_loader(train_dataloader, device_placement=False)
+    # pinned host-to-device copies of the next batch overlap with the current step, the cast to weight_dtype runs on the device
+    train_dataloader = DevicePrefetcher(train_dataloader, accelerator.device, dtype=weight_dtype)
+    # random flips and jitter of the batches, on the device
+    augment = XRayAugmentation(args.near, args.far, hflip=args.augment_hflip, depth_scale=args.augment_depth_scale,
+                               color=args.augment_color)
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(
@@ -711,6 +738,8 @@ def main():
     # The trackers initializes automatically on the main process.
     if accelerator.is_main_process:
         accelerator.init_trackers("X-Ray", config=vars(args))
+        # sample dumps and validation outputs are encoded and written off the training loop
+        writer = BackgroundWriter(max_pending=args.max_pending_artifacts)
 
     # Train!
     total_batch_size = args.per_gpu_batch_size * \
@@ -727,16 +756,15 @@ def main():
         f"  Gradient Accumulation steps = {args.gradient_accumulation_steps}")
     logger.info(f"  Total optimization steps = {args.max_train_steps}")
 
+    checkpointer = AsyncCheckpointer(accelerator, args.output_dir, args.checkpoints_total_limit) if args.async_checkpointing else None
+
     # Potentially load in the weights and states from a previous save
     if args.resume_from_checkpoint:
         if args.resume_from_checkpoint != "latest":
             path = os.path.basename(args.resume_from_checkpoint)
         else:
-            # Get the most recent checkpoint
-            dirs = os.listdir(args.output_dir)
-            dirs = [d for d in dirs if d.startswith("checkpoint")]
-            dirs = sorted(dirs, key=lambda x: int(x.split("-")[1]))
-            path = dirs[-1] if len(dirs) > 0 else None
+            # Get the most recent checkpoint that was completely written
+            path = latest_checkpoint(args.output_dir)
 
         if path is None:
             accelerator.print(
@@ -755,22 +783,55 @@ def main():
     progress_bar.set_description("Steps")
 
     progress_bar.update(global_step)
+
+    # training resolution of every stage of the curriculum, a single stage without --resolution_schedule
+    resolution_schedule = ResolutionSchedule(args.resolution_schedule or f"0:{args.height}")
+    stage, resolution = resolution_schedule(global_step)
+    train_dataset.set_size(resolution)
+    if args.resume_from_checkpoint:
+        record = ResolutionSchedule.load(os.path.join(args.output_dir, path))
+        if record is not None and (record["stage"], record["resolution"]) != (stage, resolution):
+            logger.warning(f"{path} was saved in resolution stage {record['stage']} ({record['resolution']}), "
+                           f"resuming in stage {stage} ({resolution}) of {resolution_schedule}")
+
+    # hit / surface / normal loss, its ray table stays on the device for the whole run
+    xray_loss = XRayLoss(args.height, args.width, args.near, args.far, normal_loss=args.normal_loss,
+                         normal_weight=0.001, knn_kwargs={"k": 20, "k_similarity": 10},
+                         compile=args.compile_loss).to(accelerator.device)
+
+    # per-phase timing of the training step, free when neither --timing_log_steps nor --trace_steps is set
+    timer = StepTimer(
+        enabled=args.timing_log_steps is not None,
+        trace_steps=tuple(int(step) for step in args.trace_steps.split(":")) if args.trace_steps is not None else None,
+        trace_path=os.path.join(args.output_dir, f"trace_rank{accelerator.process_index}.json"),
+        device=accelerator.device,
+        process_index=accelerator.process_index,
+    )
+
     for epoch in range(first_epoch, args.num_train_epochs):
         vae.train()
+        if streaming:
+            train_dataset.set_epoch(epoch)
         train_loss = 0.0
         for step, batch in enumerate(train_dataloader):
+            timer.lap("data")
+            batch = augment(batch)
+            stage, resolution = resolution_schedule(global_step)
+            if resolution != train_dataset.size:
+                logger.info(f"Resolution stage {stage}: training at {resolution}x{resolution} from step {global_step}")
+                train_dataset.set_size(resolution)
 
             with accelerator.accumulate(vae):
-                xray = batch["xray"].to(weight_dtype).to(
-                    accelerator.device, non_blocking=True
-                )
+                xray = batch["xray"]
+                timer.lap("to_device")
 
                 # save and conditional_pixel_values as images.
                 if global_step % 100 == 0 and accelerator.is_main_process:
-                    os.makedirs(os.path.join(args.output_dir, "samples"), exist_ok=True)
-                    torchvision.utils.save_image(xray[0, :, 0:1], os.path.join(args.output_dir, "samples", "depths_high.png"), normalize=True, nrow=4)
-                    torchvision.utils.save_image(xray[0, :, 1:4], os.path.join(args.output_dir, "samples", "normals_high.png"), normalize=True, nrow=4)
-                    torchvision.utils.save_image(xray[0, :, 4:7], os.path.join(args.output_dir, "samples", "colors_high.png"), normalize=True, nrow=4)
+                    sample = to_host(xray[0])
+                    writer.try_submit(save_images, {
+                        "depths_high": sample[:, 0:1], "normals_high": sample[:, 1:4], "colors_high": sample[:, 4:7],
+                    }, os.path.join(args.output_dir, "samples"))
+                timer.lap("samples")
 
                 with torch.backends.cuda.sdp_kernel(enable_flash=True, enable_math=True, enable_mem_efficient=False):
                     xray_input = xray.flatten(0, 1)
@@ -781,47 +842,41 @@ def main():
 
                     z = posterior.sample() # Not mode()
 
+                    # the frame count of the batch, fewer than --num_frames with --layer_buckets
+                    num_frames = xray.shape[1]
                     # if vae is dype of DistributedDataParallel
                     if isinstance(vae, torch.nn.parallel.DistributedDataParallel):
-                        model_pred = vae.module.decode(z, num_frames=args.num_frames).sample
+                        model_pred = vae.module.decode(z, num_frames=num_frames).sample
                     else:
-                        model_pred = vae.decode(z, num_frames=args.num_frames).sample
+                        model_pred = vae.decode(z, num_frames=num_frames).sample
                     
-                    model_pred = model_pred.reshape(-1, args.num_frames, *model_pred.shape[1:])
+                    model_pred = model_pred.reshape(-1, num_frames, *model_pred.shape[1:])
+                timer.lap("forward")
                 
                 model_pred = model_pred.float()
                 xray = xray.float()
 
-                H = (xray[:, :, -1:] > 0.0).detach().expand(-1, -1, 7, -1, -1)
-                hit_loss = F.binary_cross_entropy_with_logits(model_pred[:, :, -1:], xray[:, :, -1:] * 0.5 + 0.5)
-                surface_loss = F.mse_loss(model_pred[:, :, :-1][H], xray[:, :, :-1][H])
+                hit_loss, surface_loss, normal_loss = xray_loss(model_pred, xray)
                 kl_loss = 1e-6 * posterior.kl().mean()
 
-                # pred normalization
-                GenDepths = (model_pred[:, :, 0:1] * 0.5 + 0.5) * (args.far - args.near) + args.near
-                GenHits = (model_pred[:, :, -1:] > 0).float().detach()
-                GenDepths[GenHits == 0] = 0
-                GenDepths[GenDepths <= args.near] = 0
-                GenDepths[GenDepths >= args.far] = 0
-                GenDepths = GenDepths.reshape(-1, 1, args.height, args.width)
-                GenHits = GenHits.reshape(-1, 1, args.height, args.width)
-                Genpts = xray_to_pcd_torch(GenDepths, GenHits)
-                normal_loss = 0.001 * normal_similarity_loss(Genpts[None])
-
                 loss = hit_loss + surface_loss + kl_loss + normal_loss
+                timer.lap("loss")
 
                 # Gather the losses across all processes for logging (if we use distributed training).
                 avg_loss = accelerator.gather(
                     loss.repeat(args.per_gpu_batch_size)).mean()
                 train_loss += avg_loss.item() / args.gradient_accumulation_steps
+                timer.lap("gather")
 
                 # Backpropagate
                 accelerator.backward(loss)
+                timer.lap("backward")
                 if accelerator.sync_gradients:
                     accelerator.clip_grad_norm_(vae.parameters(), args.max_grad_norm)
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad()
+                timer.lap("optimizer")
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
@@ -830,42 +885,31 @@ def main():
                                  "hit_loss": hit_loss, 
                                  "surface_loss": surface_loss,
                                  "kl_loss": kl_loss,
-                                 "normal_loss": normal_loss}, step=global_step)
+                                 "normal_loss": normal_loss,
+                                 "resolution": xray.shape[-1]}, step=global_step)
                 train_loss = 0.0
+                if args.timing_log_steps is not None and global_step % args.timing_log_steps == 0:
+                    accelerator.log(timer.summary(), step=global_step)
 
                 if accelerator.is_main_process:
                     # save checkpoints!
                     if global_step % args.checkpointing_steps == 0:
-                        # _before_ saving state, check if this save would set us over the `checkpoints_total_limit`
-                        if args.checkpoints_total_limit is not None:
-                            checkpoints = os.listdir(args.output_dir)
-                            checkpoints = [
-                                d for d in checkpoints if d.startswith("checkpoint")]
-                            checkpoints = sorted(
-                                checkpoints, key=lambda x: int(x.split("-")[1]))
-
-                            # before we save the new checkpoint, we need to have at _most_ `checkpoints_total_limit - 1` checkpoints
-                            if len(checkpoints) >= args.checkpoints_total_limit:
-                                num_to_remove = len(
-                                    checkpoints) - args.checkpoints_total_limit + 1
-                                removing_checkpoints = checkpoints[0:num_to_remove]
-
-                                logger.info(
-                                    f"{len(checkpoints)} checkpoints already exist, removing {len(removing_checkpoints)} checkpoints"
-                                )
-                                logger.info(
-                                    f"removing checkpoints: {', '.join(removing_checkpoints)}")
-
-                                for removing_checkpoint in removing_checkpoints:
-                                    removing_checkpoint = os.path.join(
-                                        args.output_dir, removing_checkpoint)
-                                    shutil.rmtree(removing_checkpoint)
-
-                        save_path = os.path.join(
-                            args.output_dir, f"checkpoint-{global_step}")
-                        # accelerator.unwrap_model(vae).save_pretrained(save_path)
-                        accelerator.save_state(save_path)
-                        logger.info(f"Saved state to {save_path}")
+                        if checkpointer is not None:
+                            save_path = checkpointer.save(
+                                global_step, {"vae": vae}, on_write=lambda path, step=global_step: resolution_schedule.save(path, step))
+                            logger.info(f"Saving state to {save_path} in the background")
+                        else:
+                            # _before_ saving state, make sure this save does not set us over the `checkpoints_total_limit`
+                            if args.checkpoints_total_limit is not None:
+                                rotate_checkpoints(args.output_dir, args.checkpoints_total_limit - 1)
+
+                            save_path = os.path.join(
+                                args.output_dir, f"checkpoint-{global_step}")
+                            accelerator.save_state(save_path)
+                            resolution_schedule.save(save_path, global_step)
+                            mark_complete(save_path)
+                            logger.info(f"Saved state to {save_path}")
+                        timer.lap("checkpoint")
                     # sample images!
                     if (
                         (global_step % args.validation_steps == 0)
@@ -890,38 +934,26 @@ def main():
                                 model_pred = vae(xray_input, num_frames=args.num_frames).sample
                                 outputs = model_pred.reshape(-1, args.num_frames, *model_pred.shape[1:])[0]
 
-                                # save the generated images
-                                outputs = outputs.clip(-1, 1)
-                                GenDepths = (outputs[:, 0:1] * 0.5 + 0.5) * (args.far - args.near) + args.near
-                                GenHits = (outputs[:, 7:8] > 0).float()
-                                GenDepths[GenHits == 0] = 0
-                                GenDepths[GenDepths <= args.near] = 0
-                                GenDepths[GenDepths >= args.far] = 0
-                                GenNormals = F.normalize(outputs[:, 1:4], dim=1)
-                                GenNormals[GenHits.repeat(1, 3, 1, 1) == 0] = 0
-                                GenColors = outputs[:, 4:7] * 0.5 + 0.5
-                                GenColors[GenHits.repeat(1, 3, 1, 1) == 0] = 0
-                               
-                                GenDepths = GenDepths.cpu().numpy()
-                                GenNormals = GenNormals.cpu().numpy()
-                                GenColors = GenColors.cpu().numpy()
-                                gen_pts, gen_normals, gen_colors = xray_to_pcd(GenDepths, GenNormals, GenColors)
-                                pcd = o3d.geometry.PointCloud()
-                                pcd.points = o3d.utility.Vector3dVector(gen_pts)
-                                pcd.normals = o3d.utility.Vector3dVector(gen_normals)
-                                pcd.colors = o3d.utility.Vector3dVector(gen_colors)
-                                o3d.io.write_point_cloud(f"{val_save_dir}/step_{global_step}_val_img_{val_img_idx}_prd.ply", pcd)
+                                # save the generated point cloud
+                                writer.submit(save_xray, to_host(outputs.float()),
+                                              f"{val_save_dir}/step_{global_step}_val_img_{val_img_idx}_prd",
+                                              args.near, args.far, images=False)
+                        timer.lap("validation")
 
             logs = {"step_loss": loss.detach().item(
             ), "lr": lr_scheduler.get_last_lr()[0]}
             progress_bar.set_postfix(**logs)
+            timer.end_step(global_step)
             global_step += 1
             if global_step >= args.max_train_steps:
                 break
 
     # Create the pipeline using the trained modules and save it.
+    if checkpointer is not None:
+        checkpointer.wait()
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
+        writer.close()
         vae = accelerator.unwrap_model(vae)
         vae.save_pretrained(args.output_dir)
 